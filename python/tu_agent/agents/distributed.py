@@ -0,0 +1,307 @@
+"""Actor/learner Q-learning over `multiprocessing.connection` sockets.
+
+Actors each step their own env with a local, read-only copy of the Q-table
+and stream transitions to one `Learner` in batches. The transitions are
+already reduced to `state_index` rows, so a batch is five flat arrays plus
+the next observations' `action_mask`s, which the TD targets respect. The
+learner applies each batch with `observe_batch`-style TD updates, in arrival
+order. Every applied batch bumps the table version. The reply to a batch
+carries the current table once the actor's copy is `sync_every` versions
+old; otherwise it's a bare ack. Once `max_episodes` episodes have arrived,
+replies tell actors to stop.
+
+Addresses are a Unix socket path or "host:port" for TCP (`parse_address`).
+Connections are authenticated with an HMAC challenge on `authkey`, run on
+each connection's own thread under `handshake_timeout_s`, so a peer that
+connects and goes silent holds up no one else. The key doesn't encrypt
+anything, so expose a TCP learner only on a trusted network.
+
+Staleness is measured per batch in two ways. `lag` is how many versions the
+learner's table moved past the one the actor acted with. `age_s` is how
+long the actor had held its copy.
+
+    learner = Learner(agent, "/tmp/learner.sock", authkey, max_episodes=2000)
+    # in each actor process:
+    run_actor("/tmp/learner.sock", authkey, env, QLearnConfig())
+    learner.serve(num_actors=4)
+"""
+from __future__ import annotations
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, answer_challenge, deliver_challenge
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from .q_learning import QLearningAgent, QLearnConfig, next_allowed, state_index
+from .q_table import QTable
+from tu_agent.env.obs_array import action_mask
+from tu_agent.utils.stats import summarize
+
+Address = Union[str, Tuple[str, int]]
+
+def parse_address(s: str) -> Address:
+    """"host:port" -> a TCP address; anything else is a Unix socket path."""
+    host, sep, port = s.rpartition(":")
+    if sep and port.isdigit() and "/" not in s:
+        return (host or "127.0.0.1", int(port))
+    return s
+
+def _table_msg(kind: str, version: int, q: QTable) -> Tuple[Any, ...]:
+    return (kind, version, q.num_states, q.action_size, sys.byteorder, q.data.tobytes())
+
+def _load_table(q: QTable, msg: Tuple[Any, ...]):
+    _kind, _version, num_states, action_size, byteorder, payload = msg
+    if (num_states, action_size) != (q.num_states, q.action_size):
+        raise ValueError(f"learner table is {(num_states, action_size)}, actor's is {(q.num_states, q.action_size)}")
+    data = array("d", payload)
+    if byteorder != sys.byteorder:
+        data.byteswap()
+    q.data[:] = data
+
+class Learner:
+    """Applies actors' transition batches to one agent's Q-table and sends the table back."""
+
+    def __init__(self, agent: QLearningAgent, address: Address, authkey: bytes, sync_every: int=1,
+                 max_episodes: Optional[int]=None, handshake_timeout_s: float=10.0):
+        self.agent = agent
+        self.sync_every = max(1, sync_every)
+        self.max_episodes = max_episodes
+        self.authkey = authkey
+        self.handshake_timeout_s = handshake_timeout_s
+        self._sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(address)
+            self._sock.listen(64)
+        except OSError:
+            self._sock.close()
+            raise
+        self.address: Address = self._sock.getsockname()
+        self.rejected = 0
+        self.version = 0
+        self.transitions = 0
+        self.episodes = 0
+        self.successes = 0
+        self.syncs = 0
+        self.update_s = 0.0
+        self.lags: List[int] = []
+        self.ages: List[float] = []
+        self.per_actor: Dict[int, int] = {}
+        self._next_id = 0
+        self._open = 0
+        self._t0: Optional[float] = None
+        self._t1: Optional[float] = None
+        self._cond = threading.Condition()
+
+    @property
+    def stopping(self) -> bool:
+        return self.max_episodes is not None and self.episodes >= self.max_episodes
+
+    def serve(self, num_actors: int, until: Optional[Callable[[], bool]]=None):
+        """Serve until `num_actors` actors have connected and all have disconnected.
+
+        `until()` is polled every second and ends serving early when it
+        returns True (e.g. every local actor process has exited).
+        """
+        threading.Thread(target=self._accept_loop, name="tu_learner_accept", daemon=True).start()
+        with self._cond:
+            while not (self._next_id >= num_actors and self._open == 0):
+                if until is not None and until():
+                    break
+                self._cond.wait(1.0)
+            self._t1 = time.perf_counter()
+        self.close()
+
+    def close(self):
+        try:
+            # wakes the accept thread
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        if isinstance(self.address, str) and self.address and not self.address.startswith("\0"):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                # listener closed by serve()
+                return
+            threading.Thread(target=self._handshake, args=(sock,), name="tu_learner_handshake", daemon=True).start()
+
+    def _set_recv_timeout(self, sock: socket.socket, secs: float):
+        # SO_RCVTIMEO rather than settimeout(), which would make the fd non-blocking under Connection
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", int(secs), int(secs % 1 * 1e6)))
+
+    def _handshake(self, sock: socket.socket):
+        """`Listener.accept`'s HMAC challenge, on this connection's thread and under a timeout."""
+        with sock:
+            try:
+                self._set_recv_timeout(sock, self.handshake_timeout_s)
+                conn = Connection(os.dup(sock.fileno()))
+            except OSError:
+                return
+            try:
+                deliver_challenge(conn, self.authkey)
+                answer_challenge(conn, self.authkey)
+                # actors may go quiet for a long episode once connected
+                self._set_recv_timeout(sock, 0)
+            except (AuthenticationError, EOFError, OSError):
+                # wrong authkey, a silent peer or a port scanner
+                conn.close()
+                with self._cond:
+                    self.rejected += 1
+                return
+        with self._cond:
+            actor_id = self._next_id
+            self._next_id += 1
+            self._open += 1
+            if self._t0 is None:
+                self._t0 = time.perf_counter()
+        self._handle(conn, actor_id)
+
+    def _handle(self, conn: Connection, actor_id: int):
+        try:
+            with conn:
+                while True:
+                    msg = conn.recv()
+                    if msg[0] == "hello":
+                        # serialized under the lock, sent outside it
+                        with self._cond:
+                            table = _table_msg("q", self.version, self.agent.q) + (actor_id,)
+                        conn.send(table)
+                    elif msg[0] == "batch":
+                        conn.send(self._apply(actor_id, *msg[1:]))
+                    elif msg[0] == "bye":
+                        return
+        except (EOFError, OSError):
+            # actor died; its unsent transitions are lost
+            pass
+        finally:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify_all()
+
+    def _apply(self, actor_id: int, version: int, age_s: float, states: array, actions: array, rewards: array,
+               next_states: array, dones: array, next_masks: List[Optional[int]], episodes: int,
+               successes: int) -> Tuple[Any, ...]:
+        cfg = self.agent.cfg
+        allowed = next_allowed(next_masks, self.agent.action_size)
+        with self._cond:
+            t0 = time.perf_counter()
+            self.agent.q.td_update_batch(states, actions, rewards, next_states, dones, cfg.alpha, cfg.gamma, allowed)
+            self.update_s += time.perf_counter() - t0
+            self.lags.append(self.version - version)
+            self.ages.append(age_s)
+            self.version += 1
+            self.transitions += len(states)
+            self.episodes += episodes
+            self.successes += successes
+            self.per_actor[actor_id] = self.per_actor.get(actor_id, 0) + len(states)
+            if self.stopping:
+                self.syncs += 1
+                return _table_msg("stop", self.version, self.agent.q)
+            if self.version - version >= self.sync_every:
+                self.syncs += 1
+                return _table_msg("q", self.version, self.agent.q)
+            return ("ack", self.version)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            end = self._t1 if self._t1 is not None else time.perf_counter()
+            elapsed = end - self._t0 if self._t0 is not None else 0.0
+            return {
+                "actors": self._next_id,
+                "rejected": self.rejected,
+                "version": self.version,
+                "transitions": self.transitions,
+                "episodes": self.episodes,
+                "success_rate": self.successes / self.episodes if self.episodes else 0.0,
+                "transitions_per_s": self.transitions / elapsed if elapsed > 0 else 0.0,
+                "episodes_per_s": self.episodes / elapsed if elapsed > 0 else 0.0,
+                # share of wall time the learner spent applying updates
+                "update_busy": self.update_s / elapsed if elapsed > 0 else 0.0,
+                "syncs": self.syncs,
+                "lag": summarize(self.lags),
+                "age_s": summarize(self.ages),
+                "per_actor": dict(self.per_actor),
+            }
+
+def run_actor(address: Address, authkey: bytes, env: Any, cfg: QLearnConfig=QLearnConfig(), batch_size: int=64,
+              max_episodes: Optional[int]=None) -> Dict[str, Any]:
+    """Roll out episodes on `env`, acting with the learner's latest table, until the learner says stop.
+
+    Each actor seeds its exploration with `cfg.seed` plus the id the learner
+    assigns it, so actors don't repeat each other. Stops early after
+    `max_episodes` episodes if given. Returns this actor's counters.
+    """
+    # the env knows its action size only once a task is loaded
+    obs = env.reset()
+    conn = Client(address, authkey=authkey)
+    try:
+        conn.send(("hello",))
+        hello = conn.recv()
+        actor_id = hello[-1]
+        agent = QLearningAgent(env.action_size, QLearnConfig(cfg.alpha, cfg.gamma, cfg.eps, cfg.seed + actor_id))
+        _load_table(agent.q, hello[:-1])
+        version, synced_at = hello[1], time.perf_counter()
+
+        states, next_states, actions, dones = array("i"), array("i"), array("i"), array("b")
+        rewards = array("d")
+        next_masks: List[Optional[int]] = []
+        episodes = successes = pending_eps = pending_ok = syncs = 0
+        stop = False
+        t0 = time.perf_counter()
+
+        def flush() -> bool:
+            nonlocal version, synced_at, pending_eps, pending_ok, syncs
+            conn.send(("batch", version, time.perf_counter() - synced_at, states, actions, rewards,
+                       next_states, dones, next_masks, pending_eps, pending_ok))
+            reply = conn.recv()
+            del states[:], actions[:], rewards[:], next_states[:], dones[:], next_masks[:]
+            pending_eps = pending_ok = 0
+            if reply[0] != "ack":
+                _load_table(agent.q, reply)
+                version, synced_at = reply[1], time.perf_counter()
+                syncs += 1
+            return reply[0] == "stop"
+
+        while True:
+            done = False
+            while not done:
+                a = agent.act(obs)
+                s = state_index(obs)
+                obs, r, done, info = env.step(a)
+                states.append(s)
+                actions.append(a)
+                rewards.append(r)
+                next_states.append(state_index(obs))
+                dones.append(done)
+                next_masks.append(action_mask(obs))
+                if len(states) >= batch_size:
+                    stop = flush() or stop
+            episodes += 1
+            pending_eps += 1
+            if info.pass_rate >= 1.0:
+                successes += 1
+                pending_ok += 1
+            if stop or (max_episodes is not None and episodes >= max_episodes):
+                break
+            obs = env.reset()
+        if len(states) or pending_eps:
+            flush()
+        conn.send(("bye",))
+        elapsed = time.perf_counter() - t0
+        return {"actor": actor_id, "episodes": episodes, "successes": successes, "syncs": syncs,
+                "episodes_per_s": episodes / elapsed if elapsed > 0 else 0.0}
+    finally:
+        conn.close()
@@ -1,9 +1,10 @@
 from __future__ import annotations
 import random
-from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 from .base import Agent
+from .q_table import QTable
+from tu_agent.env.obs_array import ACTION_MASK, BEST_PASS_RATE, MAX_STEPS, STEP, TOOL_CALLS, action_mask, allowed_actions
 
 def bucket(x: float) -> int:
     # pass rate buckets
@@ -21,6 +22,40 @@ def state_key(obs: Dict[str, Any]) -> Tuple[int, int, int]:
     tool_bucket = 2 if tool_calls >= 6 else (1 if tool_calls >= 3 else 0)
     return (best, steps_bucket, tool_bucket)
 
+# sizes of the three state_key buckets
+STATE_SHAPE = (4, 3, 3)
+NUM_STATES = STATE_SHAPE[0] * STATE_SHAPE[1] * STATE_SHAPE[2]
+
+def _index(best_pass_rate: float, steps_left: float, tool_calls: float) -> int:
+    steps = 2 if steps_left >= 6 else (1 if steps_left >= 3 else 0)
+    tools = 2 if tool_calls >= 6 else (1 if tool_calls >= 3 else 0)
+    return (bucket(best_pass_rate) * STATE_SHAPE[1] + steps) * STATE_SHAPE[2] + tools
+
+def state_index(obs: Any) -> int:
+    """Row of `state_key(obs)` in the agent's `QTable`, for a dict or an `obs_array` observation."""
+    if isinstance(obs, dict):
+        best, steps, tools = state_key(obs)
+        return (best * STATE_SHAPE[1] + steps) * STATE_SHAPE[2] + tools
+    return _index(obs[BEST_PASS_RATE], obs[MAX_STEPS] - obs[STEP], obs[TOOL_CALLS])
+
+def state_indices(obs: Any) -> List[int]:
+    """`state_index` of each observation; `obs` may also be a 2-D `obs_batch` from a vec env."""
+    if isinstance(obs, memoryview) and obs.ndim == 2:
+        return [_index(obs[i, BEST_PASS_RATE], obs[i, MAX_STEPS] - obs[i, STEP], obs[i, TOOL_CALLS]) for i in range(obs.shape[0])]
+    return [state_index(o) for o in obs]
+
+def action_masks(obs: Any) -> List[Optional[int]]:
+    """`action_mask` of each observation, like `state_indices`."""
+    if isinstance(obs, memoryview) and obs.ndim == 2:
+        return [int(obs[i, ACTION_MASK]) for i in range(obs.shape[0])]
+    return [action_mask(o) for o in obs]
+
+def next_allowed(masks: Sequence[Optional[int]], action_size: int) -> Optional[List[Optional[List[int]]]]:
+    """`allowed_actions` per mask for `td_update_batch`; None when no observation carries a mask."""
+    if all(m is None for m in masks):
+        return None
+    return [None if m is None else allowed_actions(m, action_size) for m in masks]
+
 @dataclass
 class QLearnConfig:
     alpha: float = 0.2
@@ -29,30 +64,58 @@ class QLearnConfig:
     seed: int = 0
 
 class QLearningAgent(Agent):
-    def __init__(self, action_size: int, cfg: QLearnConfig = QLearnConfig()):
+    """Tabular Q-learning over `state_index(obs)`.
+
+    Exploration, the greedy choice and the TD target's max only consider the
+    actions the (next) observation's `action_mask` allows, so a masked
+    action's value never leaks into its neighbours' targets.
+
+    Pass `q` to start from (or share) an existing table, e.g.
+    `QTable.load(path, mmap_mode="r+")` in every training worker.
+    """
+
+    def __init__(self, action_size: int, cfg: QLearnConfig = QLearnConfig(), q: Optional[QTable]=None):
+        if q is not None and (q.num_states, q.action_size) != (NUM_STATES, action_size):
+            raise ValueError(f"Q-table shape {(q.num_states, q.action_size)} != {(NUM_STATES, action_size)}")
         self.action_size = action_size
         self.cfg = cfg
         self.rng = random.Random(cfg.seed)
-        self.q = defaultdict(lambda: [0.0] * self.action_size)
-        self.prev = None  # (s, a)
+        self.q = q if q is not None else QTable(NUM_STATES, action_size)
 
     def act(self, obs: Dict[str, Any]) -> int:
-        s = state_key(obs)
+        s = state_index(obs)
+        mask = action_mask(obs)
         if self.rng.random() < self.cfg.eps:
-            a = self.rng.randrange(self.action_size)
-        else:
-            qs = self.q[s]
-            a = int(max(range(self.action_size), key=lambda i: qs[i]))
-        self.prev = (s, a)
-        return a
+            return self.rng.choice(allowed_actions(mask, self.action_size))
+        return self.q.greedy(s) if mask is None else self.q.greedy_among(s, allowed_actions(mask, self.action_size))
+
+    def act_batch(self, obs: Sequence[Dict[str, Any]]) -> List[int]:
+        """`act` for each observation, drawing from the rng in the same order."""
+        states = state_indices(obs)
+        allowed = [allowed_actions(m, self.action_size) for m in action_masks(obs)]
+        explore = [self.rng.choice(acts) if self.rng.random() < self.cfg.eps else None for acts in allowed]
+        greedy = self.q.greedy_batch([s for s, e in zip(states, explore) if e is None],
+                                     [acts for acts, e in zip(allowed, explore) if e is None])
+        it = iter(greedy)
+        return [next(it) if e is None else e for e in explore]
 
     def observe(self, obs, action, reward, next_obs, done):
-        if self.prev is None:
-            return
-        s, a = self.prev
-        ns = state_key(next_obs)
-        max_next = max(self.q[ns])
-        target = reward + (0.0 if done else self.cfg.gamma * max_next)
-        self.q[s][a] = (1 - self.cfg.alpha) * self.q[s][a] + self.cfg.alpha * target
-        if done:
-            self.prev = None
+        # Keyed on the transition itself (not the last `act` call) so one agent
+        # can learn from several envs stepped in lockstep.
+        mask = action_mask(next_obs)
+        self.q.td_update(state_index(obs), action, reward, state_index(next_obs), done, self.cfg.alpha, self.cfg.gamma,
+                         None if mask is None else allowed_actions(mask, self.action_size))
+
+    def observe_batch(self, obs: Sequence[Dict[str, Any]], actions: Sequence[int], rewards: Sequence[float],
+                      next_obs: Sequence[Dict[str, Any]], dones: Sequence[bool]):
+        """`observe` for each transition, in order."""
+        self.q.td_update_batch(state_indices(obs), actions, rewards, state_indices(next_obs), dones, self.cfg.alpha, self.cfg.gamma,
+                               next_allowed(action_masks(next_obs), self.action_size))
+
+    def save(self, path: str):
+        self.q.save(path)
+
+    @classmethod
+    def load(cls, path: str, cfg: QLearnConfig = QLearnConfig(), mmap_mode: Optional[str]=None) -> "QLearningAgent":
+        q = QTable.load(path, mmap_mode=mmap_mode)
+        return cls(q.action_size, cfg, q=q)
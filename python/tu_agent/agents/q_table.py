@@ -0,0 +1,169 @@
+"""Dense Q-table stored as one flat, row-major float64 array.
+
+Rows are state indices (see `q_learning.state_index`), columns are actions.
+
+Tables are saved in NumPy's `.npy` format (version 1.0, `<f8`, C order). The
+header is written by hand, so NumPy isn't needed, and `np.load` reads the
+files. `QTable.load(path, mmap_mode="r+")` maps the file shared. Several
+training processes can then read and update one table without copying it;
+updates aren't locked, so concurrent writers race per entry, like Hogwild.
+`mmap_mode="r"` gives a read-only table for evaluation workers.
+"""
+from __future__ import annotations
+import ast
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+NPY_MAGIC = b"\x93NUMPY"
+NPY_ALIGN = 64
+
+def _npy_header(shape: Sequence[int]) -> bytes:
+    d = "{'descr': '<f8', 'fortran_order': False, 'shape': %r, }" % (tuple(shape),)
+    # magic(6) + version(2) + header length(2) + header, padded so the data is aligned
+    pad = -(10 + len(d) + 1) % NPY_ALIGN
+    h = (d + " " * pad + "\n").encode("latin1")
+    return NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(h)) + h
+
+def _read_npy_header(f) -> tuple:
+    """(shape, data offset) of an .npy file holding a C-order float64 array."""
+    if f.read(6) != NPY_MAGIC:
+        raise ValueError("not an .npy file")
+    major, _minor = f.read(2)
+    if major == 1:
+        (hlen,) = struct.unpack("<H", f.read(2))
+    elif major in (2, 3):
+        (hlen,) = struct.unpack("<I", f.read(4))
+    else:
+        raise ValueError(f"unsupported .npy version {major}")
+    d = ast.literal_eval(f.read(hlen).decode("latin1"))
+    if d.get("descr") != "<f8" or d.get("fortran_order"):
+        raise ValueError(f"expected a C-order '<f8' array, got {d.get('descr')!r} fortran_order={d.get('fortran_order')}")
+    return tuple(d["shape"]), f.tell()
+
+class QTable:
+    """`num_states x action_size` Q-values in a flat buffer (an `array('d')` or a mapped .npy file)."""
+
+    def __init__(self, num_states: int, action_size: int, data: Optional[Union[array, memoryview]]=None):
+        self.action_size = action_size
+        self.num_states = num_states
+        if data is None:
+            data = array("d", bytes(8 * num_states * action_size))
+        if len(data) != num_states * action_size:
+            raise ValueError(f"expected {num_states * action_size} values, got {len(data)}")
+        self.data = data
+        self._mm: Optional[mmap.mmap] = None
+
+    @property
+    def readonly(self) -> bool:
+        return isinstance(self.data, memoryview) and self.data.readonly
+
+    def row(self, s: int) -> List[float]:
+        a = self.action_size
+        return self.data[s * a:(s + 1) * a].tolist()
+
+    def get(self, s: int, a: int) -> float:
+        return self.data[s * self.action_size + a]
+
+    def greedy(self, s: int) -> int:
+        """argmax_a Q(s, a); ties go to the lowest action."""
+        qs = self.row(s)
+        return qs.index(max(qs))
+
+    def greedy_among(self, s: int, actions: Sequence[int]) -> int:
+        """argmax over `actions` (ascending) of Q(s, a); ties go to the lowest action."""
+        qs = self.row(s)
+        return max(actions, key=qs.__getitem__)
+
+    def greedy_batch(self, states: Sequence[int], allowed: Optional[Sequence[Sequence[int]]]=None) -> List[int]:
+        """`greedy` per state, or `greedy_among` with `allowed[i]` for state i."""
+        cache: Dict[Any, int] = {}
+        out = []
+        for i, s in enumerate(states):
+            key = s if allowed is None else (s, tuple(allowed[i]))
+            a = cache.get(key)
+            if a is None:
+                a = cache[key] = self.greedy(s) if allowed is None else self.greedy_among(s, allowed[i])
+            out.append(a)
+        return out
+
+    def td_update(self, s: int, a: int, reward: float, ns: int, done: bool, alpha: float, gamma: float,
+                  next_allowed: Optional[Sequence[int]]=None):
+        """TD(0) update of Q(s, a); the target's max is over `next_allowed` (all actions if None)."""
+        self.td_update_batch((s,), (a,), (reward,), (ns,), (done,), alpha, gamma, None if next_allowed is None else (next_allowed,))
+
+    def td_update_batch(self, states: Sequence[int], actions: Sequence[int], rewards: Sequence[float],
+                        next_states: Sequence[int], dones: Sequence[bool], alpha: float, gamma: float,
+                        next_allowed: Optional[Sequence[Optional[Sequence[int]]]]=None):
+        """One TD(0) update per transition, applied in order (same result as calling `td_update` per transition)."""
+        A = self.action_size
+        data = self.data
+        keep = 1 - alpha
+        if next_allowed is None:
+            next_allowed = [None] * len(states)
+        for s, a, r, ns, done, allowed in zip(states, actions, rewards, next_states, dones, next_allowed):
+            if done:
+                target = r
+            elif allowed is None:
+                target = r + gamma * max(data[ns * A:(ns + 1) * A])
+            else:
+                target = r + gamma * max(data[ns * A + b] for b in allowed)
+            i = s * A + a
+            data[i] = keep * data[i] + alpha * target
+
+    def save(self, path: str):
+        """Write the table as a `(num_states, action_size)` float64 .npy file (atomically)."""
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(_npy_header((self.num_states, self.action_size)))
+            data = self.data if isinstance(self.data, array) else array("d", self.data)
+            if sys.byteorder != "little":
+                data = array("d", data)
+                data.byteswap()
+            data.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str]=None) -> "QTable":
+        """Load a table saved by `save` (or `np.save`).
+
+        `mmap_mode` follows `np.load`. None copies the file into memory. "r"
+        maps it read-only. "r+" maps it shared, so updates reach the file and
+        every other process mapping it.
+        """
+        if mmap_mode not in (None, "r", "r+"):
+            raise ValueError(f"mmap_mode must be None, 'r' or 'r+', got {mmap_mode!r}")
+        with open(path, "rb" if mmap_mode != "r+" else "r+b") as f:
+            shape, offset = _read_npy_header(f)
+            if len(shape) != 2:
+                raise ValueError(f"expected a 2-d table, got shape {shape}")
+            num_states, action_size = shape
+            if mmap_mode is None or sys.byteorder != "little":
+                if mmap_mode is not None:
+                    raise ValueError("mmap_mode needs a little-endian host")
+                data = array("d")
+                data.fromfile(f, num_states * action_size)
+                if sys.byteorder != "little":
+                    data.byteswap()
+                return cls(num_states, action_size, data)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if mmap_mode == "r+" else mmap.ACCESS_READ)
+        view = memoryview(mm)[offset:offset + 8 * num_states * action_size].cast("d")
+        table = cls(num_states, action_size, view)
+        table._mm = mm
+        return table
+
+    def flush(self):
+        if self._mm is not None and not self.readonly:
+            self._mm.flush()
+
+    def close(self):
+        """Release a mapped file (a no-op for in-memory tables)."""
+        if self._mm is None:
+            return
+        self.flush()
+        self.data.release()
+        self._mm.close()
+        self._mm = None
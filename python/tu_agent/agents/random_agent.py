@@ -2,10 +2,12 @@ from __future__ import annotations
 import random
 from typing import Dict, Any
 from .base import Agent
+from tu_agent.env.obs_array import action_mask, allowed_actions, obs_get
 
 class RandomAgent(Agent):
     def __init__(self, seed: int = 0):
         self.rng = random.Random(seed)
 
     def act(self, obs: Dict[str, Any]) -> int:
-        return self.rng.randrange(obs["action_size"])
+        # uniform over the actions the observation's action_mask allows
+        return self.rng.choice(allowed_actions(action_mask(obs), obs_get(obs, "action_size")))
@@ -0,0 +1,99 @@
+from __future__ import annotations
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from tu_agent.env.tool_env import ToolUseCodingEnv, StepInfo
+from tu_agent.env.obs_array import obs_get
+
+@dataclass
+class EpisodeResult:
+    index: int
+    total_reward: float
+    steps: int
+    pass_rate: float
+    best_pass_rate: float
+    elapsed_s: float
+
+async def rollout(
+    make_env: Callable[[], ToolUseCodingEnv],
+    agent: Any,
+    num_episodes: int,
+    concurrency: int=64,
+    on_episode: Optional[Callable[[EpisodeResult], None]]=None,
+    on_step: Optional[Callable[[int, Dict[str, Any], int, float, Dict[str, Any], bool, StepInfo], None]]=None,
+) -> List[EpisodeResult]:
+    """Run `num_episodes` episodes on one event loop, at most `concurrency` in flight.
+
+    `make_env` builds an env around an `AsyncAutoRunner`. Envs are created
+    lazily, at most one per concurrent episode, and reused for later
+    episodes. `agent` needs `act(obs)` and, optionally,
+    `observe(obs, action, reward, next_obs, done)`. Agent calls are
+    synchronous and run between awaits, so a plain (non-thread-safe) agent
+    is fine. Results come back in episode order, and `on_episode` sees
+    each one as it finishes. `on_step(i, obs, action, reward, next_obs,
+    done, info)` sees every transition of episode `i`.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    idle: List[ToolUseCodingEnv] = []
+    created: List[ToolUseCodingEnv] = []
+    observe = getattr(agent, "observe", None)
+
+    async def episode(i: int) -> EpisodeResult:
+        async with sem:
+            if idle:
+                env = idle.pop()
+            else:
+                env = make_env()
+                created.append(env)
+            try:
+                t0 = time.perf_counter()
+                obs = await env.areset()
+                total = 0.0
+                done = False
+                info = None
+                while not done:
+                    a = agent.act(obs)
+                    next_obs, r, done, info = await env.astep(a)
+                    if observe is not None:
+                        observe(obs, a, r, next_obs, done)
+                    if on_step is not None:
+                        on_step(i, obs, a, r, next_obs, done, info)
+                    total += r
+                    obs = next_obs
+                res = EpisodeResult(
+                    index=i,
+                    total_reward=total,
+                    steps=obs_get(obs, "step"),
+                    pass_rate=info.pass_rate if info is not None else 0.0,
+                    best_pass_rate=obs_get(obs, "best_pass_rate"),
+                    elapsed_s=time.perf_counter() - t0,
+                )
+            finally:
+                idle.append(env)
+        if on_episode is not None:
+            on_episode(res)
+        return res
+
+    tasks = [asyncio.ensure_future(episode(i)) for i in range(num_episodes)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    finally:
+        # on failure, stop the other episodes before closing their envs
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for env in created:
+            await env.aclose()
+
+def summarize_episodes(results: List[EpisodeResult]) -> Dict[str, float]:
+    n = len(results)
+    if n == 0:
+        return {"episodes": 0}
+    return {
+        "episodes": n,
+        "success_rate": sum(r.pass_rate >= 1.0 for r in results) / n,
+        "mean_reward": sum(r.total_reward for r in results) / n,
+        "mean_steps": sum(r.steps for r in results) / n,
+    }
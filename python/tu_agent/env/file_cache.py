@@ -0,0 +1,133 @@
+"""In-memory copy of a workspace's files, so `read_file` needs no runner call.
+
+A task's files are read once, right after its first reset, and every later
+episode starts from that pristine set. A patch drops the entries for the
+paths it touched (from the runner's result, else the diff headers). The next
+read of such a path loads it from disk again. Paths not in the pristine set
+are read from disk on first use and kept.
+
+The cache only sees changes made through patches. Anything else that
+rewrites a workspace file must call `invalidate`.
+"""
+from __future__ import annotations
+import hashlib
+import os
+import time
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+from tu_agent.runner.test_cache import IGNORED_DIRS, IGNORED_SUFFIXES
+from tu_agent.runner.types import RunResult
+
+# larger files are read from disk when asked for, not at reset
+MAX_PRELOAD_BYTES = 1 << 20
+
+def load_files(root: str) -> Dict[str, bytes]:
+    """relpath -> contents of the files under `root`, minus test by-products and large files."""
+    out: Dict[str, bytes] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+        for fn in filenames:
+            p = os.path.join(dirpath, fn)
+            if fn.endswith(IGNORED_SUFFIXES) or os.path.islink(p) or os.path.getsize(p) > MAX_PRELOAD_BYTES:
+                continue
+            with open(p, "rb") as f:
+                out[os.path.relpath(p, root)] = f.read()
+    return out
+
+class WorkspaceFiles:
+    """File contents and sha256 digests of one workspace, on top of a shared pristine set."""
+
+    def __init__(self):
+        self.root: Optional[str] = None
+        self._real_root = ""
+        self._pristine: Dict[str, bytes] = {}
+        # relpath -> contents read since reset (None: the file doesn't exist)
+        self._local: Dict[str, Optional[bytes]] = {}
+        self._stale: Set[str] = set()
+        self._digests: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def reset(self, root: str, pristine: Dict[str, bytes]):
+        """Start over for `root`, whose files are exactly `pristine` (not copied)."""
+        self.root = root
+        self._real_root = os.path.realpath(root)
+        self._pristine = pristine
+        self._local = {}
+        self._stale = set()
+        self._digests = {}
+
+    def invalidate(self, paths: Optional[Iterable[str]]=None):
+        """Forget `paths` (workspace-relative); None forgets every file."""
+        if paths is None:
+            self._stale = set(self._pristine)
+            self._local = {}
+            self._digests = {}
+            self.invalidations += 1
+            return
+        for p in paths:
+            rel = os.path.normpath(p)
+            self._stale.add(rel)
+            self._local.pop(rel, None)
+            self._digests.pop(rel, None)
+            self.invalidations += 1
+
+    def _resolve(self, path: str) -> Tuple[Optional[str], str]:
+        """(relpath, "") for a path inside the workspace, else (None, error), like the runner's check."""
+        if "\0" in path:
+            return None, "invalid path"
+        if os.path.isabs(path):
+            return None, f"absolute paths are not allowed: {path}"
+        real = os.path.realpath(os.path.join(self._real_root, path))
+        if not real.startswith(self._real_root + os.sep):
+            return None, f"path escapes root: {path}"
+        return os.path.relpath(real, self._real_root), ""
+
+    def _get(self, rel: str) -> Optional[bytes]:
+        if rel in self._local:
+            self.hits += 1
+            return self._local[rel]
+        if rel not in self._stale and rel in self._pristine:
+            self.hits += 1
+            return self._pristine[rel]
+        self.misses += 1
+        try:
+            with open(os.path.join(self._real_root, rel), "rb") as f:
+                data: Optional[bytes] = f.read()
+        except FileNotFoundError:
+            data = None
+        self._local[rel] = data
+        return data
+
+    def read(self, path: str) -> RunResult:
+        """The file as a runner `read_file` result, served from memory when possible."""
+        t0 = time.perf_counter()
+        rel, err = self._resolve(path)
+        if rel is None:
+            return RunResult(False, 1, time.perf_counter() - t0, "", err, {"file_cache": True})
+        try:
+            data = self._get(rel)
+            if data is None:
+                raise FileNotFoundError(f"no such file: {path}")
+            text = data.decode("utf-8")
+        except (OSError, UnicodeDecodeError) as e:
+            return RunResult(False, 1, time.perf_counter() - t0, "", str(e), {"file_cache": True})
+        return RunResult(True, 0, time.perf_counter() - t0, text, "", {"file_cache": True})
+
+    def digest(self, path: str) -> Optional[str]:
+        """sha256 hex digest of a workspace file (None if it doesn't exist or isn't inside the workspace)."""
+        rel, _ = self._resolve(path)
+        if rel is None:
+            return None
+        d = self._digests.get(rel)
+        if d is None:
+            data = self._get(rel)
+            if data is None:
+                return None
+            d = self._digests[rel] = hashlib.sha256(data).hexdigest()
+        return d
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations, "files": len(self._pristine)}
@@ -0,0 +1,112 @@
+"""Numeric observations written into preallocated float64 buffers.
+
+With `ToolUseCodingEnv(obs_mode="array")`, reset and step don't build a new
+dict every time. They write the numeric observation fields into a fixed
+slot and return a 1-D `memoryview` of it (format "d"). The field offsets
+are the constants below, so agents read e.g. `obs[BEST_PASS_RATE]`.
+`msg_features > 0` appends a signed feature-hashed bag of words of the last
+tool message (`hash_features`).
+
+Each env owns two slots and alternates between them, so `obs` and
+`next_obs` from one step are distinct and stay valid until the step after.
+Copy a view (`list(obs)`) to keep it for longer. `VecToolUseCodingEnv` lays
+all its envs' slots out in two contiguous batches (`obs_batch`, shape
+`(num_envs, size)`) so batched agents get one block per step.
+"""
+from __future__ import annotations
+import re
+import zlib
+from array import array
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+FIELDS = ("step", "max_steps", "tool_calls", "best_pass_rate", "last_pass_rate", "last_tool", "applied_mask", "action_size", "action_mask")
+STEP, MAX_STEPS, TOOL_CALLS, BEST_PASS_RATE, LAST_PASS_RATE, LAST_TOOL, APPLIED_MASK, ACTION_SIZE, ACTION_MASK = range(len(FIELDS))
+FIELD_INDEX = {f: i for i, f in enumerate(FIELDS)}
+NUM_FIELDS = len(FIELDS)
+_INT_FIELDS = {"step", "max_steps", "tool_calls", "last_tool", "applied_mask", "action_size", "action_mask"}
+
+# StepInfo.tool -> LAST_TOOL (0 before the first step)
+TOOL_CODES = {"apply_patch": 1, "pytest": 2, "read_file": 3, "done": 4}
+# APPLIED_MASK and ACTION_MASK are float64s, exact for bits 0..52; patches
+# past that aren't tracked, and actions past that are always allowed
+MASK_BITS = 53
+_MASK_LOW = (1 << MASK_BITS) - 1
+
+Obs = Union[Mapping[str, Any], memoryview]
+
+_WORD_RE = re.compile(r"\w+")
+
+def hash_features(text: str, out: Any, offset: int, n: int):
+    """Signed feature hashing of the words of `text` into out[offset:offset+n], scaled by 1/#words."""
+    for j in range(offset, offset + n):
+        out[j] = 0.0
+    words = _WORD_RE.findall(text.lower())
+    if not words or n <= 0:
+        return
+    w = 1.0 / len(words)
+    for word in words:
+        # crc32 rather than hash(): stable across processes (PYTHONHASHSEED)
+        h = zlib.crc32(word.encode("utf-8"))
+        out[offset + h % n] += w if h >> 31 else -w
+
+def new_slots(size: int, count: int=2) -> Tuple[memoryview, ...]:
+    data = memoryview(array("d", [0.0]) * (size * count))
+    return tuple(data[k * size:(k + 1) * size] for k in range(count))
+
+class ObsBuffer:
+    """Two alternating observation slots for one env (its own, or rows of a vec env's batches)."""
+
+    def __init__(self, msg_features: int=0, slots: Optional[Sequence[memoryview]]=None):
+        self.msg_features = msg_features
+        self.size = NUM_FIELDS + msg_features
+        self.slots = tuple(slots) if slots is not None else new_slots(self.size)
+        if len(self.slots) != 2 or any(len(s) != self.size for s in self.slots):
+            raise ValueError(f"need two slots of {self.size} float64s")
+        self.parity = 1
+
+    def write(self, step: int, max_steps: int, tool_calls: int, best_pass_rate: float, last_pass_rate: float,
+              last_tool: int, applied_mask: int, action_size: int, action_mask: int, message: str) -> memoryview:
+        self.parity ^= 1
+        b = self.slots[self.parity]
+        b[STEP] = step
+        b[MAX_STEPS] = max_steps
+        b[TOOL_CALLS] = tool_calls
+        b[BEST_PASS_RATE] = best_pass_rate
+        b[LAST_PASS_RATE] = last_pass_rate
+        b[LAST_TOOL] = last_tool
+        b[APPLIED_MASK] = applied_mask
+        b[ACTION_SIZE] = action_size
+        b[ACTION_MASK] = action_mask & _MASK_LOW
+        if self.msg_features:
+            hash_features(message, b, NUM_FIELDS, self.msg_features)
+        return b
+
+def obs_get(obs: Obs, name: str) -> Any:
+    """Field `name` of a dict or array observation."""
+    if isinstance(obs, Mapping):
+        return obs[name]
+    x = obs[FIELD_INDEX[name]]
+    return int(x) if name in _INT_FIELDS else x
+
+def as_dict(obs: Obs) -> Dict[str, Any]:
+    """The numeric fields of an observation as a dict (a copy for array observations)."""
+    if isinstance(obs, Mapping):
+        return dict(obs)
+    return {f: obs_get(obs, f) for f in FIELDS}
+
+def action_mask(obs: Obs) -> Optional[int]:
+    """Bitmask of the actions worth taking (bit a: action a); None if the observation has none."""
+    if isinstance(obs, Mapping):
+        return obs.get("action_mask")
+    return int(obs[ACTION_MASK])
+
+def allowed_actions(mask: Optional[int], action_size: int) -> List[int]:
+    """The actions `mask` allows, in order; all of them for None. Actions from MASK_BITS on are always allowed."""
+    if mask is None:
+        return list(range(action_size))
+    return [a for a in range(action_size) if a >= MASK_BITS or mask >> a & 1]
+
+def applied_patches(obs: Obs) -> Sequence[int]:
+    """Patch indices set in an array observation's APPLIED_MASK."""
+    mask = int(obs[APPLIED_MASK])
+    return [i for i in range(MASK_BITS) if mask >> i & 1]
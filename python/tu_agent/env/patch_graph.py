@@ -0,0 +1,117 @@
+"""Which candidate patches apply, from which workspace states, worked out ahead of time.
+
+A failed apply writes nothing, so the workspace is determined by the patches
+that applied so far. `PatchGraph.build` applies every patch in memory
+(`apply_to_files`, the native applier's logic). It starts from the pristine
+files and goes breadth-first over the states that reach. A state is
+identified by the contents of the files the patches touch, so orders that
+end in the same files share a state. For each state the graph keeps the
+bitmask of patches that apply and where each one leads.
+
+The runner's native engine is the same applier and its result is final
+for any patch it parses, so `mask` is `valid`: a patch that can't apply in
+a state is masked the first time the state is reached, in every episode
+and every env (graphs are built once per task per process, see
+`ToolUseCodingEnv`).
+
+The env follows the graph as patches are applied (`step`). Its state
+becomes unknown (None) when a real apply disagrees with the prediction,
+as it can with `native_diff=False`, after an apply of a patch the graph
+couldn't parse, or past `max_states` states. `mask` allows every patch in
+an unknown state.
+"""
+from __future__ import annotations
+import os
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Tuple
+from tu_agent.utils.diff import PatchError, PatchSet, apply_to_files
+
+Files = Dict[str, Optional[str]]
+
+def read_patch_files(root: str, patches: Sequence[Optional[PatchSet]]) -> Files:
+    """Current text of every path the patches name (None if absent), read the way `apply_patch` reads."""
+    out: Files = {}
+    for ps in patches:
+        for rel in ps.paths if ps is not None else ():
+            if rel in out:
+                continue
+            try:
+                with open(os.path.join(root, rel), "r", encoding="utf-8", errors="surrogateescape", newline="") as f:
+                    out[rel] = f.read()
+            except (FileNotFoundError, IsADirectoryError):
+                out[rel] = None
+    return out
+
+class PatchGraph:
+    """Per-state applicable-patch bitmasks and transitions for one task's patches (state 0 is pristine)."""
+
+    def __init__(self, num_patches: int):
+        self.num_patches = num_patches
+        self.all_patches = (1 << num_patches) - 1
+        # state -> bitmask of patches the in-process applier applies
+        self.valid: List[int] = []
+        # state -> {patch: state after applying it}; missing past max_states
+        self.next: List[Dict[int, int]] = []
+
+    @property
+    def num_states(self) -> int:
+        return len(self.valid)
+
+    @classmethod
+    def build(cls, patches: Sequence[Optional[PatchSet]], files: Files, max_states: int=4096) -> "PatchGraph":
+        g = cls(len(patches))
+        paths = sorted(files)
+        ids: Dict[Tuple[Optional[str], ...], int] = {}
+        states: List[Files] = []
+
+        def state_of(fs: Files) -> Tuple[Optional[int], bool]:
+            """(state id, whether it's new); None for a new state past max_states."""
+            key = tuple(fs.get(p) for p in paths)
+            sid = ids.get(key)
+            if sid is not None:
+                return sid, False
+            if len(states) >= max_states:
+                return None, False
+            sid = ids[key] = len(states)
+            states.append(fs)
+            g.valid.append(0)
+            g.next.append({})
+            return sid, True
+
+        queue = deque([state_of(dict(files))[0]])
+        while queue:
+            sid = queue.popleft()
+            fs = states[sid]
+            valid = 0
+            for i, ps in enumerate(patches):
+                if ps is None:
+                    continue
+                try:
+                    res, out = apply_to_files(ps, fs)
+                except PatchError:
+                    continue
+                if not res.ok:
+                    continue
+                valid |= 1 << i
+                nxt, new = state_of({**fs, **out})
+                if nxt is not None:
+                    g.next[sid][i] = nxt
+                if new:
+                    queue.append(nxt)
+            g.valid[sid] = valid
+        return g
+
+    def mask(self, state: Optional[int]) -> int:
+        """Bitmask of the patches that apply in `state` (all of them if unknown)."""
+        if state is None:
+            return self.all_patches
+        return self.valid[state]
+
+    def step(self, state: Optional[int], patch: int, applied: bool) -> Optional[int]:
+        """The state after trying `patch` in `state`; None once the real outcome leaves the graph."""
+        if state is None or patch >= self.num_patches:
+            return None
+        if not applied:
+            # a failed apply writes nothing; unknown if the graph expected it to apply
+            return None if self.valid[state] >> patch & 1 else state
+        return self.next[state].get(patch)
@@ -0,0 +1,421 @@
+"""Serve env steps from a recorded transition table instead of the sandbox.
+
+For a fixed task, what an action does depends only on which patches have
+been applied so far, and in what order. A failed apply writes nothing. So
+the env is a small deterministic graph whose states are applied-patch
+sequences. `TransitionModel` records, for each state it has seen:
+- per patch: whether it applied, its message, and its step time;
+- the pytest result: pass rate, pass vector, message and step time;
+- the read_file message and step time.
+The model persists as one JSON file.
+
+`ReplayEnv` answers `reset`/`step` from the model with the observation,
+reward and `StepInfo` semantics of `ToolUseCodingEnv`. The time penalty uses
+each transition's mean recorded step time, and `StepInfo.elapsed_s` is the
+sum of those (a simulated clock). With a `fallback` env, a transition the
+model hasn't seen is run for real, recorded and then served. Without one, it
+raises KeyError. `TransitionModel.explore` fills the table ahead of time,
+breadth-first up to a depth. `ReplayEnv.verify` replays an action sequence on
+the real env and reports where the two disagree.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from tu_agent.env.task_loader import TaskSpec
+from tu_agent.env.tool_env import ToolUseCodingEnv, StepInfo
+from tu_agent.env.obs_array import MASK_BITS, TOOL_CODES, ObsBuffer, obs_get
+from tu_agent.env.patch_graph import PatchGraph
+
+FORMAT_VERSION = 1
+
+Seq = Tuple[int, ...]
+
+def task_digest(task: TaskSpec) -> str:
+    """Identity of a task's action set; a model recorded for other patches doesn't apply."""
+    return hashlib.sha256(json.dumps([p.get("diff") for p in task.patches]).encode("utf-8")).hexdigest()
+
+def _mean(old: float, n: int, x: float) -> float:
+    return old + (x - old) / (n + 1)
+
+class TransitionModel:
+    """Recorded outcomes of every action in every applied-patch state of one task."""
+
+    def __init__(self, task: str, num_patches: int, digest: str=""):
+        self.task = task
+        self.num_patches = num_patches
+        self.digest = digest
+        self._ids: Dict[Seq, int] = {(): 0}
+        self.seqs: List[Seq] = [()]
+        # per state id: patch -> [next id, applied, message, mean step_s, n]
+        self.apply: List[Dict[int, list]] = [{}]
+        # [pass rate, pass vector, message, mean step_s, n]
+        self.test: List[Optional[list]] = [None]
+        # [message, mean step_s, n]
+        self.read: List[Optional[list]] = [None]
+
+    @classmethod
+    def for_task(cls, task: TaskSpec) -> "TransitionModel":
+        return cls(task.name, len(task.patches), task_digest(task))
+
+    def state(self, seq: Seq) -> int:
+        sid = self._ids.get(seq)
+        if sid is None:
+            sid = self._ids[seq] = len(self.seqs)
+            self.seqs.append(seq)
+            self.apply.append({})
+            self.test.append(None)
+            self.read.append(None)
+        return sid
+
+    @property
+    def num_states(self) -> int:
+        return len(self.seqs)
+
+    def num_transitions(self) -> int:
+        return (sum(len(a) for a in self.apply) + sum(t is not None for t in self.test)
+                + sum(r is not None for r in self.read))
+
+    def record(self, sid: int, action: int, info: StepInfo) -> int:
+        """Record a real step taken in state `sid`; returns the state it led to."""
+        seq = self.seqs[sid]
+        if action < self.num_patches:
+            applied = bool(info.applied)
+            nxt = self.state(seq + (action,)) if applied else sid
+            prev = self.apply[sid].get(action)
+            if prev is None:
+                self.apply[sid][action] = [nxt, applied, info.message, info.step_s, 1]
+            else:
+                if prev[1] != applied:
+                    raise RuntimeError(f"{self.task}: patch {action} after {list(seq)} applied={applied}, recorded {prev[1]}")
+                prev[3] = _mean(prev[3], prev[4], info.step_s)
+                prev[4] += 1
+            return nxt
+        if action == self.num_patches:
+            prev = self.test[sid]
+            if prev is None:
+                self.test[sid] = [info.pass_rate, info.tests, info.message, info.step_s, 1]
+            else:
+                prev[3] = _mean(prev[3], prev[4], info.step_s)
+                prev[4] += 1
+        elif action == self.num_patches + 1:
+            prev = self.read[sid]
+            if prev is None:
+                self.read[sid] = [info.message, info.step_s, 1]
+            else:
+                prev[1] = _mean(prev[1], prev[2], info.step_s)
+                prev[2] += 1
+        return sid
+
+    def known(self, sid: int, action: int) -> bool:
+        if action < self.num_patches:
+            return action in self.apply[sid]
+        if action == self.num_patches:
+            return self.test[sid] is not None
+        if action == self.num_patches + 1:
+            return self.read[sid] is not None
+        return True
+
+    def explore(self, env: ToolUseCodingEnv, max_depth: int=2, max_states: int=10_000) -> int:
+        """Record every action in every state reachable by up to `max_depth` successful applies.
+
+        `env` is a real env on the same task. Returns the number of real steps taken.
+        """
+        cursor = _RealCursor(self, env)
+        frontier = [0]
+        seen = {0}
+        for sid in frontier:
+            for action in range(self.num_patches + 2):
+                if not self.known(sid, action):
+                    cursor.step(sid, action)
+            if len(self.seqs[sid]) >= max_depth:
+                continue
+            for nxt, applied, *_ in self.apply[sid].values():
+                if applied and nxt not in seen and len(frontier) < max_states:
+                    seen.add(nxt)
+                    frontier.append(nxt)
+        return cursor.real_steps
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "version": FORMAT_VERSION,
+            "task": self.task,
+            "num_patches": self.num_patches,
+            "digest": self.digest,
+            "states": [
+                {
+                    "seq": list(seq),
+                    "apply": {str(p): [ok, msg, dur, n] for p, (_nxt, ok, msg, dur, n) in self.apply[sid].items()},
+                    "test": self.test[sid],
+                    "read": self.read[sid],
+                }
+                for sid, seq in enumerate(self.seqs)
+            ],
+        }
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Any]) -> "TransitionModel":
+        if d.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported transition model version {d.get('version')}")
+        m = cls(d["task"], d["num_patches"], d.get("digest", ""))
+        for st in d["states"]:
+            m.state(tuple(st["seq"]))
+        for st in d["states"]:
+            seq = tuple(st["seq"])
+            sid = m.state(seq)
+            for p, (ok, msg, dur, n) in st["apply"].items():
+                p = int(p)
+                m.apply[sid][p] = [m.state(seq + (p,)) if ok else sid, ok, msg, dur, n]
+            m.test[sid] = st["test"]
+            m.read[sid] = st["read"]
+        return m
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TransitionModel":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_json(json.load(f))
+
+    def stats(self) -> Dict[str, int]:
+        return {"states": self.num_states, "transitions": self.num_transitions()}
+
+class _RealCursor:
+    """Drives a real env to a model state (reset + replaying its patches) and records steps taken there."""
+
+    def __init__(self, model: TransitionModel, env: ToolUseCodingEnv):
+        self.model = model
+        self.env = env
+        self.sid: Optional[int] = None
+        self.real_steps = 0
+
+    def _goto(self, sid: int):
+        if self.sid == sid:
+            return
+        self.env.reset()
+        for p in self.model.seqs[sid]:
+            _obs, _r, _done, info = self.env.step(p)
+            self.real_steps += 1
+            if not info.applied:
+                raise RuntimeError(f"{self.model.task}: replaying {list(self.model.seqs[sid])}, patch {p} no longer applies")
+        self.sid = sid
+
+    def step(self, sid: int, action: int) -> StepInfo:
+        self._goto(sid)
+        _obs, _r, _done, info = self.env.step(action)
+        self.real_steps += 1
+        self.sid = self.model.record(sid, action, info)
+        return info
+
+    def invalidate(self):
+        self.sid = None
+
+class ReplayEnv:
+    """`ToolUseCodingEnv` semantics served from a `TransitionModel`.
+
+    `fallback` (a real env on the same task) answers, and records,
+    transitions the model doesn't have yet; without it they raise KeyError.
+    `obs_mode`/`msg_features` are as for the real env. Without a
+    `patch_graph`, every action's `action_mask` bit is set.
+    """
+
+    def __init__(
+        self,
+        model: TransitionModel,
+        fallback: Optional[ToolUseCodingEnv]=None,
+        max_steps: int=10,
+        tool_call_penalty: float=0.02,
+        time_penalty_per_s: float=0.01,
+        obs_mode: str="dict",
+        msg_features: int=0,
+        patch_graph: Optional[PatchGraph]=None,
+    ):
+        self.model = model
+        self.fallback = fallback
+        self.task_name = model.task
+        self.max_steps = max_steps
+        self.tool_call_penalty = tool_call_penalty
+        self.time_penalty_per_s = time_penalty_per_s
+        self._cursor = _RealCursor(model, fallback) if fallback is not None else None
+        self.obs_mode = obs_mode
+        self.obs_buffer = ObsBuffer(msg_features) if obs_mode == "array" else None
+        self.patch_graph = patch_graph
+        self.hits = 0
+        self.misses = 0
+        self._reset_state()
+
+    @classmethod
+    def wrap(cls, env: ToolUseCodingEnv, model: Optional[TransitionModel]=None) -> "ReplayEnv":
+        """A replay env with `env`'s settings, falling back to `env` itself."""
+        if env.task is None:
+            env.reset()
+        assert env.task is not None
+        if model is None:
+            model = TransitionModel.for_task(env.task)
+        elif model.digest and model.digest != task_digest(env.task):
+            raise ValueError(f"transition model was recorded for different patches than task {env.task_name!r}")
+        return cls(model, fallback=env, max_steps=env.max_steps, tool_call_penalty=env.tool_call_penalty,
+                   time_penalty_per_s=env.time_penalty_per_s, obs_mode=env.obs_mode,
+                   msg_features=env.obs_buffer.msg_features if env.obs_buffer is not None else 0, patch_graph=env.patch_graph)
+
+    @property
+    def num_patches(self) -> int:
+        return self.model.num_patches
+
+    @property
+    def action_size(self) -> int:
+        return self.model.num_patches + 3
+
+    def _reset_state(self):
+        self.sid = 0
+        self.steps = 0
+        self.tool_calls = 0
+        self.best_pass_rate = 0.0
+        self.last_pass_rate = 0.0
+        self.last_message = ""
+        self.last_tests: Optional[Dict[str, bool]] = None
+        self.last_tool = 0
+        self.applied_mask = 0
+        self._graph_state: Optional[int] = 0
+        self.clock_s = 0.0
+
+    def reset(self, seed: Optional[int]=None) -> Dict[str, Any]:
+        self._reset_state()
+        return self._obs()
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.invalidate()
+
+    @property
+    def action_mask(self) -> int:
+        n = self.num_patches
+        patches = self.patch_graph.mask(self._graph_state) if self.patch_graph is not None else (1 << n) - 1
+        return patches | 0b111 << n
+
+    def _obs(self) -> Any:
+        if self.obs_buffer is not None:
+            return self.obs_buffer.write(self.steps, self.max_steps, self.tool_calls, self.best_pass_rate, self.last_pass_rate,
+                                         self.last_tool, self.applied_mask, self.action_size, self.action_mask, self.last_message)
+        return {
+            "task": self.task_name,
+            "step": self.steps,
+            "max_steps": self.max_steps,
+            "tool_calls": self.tool_calls,
+            "best_pass_rate": self.best_pass_rate,
+            "last_pass_rate": self.last_pass_rate,
+            "action_size": self.action_size,
+            "action_mask": self.action_mask,
+            "last_message": self.last_message[:400],
+        }
+
+    def _lookup(self, action: int):
+        m = self.model
+        sid = self.sid
+        if m.known(sid, action):
+            self.hits += 1
+        elif self._cursor is None:
+            raise KeyError(f"{m.task}: no recorded outcome for action {action} after patches {list(m.seqs[sid])}")
+        else:
+            self.misses += 1
+            self._cursor.step(sid, action)
+        if action < m.num_patches:
+            return m.apply[sid][action]
+        return m.test[sid] if action == m.num_patches else m.read[sid]
+
+    def step(self, action: int) -> Tuple[Dict[str, Any], float, bool, StepInfo]:
+        P = self.model.num_patches
+        if action < 0 or action >= P + 3:
+            raise ValueError(f"Invalid action {action} for action_size {self.action_size}")
+        self.steps += 1
+        done = False
+        reward = 0.0
+        applied = None
+        step_s = 0.0
+
+        if action < P:
+            self.tool_calls += 1
+            nxt, applied, msg, step_s, _n = self._lookup(action)
+            self.sid = nxt
+            if applied and action < MASK_BITS:
+                self.applied_mask |= 1 << action
+            if self.patch_graph is not None:
+                self._graph_state = self.patch_graph.step(self._graph_state, action, applied)
+            reward -= self.tool_call_penalty
+            tool = "apply_patch"
+        elif action == P:
+            self.tool_calls += 1
+            pass_rate, self.last_tests, msg, step_s, _n = self._lookup(action)
+            self.last_pass_rate = pass_rate
+            if pass_rate > self.best_pass_rate:
+                self.best_pass_rate = pass_rate
+            reward += pass_rate - self.tool_call_penalty
+            if pass_rate >= 1.0:
+                done = True
+            tool = "pytest"
+        elif action == P + 1:
+            self.tool_calls += 1
+            msg, step_s, _n = self._lookup(action)
+            reward -= self.tool_call_penalty
+            tool = "read_file"
+        else:
+            done = True
+            msg = "terminated by agent"
+            tool = "done"
+
+        reward -= self.time_penalty_per_s * step_s
+        self.clock_s += step_s
+        if self.steps >= self.max_steps:
+            done = True
+        self.last_message = msg
+        self.last_tool = TOOL_CODES[tool]
+        info = StepInfo(tool=tool, tool_calls=self.tool_calls, elapsed_s=self.clock_s, pass_rate=self.last_pass_rate,
+                        done=done, message=msg[:400], tests=self.last_tests, applied=applied, step_s=step_s,
+                        action_mask=self.action_mask)
+        return self._obs(), reward, done, info
+
+    def verify(self, actions: Sequence[int]) -> List[str]:
+        """Replay `actions` from reset on both this env and the fallback; describe each disagreement.
+
+        Timing-dependent values (rewards, messages, elapsed times) aren't compared.
+        """
+        if self.fallback is None:
+            raise ValueError("verify needs a fallback env")
+        assert self._cursor is not None
+
+        def run(env) -> List[Tuple[float, bool, StepInfo]]:
+            env.reset()
+            steps = []
+            for a in actions:
+                obs, _r, done, info = env.step(a)
+                # array observations are overwritten by later steps
+                steps.append((obs_get(obs, "best_pass_rate"), done, info))
+                if done:
+                    break
+            return steps
+
+        # replay first: a miss there drives the fallback itself
+        replayed = run(self)
+        self._cursor.invalidate()
+        real = run(self.fallback)
+        self._cursor.invalidate()
+        self.reset()
+        out: List[str] = []
+        if len(replayed) != len(real):
+            out.append(f"episode length replay={len(replayed)} real={len(real)}")
+        for i, ((o1, d1, i1), (o2, d2, i2)) in enumerate(zip(replayed, real)):
+            for name, x, y in (("done", d1, d2), ("applied", i1.applied, i2.applied), ("pass_rate", i1.pass_rate, i2.pass_rate),
+                               ("tests", i1.tests, i2.tests), ("best_pass_rate", o1, o2), ("action_mask", i1.action_mask, i2.action_mask)):
+                if x != y:
+                    out.append(f"step {i} action {actions[i]}: {name} replay={x!r} real={y!r}")
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.model.stats(), hits=self.hits, misses=self.misses,
+                    real_steps=self._cursor.real_steps if self._cursor is not None else 0)
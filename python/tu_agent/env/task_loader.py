@@ -1,14 +1,44 @@
 from __future__ import annotations
 import json
 import os
-from dataclasses import dataclass
-from typing import List, Dict, Any
+import shutil
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional
+from tu_agent.utils.diff import PatchSet, PatchError, parse_unified_diff
 
 @dataclass
 class TaskSpec:
     name: str
     task_dir: str
     patches: List[Dict[str, Any]]
+    # patches[i]["diff"] pre-parsed at load time; None if it does not parse
+    # (the runner then reports the error when the patch is tried)
+    parsed_patches: List[Optional[PatchSet]] = field(default_factory=list)
+    # Packed store the files live in (e.g. a TaskRegistry); None means `task_dir`.
+    source: Optional[Any] = None
+
+    @property
+    def key(self) -> str:
+        """Stable identity of the task's pristine files."""
+        if self.source is not None:
+            return f"{self.source.path}::{self.name}"
+        return os.path.abspath(self.task_dir)
+
+    def materialize(self, dest: str) -> None:
+        """Write the task's files into `dest`."""
+        if self.source is not None:
+            self.source.materialize(self.name, dest)
+        else:
+            shutil.copytree(self.task_dir, dest, dirs_exist_ok=True)
+
+def parse_patches(patches: List[Dict[str, Any]]) -> List[Optional[PatchSet]]:
+    out: List[Optional[PatchSet]] = []
+    for p in patches:
+        try:
+            out.append(parse_unified_diff(p["diff"]))
+        except (PatchError, KeyError, TypeError):
+            out.append(None)
+    return out
 
 def load_task(tasks_root: str, name: str) -> TaskSpec:
     task_dir = os.path.join(tasks_root, name)
@@ -19,4 +49,4 @@ def load_task(tasks_root: str, name: str) -> TaskSpec:
         patches = json.load(f)
     if not isinstance(patches, list):
         raise ValueError("patches.json must be a list")
-    return TaskSpec(name=name, task_dir=task_dir, patches=patches)
+    return TaskSpec(name=name, task_dir=task_dir, patches=patches, parsed_patches=parse_patches(patches))
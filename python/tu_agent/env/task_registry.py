@@ -0,0 +1,183 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from tu_agent.env.task_loader import TaskSpec, load_task, parse_patches
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    name TEXT PRIMARY KEY,
+    n_patches INTEGER NOT NULL,
+    n_files INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    patches TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    task TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    PRIMARY KEY (task, path)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+# Not task content: skipped when packing a directory.
+SKIP_DIRS = {"__pycache__", ".pytest_cache", ".git"}
+
+@dataclass
+class TaskManifest:
+    name: str
+    n_patches: int
+    n_files: int
+    total_size: int
+    digest: str  # sha256 over (path, file sha256) pairs
+    files: List[Tuple[str, str, int]]  # (path, sha256, size)
+
+class TaskRegistry:
+    """Task corpus packed into a single SQLite file.
+
+    Holds a manifest row per task (patch count, file count, total size,
+    content digest), file entries pointing at content-addressed blobs
+    (identical files across tasks are stored once) and each task's
+    patches.json. `get` builds `TaskSpec`s lazily behind an LRU, so patches
+    are parsed once per task rather than on every reset; `materialize`
+    writes a task's files into a workspace on demand.
+
+    Build one from the directory layout with `TaskRegistry.pack` or
+    `python -m tu_agent.scripts.pack_tasks`.
+    """
+
+    def __init__(self, path: str, cache_size: int=256):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Task registry not found: {path}")
+        self.path = os.path.abspath(path)
+        self.cache_size = cache_size
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, TaskSpec]" = OrderedDict()
+
+    def _query(self, sql: str, args: Tuple=()) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def names(self) -> List[str]:
+        return [r[0] for r in self._query("SELECT name FROM tasks ORDER BY name")]
+
+    def __len__(self) -> int:
+        return int(self._query("SELECT COUNT(*) FROM tasks")[0][0])
+
+    def __contains__(self, name: str) -> bool:
+        return bool(self._query("SELECT 1 FROM tasks WHERE name = ?", (name,)))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names())
+
+    def manifest(self, name: str) -> TaskManifest:
+        rows = self._query("SELECT n_patches, n_files, total_size, digest FROM tasks WHERE name = ?", (name,))
+        if not rows:
+            raise FileNotFoundError(f"Task not found in registry: {name}")
+        n_patches, n_files, total_size, digest = rows[0]
+        files = self._query("SELECT path, sha256, size FROM files WHERE task = ? ORDER BY path", (name,))
+        return TaskManifest(name, n_patches, n_files, total_size, digest, [tuple(f) for f in files])
+
+    def get(self, name: str) -> TaskSpec:
+        with self._lock:
+            spec = self._cache.get(name)
+            if spec is not None:
+                self._cache.move_to_end(name)
+                return spec
+        rows = self._query("SELECT patches FROM tasks WHERE name = ?", (name,))
+        if not rows:
+            raise FileNotFoundError(f"Task not found in registry: {name}")
+        patches = json.loads(rows[0][0])
+        spec = TaskSpec(name=name, task_dir="", patches=patches, parsed_patches=parse_patches(patches), source=self)
+        with self._lock:
+            self._cache[name] = spec
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return spec
+
+    def materialize(self, name: str, dest: str) -> int:
+        """Write task `name`'s files under `dest`; returns the number of files written."""
+        rows = self._query(
+            "SELECT f.path, f.mode, b.data FROM files f JOIN blobs b ON b.sha256 = f.sha256 WHERE f.task = ?",
+            (name,),
+        )
+        if not rows and name not in self:
+            raise FileNotFoundError(f"Task not found in registry: {name}")
+        dest_real = os.path.realpath(dest)
+        for rel, mode, data in rows:
+            p = os.path.realpath(os.path.join(dest_real, rel))
+            if not p.startswith(dest_real + os.sep):
+                raise ValueError(f"registry path escapes workspace: {rel}")
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+            with open(p, "wb") as f:
+                f.write(data)
+            os.chmod(p, mode & 0o777)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._cache.clear()
+
+    @classmethod
+    def pack(cls, tasks_root: str, db_path: str, names: Optional[List[str]]=None) -> int:
+        """Convert the `tasks_root/<name>/` layout into a registry at `db_path`; returns tasks packed.
+
+        Re-packing an existing registry replaces the tasks it contains.
+        """
+        if names is None:
+            names = sorted(
+                n for n in os.listdir(tasks_root)
+                if os.path.isfile(os.path.join(tasks_root, n, "patches.json"))
+            )
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.executescript(SCHEMA)
+            with conn:
+                for name in names:
+                    spec = load_task(tasks_root, name)
+                    files = _scan_task(spec.task_dir)
+                    digest = hashlib.sha256()
+                    conn.execute("DELETE FROM files WHERE task = ?", (name,))
+                    for rel, sha, data, mode in files:
+                        digest.update(f"{rel}\0{sha}\n".encode("utf-8"))
+                        conn.execute("INSERT OR IGNORE INTO blobs (sha256, data) VALUES (?, ?)", (sha, data))
+                        conn.execute(
+                            "INSERT INTO files (task, path, sha256, size, mode) VALUES (?, ?, ?, ?, ?)",
+                            (name, rel, sha, len(data), mode),
+                        )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO tasks (name, n_patches, n_files, total_size, digest, patches) VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, len(spec.patches), len(files), sum(len(f[2]) for f in files), digest.hexdigest(), json.dumps(spec.patches)),
+                    )
+        finally:
+            conn.close()
+        return len(names)
+
+def _scan_task(task_dir: str) -> List[Tuple[str, str, bytes, int]]:
+    out = []
+    for dirpath, dirnames, filenames in os.walk(task_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for fn in sorted(filenames):
+            if fn.endswith((".pyc", ".pyo")):
+                continue
+            p = os.path.join(dirpath, fn)
+            with open(p, "rb") as f:
+                data = f.read()
+            rel = os.path.relpath(p, task_dir).replace(os.sep, "/")
+            out.append((rel, hashlib.sha256(data).hexdigest(), data, os.stat(p).st_mode & 0o777))
+    return out
@@ -0,0 +1,163 @@
+"""Import-graph based test selection for incremental test runs.
+
+`ImportGraph` parses every Python file in a workspace with `ast` (re-parsing
+only files whose (size, mtime_ns) changed) and resolves imports to workspace
+files, against the root and, like pytest's rootdir-less `sys.path` insertion,
+the importing file's directory. A test file depends on everything it reaches
+transitively, plus the `conftest.py` files above it.
+
+This is static: dynamic imports (importlib, `__import__`) and data files are
+invisible, so callers should fall back to a full run when a touched file is
+not a Python module.
+"""
+from __future__ import annotations
+import ast
+import fnmatch
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from tu_agent.runner.test_cache import IGNORED_DIRS
+
+# pytest's default `python_files`
+TEST_FILE_PATTERNS = ("test_*.py", "*_test.py")
+
+def is_test_file(rel: str) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name, pat) for pat in TEST_FILE_PATTERNS)
+
+def _module_name(rel: str) -> str:
+    mod = rel[:-3].replace("/", ".")
+    return mod[:-len(".__init__")] if mod.endswith(".__init__") else ("" if mod == "__init__" else mod)
+
+def _imports(source: bytes, rel: str) -> List[str]:
+    """Dotted names `rel` may import (each prefix of a dotted import counts, as its packages run too)."""
+    try:
+        tree = ast.parse(source, filename=rel)
+    except (SyntaxError, ValueError):
+        return []
+    pkg = [p for p in _module_name(rel).split(".") if p]
+    if not rel.endswith("__init__.py"):
+        pkg = pkg[:-1]
+    names: List[str] = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(a.name for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = pkg[:len(pkg) - (node.level - 1)] if node.level - 1 <= len(pkg) else []
+                mod = ".".join(base + ([node.module] if node.module else []))
+            else:
+                mod = node.module or ""
+            if mod:
+                names.append(mod)
+            # `from pkg import name` may import the submodule pkg.name
+            names.extend(f"{mod}.{a.name}" if mod else a.name for a in node.names if a.name != "*")
+    out: List[str] = []
+    for n in names:
+        parts = n.split(".")
+        out.extend(".".join(parts[:i]) for i in range(1, len(parts) + 1))
+    return out
+
+class ImportGraph:
+    """Module-level import graph of the Python files under `root`."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._stat: Dict[str, Tuple[int, int]] = {}
+        self._raw: Dict[str, List[str]] = {}  # rel -> imported dotted names
+        self._edges: Dict[str, Set[str]] = {}
+        self._closure: Dict[str, Set[str]] = {}
+
+    @property
+    def files(self) -> List[str]:
+        return sorted(self._raw)
+
+    def test_files(self) -> List[str]:
+        return [f for f in self.files if is_test_file(f)]
+
+    def refresh(self) -> bool:
+        """Rescan the workspace; returns True if anything changed."""
+        seen: Dict[str, Tuple[int, int]] = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS)
+            for fn in filenames:
+                if not fn.endswith(".py"):
+                    continue
+                p = os.path.join(dirpath, fn)
+                st = os.stat(p)
+                seen[os.path.relpath(p, self.root).replace(os.sep, "/")] = (st.st_size, st.st_mtime_ns)
+        changed = seen.keys() != self._stat.keys()
+        for rel, sig in seen.items():
+            if self._stat.get(rel) == sig:
+                continue
+            changed = True
+            with open(os.path.join(self.root, rel), "rb") as f:
+                self._raw[rel] = _imports(f.read(), rel)
+        for rel in self._stat.keys() - seen.keys():
+            del self._raw[rel]
+        self._stat = seen
+        if changed:
+            self._link()
+        return changed
+
+    def _resolve(self, name: str, importer: str, by_module: Dict[str, str]) -> Optional[str]:
+        hit = by_module.get(name)
+        if hit is not None:
+            return hit
+        d = importer.rsplit("/", 1)[0] if "/" in importer else ""
+        if d:
+            return by_module.get(f"{d.replace('/', '.')}.{name}")
+        return None
+
+    def _link(self):
+        by_module = {_module_name(rel): rel for rel in self._raw}
+        by_module.pop("", None)
+        self._edges = {}
+        for rel, names in self._raw.items():
+            deps: Set[str] = set()
+            # importing a module runs the __init__.py of each enclosing package
+            parts = rel.split("/")[:-1]
+            while parts and "/".join(parts + ["__init__.py"]) in self._raw:
+                deps.add("/".join(parts + ["__init__.py"]))
+                parts.pop()
+            deps.discard(rel)
+            for n in names:
+                hit = self._resolve(n, rel, by_module)
+                if hit is not None and hit != rel:
+                    deps.add(hit)
+            self._edges[rel] = deps
+        self._closure = {}
+
+    def deps(self, rel: str) -> Set[str]:
+        """Workspace files `rel` depends on, itself and enclosing conftest.py files included."""
+        hit = self._closure.get(rel)
+        if hit is not None:
+            return hit
+        seeds = {rel}
+        parts = rel.split("/")[:-1]
+        for i in range(len(parts) + 1):
+            conf = "/".join(parts[:i] + ["conftest.py"])
+            if conf in self._raw:
+                seeds.add(conf)
+        out: Set[str] = set()
+        stack = list(seeds)
+        while stack:
+            f = stack.pop()
+            if f in out:
+                continue
+            out.add(f)
+            stack.extend(self._edges.get(f, ()))
+        self._closure[rel] = out
+        return out
+
+def select_test_files(graph: ImportGraph, touched: Iterable[str]) -> Optional[List[str]]:
+    """Test files whose dependencies intersect `touched`, or None if that can't be decided statically.
+
+    Call `graph.refresh()` first so the graph reflects the patched workspace.
+    """
+    touched = {t.replace(os.sep, "/") for t in touched}
+    known = set(graph.files)
+    # data files and deleted modules aren't edges in the graph
+    if any(not t.endswith(".py") or t not in known for t in touched):
+        return None
+    return [f for f in graph.test_files() if graph.deps(f) & touched]
@@ -1,14 +1,37 @@
 from __future__ import annotations
+import inspect
 import os
 import shutil
 import tempfile
 import time
 from dataclasses import dataclass
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, Generator, List, Optional, Set, Tuple, TypeVar
 
 from tu_agent.env.task_loader import TaskSpec, load_task
+from tu_agent.env.workspace_pool import WorkspacePool
+from tu_agent.env.file_cache import WorkspaceFiles, load_files
+from tu_agent.env.patch_graph import PatchGraph, read_patch_files
+from tu_agent.env.task_registry import TaskRegistry
+from tu_agent.env.test_selection import ImportGraph, select_test_files
+from tu_agent.env.obs_array import MASK_BITS, TOOL_CODES, ObsBuffer
 from tu_agent.runner.auto_runner import AutoRunner
-from tu_agent.utils.text import parse_pytest_pass_rate
+from tu_agent.runner.test_cache import TestResultCache
+from tu_agent.runner.test_report import TestReport
+from tu_agent.runner.types import RunResult
+from tu_agent.utils import trace
+from tu_agent.utils.text import pytest_pass_rate
+
+# What `runner.pytest` runs; part of the test-cache key.
+PYTEST_CMD = ["python", "-m", "pytest", "-q"]
+# Cache-key suffix for runs that carry per-test results.
+STRUCTURED_KEY = ["--junitxml"]
+# task key -> its PatchGraph, shared by every env in the process
+_PATCH_GRAPHS: Dict[str, PatchGraph] = {}
+
+# env logic yields (runner method, kwargs) and is sent back the RunResult
+RunnerCall = Tuple[str, Dict[str, Any]]
+T = TypeVar("T")
+EnvGen = Generator[RunnerCall, Any, T]
 
 @dataclass
 class StepInfo:
@@ -18,6 +41,16 @@ class StepInfo:
     pass_rate: float
     done: bool
     message: str
+    # nodeid -> passed, from the latest structured test run (None if unavailable)
+    tests: Optional[Dict[str, bool]] = None
+    # apply_patch steps: whether the patch applied
+    applied: Optional[bool] = None
+    # time charged to this step by the time penalty (wall or CPU seconds, see time_penalty_clock)
+    step_s: float = 0.0
+    # CPU seconds (user + sys) of the processes this step ran
+    cpu_s: float = 0.0
+    # bitmask of the actions worth taking next (bit a: action a), as in the observation
+    action_mask: Optional[int] = None
 
 class ToolUseCodingEnv:
     """A small RL-style environment for 'tool-use' code editing.
@@ -28,7 +61,28 @@ class ToolUseCodingEnv:
       - num_patches+1: read solution file
       - num_patches+2: done (terminate)
 
-    Observation is a small dict for ease of baseline agents.
+    Observation is a small dict for ease of baseline agents. With
+    `obs_mode="array"` it is instead a float64 `memoryview` written in place
+    (see `obs_array.py`): no per-step allocation, and it adds the last tool
+    and a bitmask of applied patches. `msg_features` hashes the last message
+    into that many extra slots.
+
+    Both kinds carry `action_mask`, a bitmask of the actions worth taking.
+    With `action_masks`, a patch's bit is clear when it won't apply in the
+    current workspace state, e.g. a distractor, a conflict or a patch
+    already applied. The task's `PatchGraph` works this out on its first
+    reset in the process and is shared by every env after that.
+    The env doesn't enforce the mask; agents use it to skip actions.
+
+    `reset`/`step`/`close` drive a synchronous runner (`AutoRunner`);
+    `areset`/`astep`/`aclose` are their coroutine versions for an
+    `AsyncAutoRunner`, so one event loop can run many episodes. Both share
+    the same logic, written as generators that yield the runner calls.
+
+    The time penalty charges each step's wall time by default. With
+    `time_penalty_clock="cpu"` it charges the CPU time the kernel accounted
+    to the step's sandboxed processes instead, which doesn't grow when many
+    workers share a node, so rewards stay comparable across hosts and loads.
     """
 
     def __init__(
@@ -40,6 +94,18 @@ class ToolUseCodingEnv:
         tool_call_penalty: float = 0.02,
         time_penalty_per_s: float = 0.01,
         test_timeout_ms: int = 20_000,
+        test_cache: Optional[TestResultCache] = None,
+        workspace_pool: Optional[WorkspacePool] = None,
+        reuse_workspace: bool = True,
+        task_registry: Optional[TaskRegistry] = None,
+        structured_tests: bool = True,
+        incremental_tests: bool = False,
+        time_penalty_clock: str = "wall",
+        test_shards: int = 1,
+        obs_mode: str = "dict",
+        msg_features: int = 0,
+        file_cache: bool = True,
+        action_masks: bool = True,
     ):
         self.tasks_root = tasks_root
         self.runner = runner
@@ -47,10 +113,42 @@ class ToolUseCodingEnv:
         self.max_steps = max_steps
         self.tool_call_penalty = tool_call_penalty
         self.time_penalty_per_s = time_penalty_per_s
+        if time_penalty_clock not in ("wall", "cpu"):
+            raise ValueError(f"time_penalty_clock must be 'wall' or 'cpu', not {time_penalty_clock!r}")
+        self.time_penalty_clock = time_penalty_clock
         self.test_timeout_ms = test_timeout_ms
+        self.test_cache = test_cache
+        # Tasks come from this packed registry instead of tasks_root/<name>/.
+        self.task_registry = task_registry
+        # With reuse_workspace, reset() restores one workspace from a pristine
+        # snapshot instead of rmtree + copytree. A pool passed in may be shared.
+        self.reuse_workspace = reuse_workspace or workspace_pool is not None
+        self._own_pool = workspace_pool is None and reuse_workspace
+        self.workspace_pool = workspace_pool
+        # structured_tests: per-test outcomes from a JUnit report drive pass_rate
+        # (errors count as failures) and StepInfo.tests.
+        # incremental_tests: after a patch, rerun only test files whose imports
+        # reach a touched file and keep earlier outcomes for the rest.
+        self.structured_tests = structured_tests
+        self.incremental_tests = incremental_tests and structured_tests
+        # test_shards > 1: split each test action across that many pytest processes
+        self.test_shards = test_shards
+        if obs_mode not in ("dict", "array"):
+            raise ValueError(f"obs_mode must be 'dict' or 'array', not {obs_mode!r}")
+        self.obs_mode = obs_mode
+        # the vec env may swap in one whose slots are rows of its batches
+        self.obs_buffer = ObsBuffer(msg_features) if obs_mode == "array" else None
+        # file_cache: serve read_file from memory instead of the runner
+        self.file_cache = WorkspaceFiles() if file_cache else None
+        self._pristine_files: Dict[str, Dict[str, bytes]] = {}  # task key -> files after reset
+        # action_masks: mask patches the graph says won't apply
+        self.action_masks = action_masks
+        self.patch_graph: Optional[PatchGraph] = None
+        self._graph_state: Optional[int] = None
 
         self.task: Optional[TaskSpec] = None
         self.workspace: Optional[str] = None
+        self.last_reset_s = 0.0
 
         self.steps = 0
         self.tool_calls = 0
@@ -58,6 +156,21 @@ class ToolUseCodingEnv:
         self.last_pass_rate = 0.0
         self.start_t = 0.0
         self.last_message = ""
+        self.last_tests: Optional[Dict[str, bool]] = None
+        self.last_tool = 0  # obs_array.TOOL_CODES
+        self.applied_mask = 0
+
+        # incremental test state: outcomes for the current workspace minus `_touched`
+        self._tests: Optional[TestReport] = None
+        self._touched: Set[str] = set()
+        self._touched_unknown = False
+        self._patched = False
+        self._pristine_tests: Dict[str, TestReport] = {}  # task key -> report before any patch
+        self._graph: Optional[ImportGraph] = None
+        # time this step's runner calls spent queued in the sandbox scheduler
+        self._sched_wait_s = 0.0
+        # CPU time of this step's runner calls
+        self._cpu_s = 0.0
 
     @property
     def num_patches(self) -> int:
@@ -68,29 +181,148 @@ class ToolUseCodingEnv:
     def action_size(self) -> int:
         return self.num_patches + 3
 
+    def _note_wait(self, res: Any):
+        if isinstance(res, RunResult):
+            self._sched_wait_s += res.meta.get("sched_wait_s", 0.0)
+            self._note_cpu(res)
+
+    def _note_cpu(self, rr: RunResult):
+        # in-process calls (native patches, fallback reads) have no child to account: charge their wall time
+        self._cpu_s += rr.rusage.cpu_s if rr.rusage is not None else rr.duration_s
+
+    def _drive(self, gen: EnvGen[T]) -> T:
+        try:
+            name, kwargs = next(gen)
+            while True:
+                res = getattr(self.runner, name)(**kwargs)
+                if inspect.isawaitable(res):
+                    res.close()
+                    raise TypeError("runner is async; use areset/astep/aclose")
+                self._note_wait(res)
+                name, kwargs = gen.send(res)
+        except StopIteration as e:
+            return e.value
+
+    async def _adrive(self, gen: EnvGen[T]) -> T:
+        try:
+            name, kwargs = next(gen)
+            while True:
+                res = getattr(self.runner, name)(**kwargs)
+                if inspect.isawaitable(res):
+                    res = await res
+                self._note_wait(res)
+                name, kwargs = gen.send(res)
+        except StopIteration as e:
+            return e.value
+
     def reset(self, seed: Optional[int]=None) -> Dict[str, Any]:
-        self.task = load_task(self.tasks_root, self.task_name)
+        with trace.span("env.reset"):
+            return self._drive(self._reset_gen(seed))
+
+    async def areset(self, seed: Optional[int]=None) -> Dict[str, Any]:
+        with trace.span("env.reset"):
+            return await self._adrive(self._reset_gen(seed))
+
+    def step(self, action: int) -> Tuple[Dict[str, Any], float, bool, StepInfo]:
+        with trace.span(f"step.{self._tool_name(action)}"):
+            return self._drive(self._step_gen(action))
+
+    async def astep(self, action: int) -> Tuple[Dict[str, Any], float, bool, StepInfo]:
+        with trace.span(f"step.{self._tool_name(action)}"):
+            return await self._adrive(self._step_gen(action))
+
+    def _tool_name(self, action: int) -> str:
+        n = self.num_patches if self.task is not None else 0
+        if action < n:
+            return "apply_patch"
+        return "pytest" if action == n else ("read_file" if action == n + 1 else "done")
+
+    def close(self):
+        self._drive(self._close_gen())
+
+    async def aclose(self):
+        await self._adrive(self._close_gen())
+
+    def _reset_gen(self, seed: Optional[int]) -> EnvGen[Dict[str, Any]]:
+        if self.task is None or self.task.name != self.task_name:
+            if self.task_registry is not None:
+                self.task = self.task_registry.get(self.task_name)
+            else:
+                self.task = load_task(self.tasks_root, self.task_name)
         self.steps = 0
         self.tool_calls = 0
         self.best_pass_rate = 0.0
         self.last_pass_rate = 0.0
         self.last_message = ""
+        self.last_tests = None
+        self.last_tool = 0
+        self.applied_mask = 0
+        self._tests = self._pristine_tests.get(self.task.key) if self.incremental_tests else None
+        self._touched = set()
+        self._touched_unknown = False
+        self._patched = False
         self.start_t = time.time()
 
-        if self.workspace and os.path.isdir(self.workspace):
-            shutil.rmtree(self.workspace, ignore_errors=True)
+        t0 = time.perf_counter()
+        if self.reuse_workspace:
+            if self.workspace_pool is None:
+                self.workspace_pool = WorkspacePool()
+            with trace.span("workspace.reset"):
+                ws = self.workspace_pool.reset(self.task, self.workspace)
+            if self.workspace and ws != self.workspace:
+                yield ("close", {"root": self.workspace})
+            self.workspace = ws
+        else:
+            if self.workspace and os.path.isdir(self.workspace):
+                yield ("close", {"root": self.workspace})
+                shutil.rmtree(self.workspace, ignore_errors=True)
 
-        self.workspace = tempfile.mkdtemp(prefix=f"tu_agent_{self.task_name}_")
-        # Copy task files into workspace
-        shutil.copytree(self.task.task_dir, self.workspace, dirs_exist_ok=True)
+            self.workspace = tempfile.mkdtemp(prefix=f"tu_agent_{self.task_name}_")
+            # Copy task files into workspace
+            with trace.span("workspace.copy"):
+                self.task.materialize(self.workspace)
+        if self.file_cache is not None:
+            files = self._pristine_files.get(self.task.key)
+            if files is None:
+                with trace.span("file_cache.load"):
+                    files = self._pristine_files[self.task.key] = load_files(self.workspace)
+            self.file_cache.reset(self.workspace, files)
+        if self.action_masks:
+            self.patch_graph = _PATCH_GRAPHS.get(self.task.key)
+            if self.patch_graph is None:
+                with trace.span("patch_graph.build"):
+                    patches = self.task.parsed_patches
+                    self.patch_graph = PatchGraph.build(patches, read_patch_files(self.workspace, patches))
+                # graphs are read-only once built; a racing env's duplicate is harmless
+                _PATCH_GRAPHS[self.task.key] = self.patch_graph
+            self._graph_state = 0
+        self.last_reset_s = time.perf_counter() - t0
         return self._obs()
 
-    def close(self):
-        if self.workspace and os.path.isdir(self.workspace):
+    def _close_gen(self) -> EnvGen[None]:
+        if self.workspace:
+            yield ("close", {"root": self.workspace})
+        if self.workspace_pool is not None:
+            if self._own_pool:
+                self.workspace_pool.close()
+                self.workspace_pool = None
+            elif self.workspace:
+                self.workspace_pool.release(self.workspace)
+        elif self.workspace and os.path.isdir(self.workspace):
             shutil.rmtree(self.workspace, ignore_errors=True)
         self.workspace = None
 
-    def _obs(self) -> Dict[str, Any]:
+    @property
+    def action_mask(self) -> int:
+        """Bitmask of the actions worth taking now; tool actions always are."""
+        n = self.num_patches
+        patches = self.patch_graph.mask(self._graph_state) if self.patch_graph is not None else (1 << n) - 1
+        return patches | 0b111 << n
+
+    def _obs(self) -> Any:
+        if self.obs_buffer is not None:
+            return self.obs_buffer.write(self.steps, self.max_steps, self.tool_calls, self.best_pass_rate, self.last_pass_rate,
+                                         self.last_tool, self.applied_mask, self.action_size, self.action_mask, self.last_message)
         return {
             "task": self.task_name,
             "step": self.steps,
@@ -99,17 +331,110 @@ class ToolUseCodingEnv:
             "best_pass_rate": self.best_pass_rate,
             "last_pass_rate": self.last_pass_rate,
             "action_size": self.action_size,
+            "action_mask": self.action_mask,
             "last_message": self.last_message[:400],
         }
 
-    def step(self, action: int) -> Tuple[Dict[str, Any], float, bool, StepInfo]:
+    def _note_touched(self, rr: RunResult, parsed):
+        self._patched = True
+        files = rr.meta.get("files")
+        if files is None and parsed is not None:
+            # runner-side apply: assume every path in the patch may have changed
+            files = parsed.paths
+        if files is None:
+            self._touched_unknown = True
+        else:
+            self._touched.update(files)
+        if self.file_cache is not None:
+            self.file_cache.invalidate(files)
+
+    def _select_tests(self) -> Optional[List[str]]:
+        """Test files to rerun incrementally; None means run the whole suite."""
+        if not self.incremental_tests or self._tests is None or self._touched_unknown:
+            return None
+        if not self._touched:
+            return []
+        if self._graph is None or self._graph.root != self.workspace:
+            self._graph = ImportGraph(self.workspace)
+        with trace.span("test_selection"):
+            self._graph.refresh()
+            files = select_test_files(self._graph, self._touched)
+        if files is None or len(files) == len(self._graph.test_files()):
+            return None
+        return files
+
+    def _pytest(self) -> EnvGen[RunResult]:
+        selected = self._select_tests()
+        if selected is not None and not selected:
+            assert self._tests is not None
+            return RunResult(True, 0, 0.0, "no tests affected since the last run; reusing results", "",
+                             {"tests": self._tests.to_json(), "incremental": True, "selected": []})
+        kwargs = {"root": self.workspace, "timeout_ms": self.test_timeout_ms, "args": selected, "report": self.structured_tests}
+        if self.test_shards > 1:
+            kwargs["shards"] = self.test_shards
+        rr = yield ("pytest", kwargs)
+        if selected:
+            assert self._tests is not None
+            rr.meta.update(incremental=True, selected=selected)
+            if "tests" in rr.meta:
+                part = TestReport.from_json(rr.meta["tests"])
+                # a collection error interrupts the session, as it would a full run
+                merged = part if part.collection_errors else self._tests.merged(part, selected)
+                rr.meta["tests"] = merged.to_json()
+        return rr
+
+    def _pass_rate(self, rr: RunResult) -> float:
+        if "tests" in rr.meta:
+            rate = TestReport.from_json(rr.meta["tests"]).pass_rate
+            if rate >= 0:
+                return rate
+        parsed = pytest_pass_rate(rr.stdout, rr.meta.get("pytest_summary"))
+        if parsed < 0:
+            # fallback: exit code 0 means success
+            return 1.0 if rr.exit_code == 0 else 0.0
+        return parsed
+
+    def _run_tests(self) -> EnvGen[Tuple[str, float]]:
+        cmd = PYTEST_CMD + (STRUCTURED_KEY if self.structured_tests else [])
+        cache_key = None
+        if self.test_cache is not None:
+            with trace.span("test_cache.key"):
+                cache_key = self.test_cache.key(self.workspace, cmd)
+        cached = self.test_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            rr, pass_rate = cached
+            # the run that produced it, so CPU-clock rewards don't depend on cache hits
+            self._note_cpu(rr)
+        else:
+            rr = yield from self._pytest()
+            with trace.span("env.pass_rate"):
+                pass_rate = self._pass_rate(rr)
+            # timeouts depend on host load, not on the workspace
+            if cache_key is not None and not rr.meta.get("timed_out"):
+                self.test_cache.put(cache_key, rr, pass_rate)
+
+        report = TestReport.from_json(rr.meta["tests"]) if "tests" in rr.meta else None
+        self.last_tests = report.pass_vector() if report is not None else None
+        if self.incremental_tests:
+            self._tests = report
+            self._touched = set()
+            self._touched_unknown = False
+            if report is not None and not self._patched:
+                assert self.task is not None
+                self._pristine_tests[self.task.key] = report
+        return rr.combined, pass_rate
+
+    def _step_gen(self, action: int) -> EnvGen[Tuple[Dict[str, Any], float, bool, StepInfo]]:
         assert self.task is not None and self.workspace is not None
         self.steps += 1
 
         t0 = time.time()
+        self._sched_wait_s = 0.0
+        self._cpu_s = 0.0
         done = False
         reward = 0.0
         msg = ""
+        applied = None
 
         if action < 0 or action >= self.action_size:
             raise ValueError(f"Invalid action {action} for action_size {self.action_size}")
@@ -119,21 +444,21 @@ class ToolUseCodingEnv:
             patch = self.task.patches[action]
             diff = patch["diff"]
             self.tool_calls += 1
-            rr = self.runner.apply_diff(diff, root=self.workspace, timeout_ms=5_000)
+            parsed = self.task.parsed_patches[action] if action < len(self.task.parsed_patches) else None
+            rr = yield ("apply_diff", {"unified_diff": diff, "root": self.workspace, "timeout_ms": 5_000, "parsed": parsed})
             msg = rr.combined.strip() or ("patch applied" if rr.ok else "patch failed")
+            applied = rr.ok
+            if applied and action < MASK_BITS:
+                self.applied_mask |= 1 << action
+            if self.patch_graph is not None:
+                self._graph_state = self.patch_graph.step(self._graph_state, action, applied)
+            self._note_touched(rr, parsed)
             reward -= self.tool_call_penalty
 
         # Run tests
         elif action == self.num_patches:
             self.tool_calls += 1
-            rr = self.runner.pytest(root=self.workspace, timeout_ms=self.test_timeout_ms)
-            out = rr.combined
-            parsed = parse_pytest_pass_rate(out)
-            if parsed < 0:
-                # fallback: exit code 0 means success
-                pass_rate = 1.0 if rr.exit_code == 0 else 0.0
-            else:
-                pass_rate = parsed
+            out, pass_rate = yield from self._run_tests()
 
             self.last_pass_rate = pass_rate
             if pass_rate > self.best_pass_rate:
@@ -151,7 +476,11 @@ class ToolUseCodingEnv:
         # Read file
         elif action == self.num_patches + 1:
             self.tool_calls += 1
-            rr = self.runner.read_file("src/solution.py", root=self.workspace, timeout_ms=5_000)
+            if self.file_cache is not None:
+                rr = self.file_cache.read("src/solution.py")
+                self._note_cpu(rr)
+            else:
+                rr = yield ("read_file", {"path": "src/solution.py", "root": self.workspace, "timeout_ms": 5_000})
             msg = rr.stdout.strip()[:4000]
             reward -= self.tool_call_penalty
 
@@ -160,7 +489,11 @@ class ToolUseCodingEnv:
             done = True
             msg = "terminated by agent"
 
-        elapsed = time.time() - t0
+        if self.time_penalty_clock == "cpu":
+            elapsed = self._cpu_s
+        else:
+            # queueing for a sandbox slot depends on other envs, not on this action
+            elapsed = max(0.0, time.time() - t0 - self._sched_wait_s)
         reward -= self.time_penalty_per_s * elapsed
 
         # Hard episode limit
@@ -168,14 +501,21 @@ class ToolUseCodingEnv:
             done = True
 
         self.last_message = msg
+        tool = self._tool_name(action)
+        self.last_tool = TOOL_CODES[tool]
 
         info = StepInfo(
-            tool="apply_patch" if action < self.num_patches else ("pytest" if action == self.num_patches else ("read_file" if action == self.num_patches+1 else "done")),
+            tool=tool,
             tool_calls=self.tool_calls,
             elapsed_s=time.time() - self.start_t,
             pass_rate=self.last_pass_rate,
             done=done,
             message=msg[:400],
+            tests=self.last_tests,
+            applied=applied,
+            step_s=elapsed,
+            cpu_s=self._cpu_s,
+            action_mask=self.action_mask,
         )
 
         return self._obs(), reward, done, info
@@ -0,0 +1,383 @@
+"""Columnar on-disk store for env trajectories.
+
+A trajectory directory holds one file per fixed-width column, named
+`<column>.col` and holding native-endian values in the `array` typecode given
+by `COLUMNS`. Variable-length fields (the step message and the per-test pass
+vector as JSON) each have a blob file `<name>.blob` and a `<name>.off`
+offsets column (uint64, rows + 1 entries). `episodes.off` holds the first row
+of every episode. `meta.json` holds the committed row and episode counts and
+the vocabularies of the categorical columns (`task`, `tool`).
+
+`TrajectoryWriter` buffers each episode in memory and appends it at once, so
+episodes are contiguous even when several envs record concurrently.
+Column files grow `chunk_rows` rows at a time and are written through mmap.
+On every commit the writer msyncs and fsyncs the data, then atomically
+replaces `meta.json`. A crash therefore loses at most the episodes still
+being recorded, and readers only ever see whole episodes.
+
+`TrajectoryReader` maps the committed rows read-only. `column()` and
+`iter_batches()` hand out memoryview slices of the mapping without copying;
+`sample()` gathers random rows for replay-buffer style training.
+"""
+from __future__ import annotations
+import json
+import mmap
+import os
+import random
+import sys
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tu_agent.env.tool_env import StepInfo
+from tu_agent.env.obs_array import as_dict
+
+FORMAT_VERSION = 1
+
+# (column, array typecode). obs_* describe the observation the action was taken in, next_* the one it led to.
+COLUMNS: List[Tuple[str, str]] = [
+    ("episode", "I"),
+    ("t", "I"),
+    ("task", "H"),
+    ("action", "i"),
+    ("reward", "d"),
+    ("done", "B"),
+    ("tool", "B"),
+    ("elapsed_s", "d"),
+    ("pass_rate", "d"),
+    ("max_steps", "i"),
+    ("action_size", "H"),
+    ("obs_step", "i"),
+    ("obs_tool_calls", "i"),
+    ("obs_best_pass_rate", "d"),
+    ("obs_last_pass_rate", "d"),
+    ("next_step", "i"),
+    ("next_tool_calls", "i"),
+    ("next_best_pass_rate", "d"),
+    ("next_last_pass_rate", "d"),
+]
+BLOBS = ("message", "tests")
+CATEGORICAL = ("task", "tool")
+OFFSET_TYPE = "Q"
+
+_OBS_FIELDS = ("step", "tool_calls", "best_pass_rate", "last_pass_rate")
+
+def _row(obs: Dict[str, Any], action: int, reward: float, next_obs: Dict[str, Any], done: bool, info: StepInfo) -> Dict[str, Any]:
+    # array observations (obs_array) are copied out now; they carry no task name
+    if not isinstance(obs, dict):
+        obs = as_dict(obs)
+    if not isinstance(next_obs, dict):
+        next_obs = as_dict(next_obs)
+    row: Dict[str, Any] = {
+        "task": obs.get("task", ""),
+        "action": int(action),
+        "reward": float(reward),
+        "done": int(bool(done)),
+        "tool": info.tool,
+        "elapsed_s": info.elapsed_s,
+        "pass_rate": info.pass_rate,
+        "max_steps": int(obs.get("max_steps", 0)),
+        "action_size": int(obs.get("action_size", 0)),
+        "message": info.message.encode("utf-8", "replace"),
+        "tests": json.dumps(info.tests, separators=(",", ":")).encode("utf-8") if info.tests is not None else b"",
+    }
+    for f in _OBS_FIELDS:
+        row["obs_" + f] = obs.get(f, 0)
+        row["next_" + f] = next_obs.get(f, 0)
+    return row
+
+def batch_obs(batch: Dict[str, Sequence[Any]], prefix: str="obs_") -> List[Dict[str, Any]]:
+    """Rebuild the numeric part of env observations from a batch (prefix "obs_" or "next_")."""
+    cols = [(f, batch[prefix + f]) for f in _OBS_FIELDS]
+    return [dict({f: c[i] for f, c in cols}, max_steps=m) for i, m in enumerate(batch["max_steps"])]
+
+class _Column:
+    """A fixed-width column file grown in chunks and written through mmap."""
+
+    def __init__(self, path: str, typecode: str, rows: int, chunk_rows: int):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.chunk_rows = chunk_rows
+        self._f = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.capacity = 0
+        self._mm: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._reserve(max(rows, 1))
+
+    def _reserve(self, rows: int):
+        if rows <= self.capacity:
+            return
+        cap = -(-rows // self.chunk_rows) * self.chunk_rows
+        self._unmap()
+        self._f.truncate(cap * self.itemsize)
+        self._mm = mmap.mmap(self._f.fileno(), cap * self.itemsize)
+        self._view = memoryview(self._mm).cast(self.typecode)
+        self.capacity = cap
+
+    def _unmap(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def write(self, start: int, values: Sequence[Any]):
+        self._reserve(start + len(values))
+        assert self._view is not None
+        self._view[start:start + len(values)] = array(self.typecode, values)
+
+    def get(self, i: int) -> Any:
+        assert self._view is not None
+        return self._view[i]
+
+    def sync(self):
+        if self._mm is not None:
+            self._mm.flush()
+
+    def close(self, rows: int):
+        self._unmap()
+        self._f.truncate(rows * self.itemsize)
+        self._f.close()
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class EpisodeBuffer:
+    """Steps of one episode, held in memory until `TrajectoryWriter.commit`."""
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+
+    def add(self, obs: Dict[str, Any], action: int, reward: float, next_obs: Dict[str, Any], done: bool, info: StepInfo):
+        self.rows.append(_row(obs, action, reward, next_obs, done, info))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+class TrajectoryWriter:
+    """Appends whole episodes to a trajectory directory (created, or reopened for appending).
+
+    Thread-safe only under the caller's lock; one writer per directory.
+    """
+
+    def __init__(self, path: str, chunk_rows: int=4096):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = _read_meta(path)
+        if meta is not None and meta.get("byteorder") != sys.byteorder:
+            raise ValueError(f"{path} was written on a {meta.get('byteorder')}-endian host")
+        self.rows = meta["rows"] if meta else 0
+        self.episodes = meta["episodes"] if meta else 0
+        self.vocab: Dict[str, List[str]] = meta["vocab"] if meta else {c: [] for c in CATEGORICAL}
+        self._codes = {c: {v: i for i, v in enumerate(vs)} for c, vs in self.vocab.items()}
+        self._cols = {name: _Column(os.path.join(path, f"{name}.col"), tc, self.rows, chunk_rows) for name, tc in COLUMNS}
+        self._offsets = {b: _Column(os.path.join(path, f"{b}.off"), OFFSET_TYPE, self.rows + 1, chunk_rows) for b in BLOBS}
+        self._episode_off = _Column(os.path.join(path, "episodes.off"), OFFSET_TYPE, self.episodes + 1, chunk_rows)
+        self._blobs = {}
+        for b in BLOBS:
+            f = open(os.path.join(path, f"{b}.blob"), "r+b" if meta else "w+b")
+            # drop anything written after the last commit
+            f.truncate(self._offsets[b].get(self.rows) if meta else 0)
+            f.seek(0, os.SEEK_END)
+            self._blobs[b] = f
+        if meta is None:
+            for b in BLOBS:
+                self._offsets[b].write(0, [0])
+            self._episode_off.write(0, [0])
+            self._write_meta()
+
+    def episode(self) -> EpisodeBuffer:
+        return EpisodeBuffer()
+
+    def _code(self, column: str, value: str) -> int:
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.vocab[column])
+            self.vocab[column].append(value)
+        return code
+
+    def commit(self, ep: EpisodeBuffer):
+        """Append `ep`'s steps as the next episode and make them durable."""
+        if not ep.rows:
+            return
+        n = len(ep.rows)
+        start = self.rows
+        for name, _ in COLUMNS:
+            if name == "episode":
+                values = [self.episodes] * n
+            elif name == "t":
+                values = list(range(n))
+            elif name in CATEGORICAL:
+                values = [self._code(name, row[name]) for row in ep.rows]
+            else:
+                values = [row[name] for row in ep.rows]
+            self._cols[name].write(start, values)
+        for b in BLOBS:
+            f = self._blobs[b]
+            end = self._offsets[b].get(start)
+            offs = []
+            for row in ep.rows:
+                f.write(row[b])
+                end += len(row[b])
+                offs.append(end)
+            self._offsets[b].write(start + 1, offs)
+        self.rows += n
+        self.episodes += 1
+        self._episode_off.write(self.episodes, [self.rows])
+        self._sync()
+        self._write_meta()
+
+    def _sync(self):
+        for col in list(self._cols.values()) + list(self._offsets.values()) + [self._episode_off]:
+            col.sync()
+        for f in self._blobs.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_meta(self):
+        meta = {
+            "version": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "rows": self.rows,
+            "episodes": self.episodes,
+            "columns": dict(COLUMNS),
+            "blobs": list(BLOBS),
+            "vocab": self.vocab,
+        }
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+        _fsync_dir(self.path)
+
+    def close(self):
+        for col in self._cols.values():
+            col.close(self.rows)
+        for col in self._offsets.values():
+            col.close(self.rows + 1)
+        self._episode_off.close(self.episodes + 1)
+        for f in self._blobs.values():
+            f.close()
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _read_meta(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported trajectory format version {meta.get('version')}")
+    return meta
+
+class TrajectoryReader:
+    """Read-only, memory-mapped view of the committed rows of a trajectory directory."""
+
+    def __init__(self, path: str):
+        meta = _read_meta(path)
+        if meta is None:
+            raise FileNotFoundError(f"no trajectory at {path}")
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {meta['byteorder']}-endian host")
+        self.path = path
+        self.rows: int = meta["rows"]
+        self.num_episodes: int = meta["episodes"]
+        self.vocab: Dict[str, List[str]] = meta["vocab"]
+        self._maps: List[mmap.mmap] = []
+        self._views: List[memoryview] = []
+        self._cols = {name: self._map(f"{name}.col", tc, self.rows) for name, tc in meta["columns"].items()}
+        self._offsets = {b: self._map(f"{b}.off", OFFSET_TYPE, self.rows + 1) for b in meta["blobs"]}
+        self._blobs = {b: self._map(f"{b}.blob", "B", self._offsets[b][self.rows]) for b in meta["blobs"]}
+        self._episode_off = self._map("episodes.off", OFFSET_TYPE, self.num_episodes + 1)
+
+    def _map(self, name: str, typecode: str, count: int) -> memoryview:
+        nbytes = count * array(typecode).itemsize
+        if nbytes == 0:
+            return memoryview(b"").cast(typecode)
+        with open(os.path.join(self.path, name), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        view = memoryview(mm)[:nbytes].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return self.rows
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._cols)
+
+    def column(self, name: str) -> memoryview:
+        """The whole column, zero-copy."""
+        return self._cols[name]
+
+    def blob(self, name: str, i: int) -> memoryview:
+        off = self._offsets[name]
+        return self._blobs[name][off[i]:off[i + 1]]
+
+    def message(self, i: int) -> str:
+        return bytes(self.blob("message", i)).decode("utf-8", "replace")
+
+    def tests(self, i: int) -> Optional[Dict[str, bool]]:
+        raw = self.blob("tests", i)
+        return json.loads(bytes(raw)) if len(raw) else None
+
+    def decode(self, column: str, code: int) -> str:
+        return self.vocab[column][code]
+
+    def episode_rows(self, k: int) -> range:
+        return range(self._episode_off[k], self._episode_off[k + 1])
+
+    def iter_batches(self, batch_size: int, columns: Optional[Sequence[str]]=None) -> Iterator[Dict[str, memoryview]]:
+        """Consecutive row batches as {column: memoryview slice}; nothing is copied."""
+        names = list(columns) if columns is not None else self.columns
+        for start in range(0, self.rows, batch_size):
+            stop = min(start + batch_size, self.rows)
+            yield {n: self._cols[n][start:stop] for n in names}
+
+    def sample(self, batch_size: int, rng: Optional[random.Random]=None, columns: Optional[Sequence[str]]=None) -> Dict[str, List[Any]]:
+        """`batch_size` rows drawn uniformly with replacement, as {column: list}."""
+        if self.rows == 0:
+            raise ValueError("empty trajectory")
+        rng = rng or random
+        idx = [rng.randrange(self.rows) for _ in range(batch_size)]
+        names = list(columns) if columns is not None else self.columns
+        return {n: [self._cols[n][i] for i in idx] for n in names}
+
+    def close(self):
+        for v in self._views:
+            v.release()
+        self._views = []
+        self._cols = {}
+        self._offsets = {}
+        self._blobs = {}
+        for mm in self._maps:
+            try:
+                mm.close()
+            except BufferError:
+                pass  # a caller still holds a slice; the map goes when it does
+        self._maps = []
+
+    def __enter__(self) -> "TrajectoryReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
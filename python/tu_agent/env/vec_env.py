@@ -0,0 +1,116 @@
+from __future__ import annotations
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+from tu_agent.env.tool_env import ToolUseCodingEnv, StepInfo
+from tu_agent.env.obs_array import ObsBuffer, new_slots
+from tu_agent.runner.auto_runner import AutoRunner
+
+class VecToolUseCodingEnv:
+    """Steps N independent `ToolUseCodingEnv` workspaces concurrently.
+
+    Every sub-env owns its own workspace; a step is dominated by waiting on a
+    runner subprocess, so a thread pool is enough to keep N of them in flight.
+
+    `step(actions)` returns lists (one entry per sub-env) of obs, rewards,
+    dones and `StepInfo`s. With `auto_reset`, a finished sub-env is reset
+    immediately: its slot in the returned obs is the fresh episode's first
+    observation and the terminal observation is kept in `terminal_obs[i]`.
+
+    If the envs use `obs_mode="array"`, their observation slots are rows of
+    two contiguous float64 batches, and every step fills the other batch.
+    `obs_batch` is the current one as a 2-D `memoryview` of shape
+    `(num_envs, size)`. The returned obs list holds the row views of that
+    same batch, and the list is reused.
+    """
+
+    def __init__(self, envs: Sequence[ToolUseCodingEnv], max_workers: Optional[int]=None, auto_reset: bool=True):
+        if not envs:
+            raise ValueError("VecToolUseCodingEnv needs at least one env")
+        self.envs = list(envs)
+        self.auto_reset = auto_reset
+        self.terminal_obs: List[Optional[Dict[str, Any]]] = [None] * len(self.envs)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers or len(self.envs), thread_name_prefix="tu_vec_env")
+        self.obs_batch: Optional[memoryview] = None
+        self._array = self.envs[0].obs_buffer is not None
+        if self._array:
+            self._init_batches()
+
+    def _init_batches(self):
+        k = self.envs[0].obs_buffer.msg_features
+        if any(e.obs_buffer is None or e.obs_buffer.msg_features != k for e in self.envs):
+            raise ValueError("array observations need the same obs_mode and msg_features in every env")
+        n, size = self.num_envs, self.envs[0].obs_buffer.size
+        batches = [array("d", [0.0]) * (n * size) for _ in range(2)]
+        self._batches = [memoryview(b).cast("B").cast("d", (n, size)) for b in batches]
+        self._rows = [[memoryview(b)[i * size:(i + 1) * size] for i in range(n)] for b in batches]
+        self._terminal = [new_slots(size, 1)[0] for _ in range(n)]
+        for i, e in enumerate(self.envs):
+            e.obs_buffer = ObsBuffer(k, slots=(self._rows[0][i], self._rows[1][i]))
+        self._parity = 1
+
+    @property
+    def num_envs(self) -> int:
+        return len(self.envs)
+
+    @property
+    def action_sizes(self) -> List[int]:
+        return [e.action_size for e in self.envs]
+
+    def reset(self, seed: Optional[int]=None) -> List[Dict[str, Any]]:
+        seeds = [None if seed is None else seed + i for i in range(self.num_envs)]
+        self.terminal_obs = [None] * self.num_envs
+        if not self._array:
+            return list(self._pool.map(lambda es: es[0].reset(seed=es[1]), zip(self.envs, seeds)))
+        # every env writes batch 0
+        for e in self.envs:
+            e.obs_buffer.parity = 1
+        list(self._pool.map(lambda es: es[0].reset(seed=es[1]), zip(self.envs, seeds)))
+        return self._flip(0)
+
+    def _flip(self, parity: int) -> List[Any]:
+        self._parity = parity
+        self.obs_batch = self._batches[parity]
+        return self._rows[parity]
+
+    def _step_one(self, i: int, action: int) -> Tuple[Dict[str, Any], float, bool, StepInfo]:
+        env = self.envs[i]
+        obs, reward, done, info = env.step(action)
+        if done and self.auto_reset:
+            if env.obs_buffer is not None:
+                # keep the terminal obs, and let reset write the slot the step just did
+                self._terminal[i][:] = obs
+                obs = self._terminal[i]
+                env.obs_buffer.parity ^= 1
+            self.terminal_obs[i] = obs
+            obs = env.reset()
+        return obs, reward, done, info
+
+    def step(self, actions: Sequence[int]) -> Tuple[List[Dict[str, Any]], List[float], List[bool], List[StepInfo]]:
+        if len(actions) != self.num_envs:
+            raise ValueError(f"Expected {self.num_envs} actions, got {len(actions)}")
+        self.terminal_obs = [None] * self.num_envs
+        results = list(self._pool.map(self._step_one, range(self.num_envs), actions))
+        obs = [r[0] for r in results] if not self._array else self._flip(self._parity ^ 1)
+        rewards = [r[1] for r in results]
+        dones = [r[2] for r in results]
+        infos = [r[3] for r in results]
+        return obs, rewards, dones, infos
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        for e in self.envs:
+            e.close()
+
+def make_vec_env(
+    tasks_root: str,
+    runner: AutoRunner,
+    task_name: str,
+    num_envs: int,
+    max_workers: Optional[int]=None,
+    auto_reset: bool=True,
+    **env_kwargs,
+) -> VecToolUseCodingEnv:
+    envs = [ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=task_name, **env_kwargs) for _ in range(num_envs)]
+    return VecToolUseCodingEnv(envs, max_workers=max_workers, auto_reset=auto_reset)
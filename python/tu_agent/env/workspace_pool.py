@@ -0,0 +1,169 @@
+from __future__ import annotations
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from tu_agent.env.task_loader import TaskSpec
+
+# relpath -> (size, mtime_ns) of a pristine file
+Manifest = Dict[str, Tuple[int, int]]
+
+def _default_base_dir(use_shm: bool) -> Optional[str]:
+    if use_shm and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+def _scan(root: str) -> Tuple[Manifest, Set[str]]:
+    files: Manifest = {}
+    dirs: Set[str] = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for d in dirnames:
+            dirs.add(os.path.relpath(os.path.join(dirpath, d), root))
+        for fn in filenames:
+            p = os.path.join(dirpath, fn)
+            st = os.lstat(p)
+            files[os.path.relpath(p, root)] = (st.st_size, st.st_mtime_ns)
+    return files, dirs
+
+class _Snapshot:
+    def __init__(self, path: str):
+        self.path = path
+        self.files, self.dirs = _scan(path)
+
+class WorkspacePool:
+    """Reusable task workspaces restored from a pristine per-task snapshot.
+
+    Each task is materialized once into a snapshot directory (on tmpfs under
+    /dev/shm when available). Workspaces are plain copies of it; resetting a
+    workspace compares (size, mtime_ns) against the snapshot manifest and
+    only re-copies files that changed, deletes files that were added
+    (patch leftovers, caches) and restores ones that went missing.
+
+    Files are copied rather than hardlinked: `patch` and friends may rewrite
+    files in place, which would corrupt a shared snapshot.
+    """
+
+    def __init__(self, base_dir: Optional[str]=None, use_shm: bool=True):
+        self.base_dir = tempfile.mkdtemp(prefix="tu_agent_pool_", dir=base_dir or _default_base_dir(use_shm))
+        self._snapshots: Dict[str, _Snapshot] = {}
+        self._free: Dict[str, List[str]] = {}
+        self._owner: Dict[str, str] = {}  # workspace -> snapshot key
+        self._lock = threading.Lock()
+        self.resets = 0
+        self.reset_s_total = 0.0
+        self.files_restored = 0
+
+    def _key(self, task: TaskSpec) -> str:
+        return task.key
+
+    def snapshot(self, task: TaskSpec) -> str:
+        """Path of the pristine snapshot for `task` (created on first use)."""
+        key = self._key(task)
+        with self._lock:
+            snap = self._snapshots.get(key)
+            if snap is None:
+                path = tempfile.mkdtemp(prefix=f"snap_{task.name}_", dir=self.base_dir)
+                task.materialize(path)
+                snap = _Snapshot(path)
+                self._snapshots[key] = snap
+            return snap.path
+
+    def restore(self, task: TaskSpec, workspace: str) -> int:
+        """Bring `workspace` back to the pristine snapshot; returns the number of files copied."""
+        self.snapshot(task)
+        snap = self._snapshots[self._key(task)]
+        copied = 0
+        seen: Set[str] = set()
+        for dirpath, dirnames, filenames in os.walk(workspace):
+            for d in list(dirnames):
+                p = os.path.join(dirpath, d)
+                if os.path.islink(p):
+                    # a symlink to a directory: never followed, and never kept, even where
+                    # the snapshot has a directory (its files are copied back below)
+                    os.unlink(p)
+                    dirnames.remove(d)
+                elif os.path.relpath(p, workspace) not in snap.dirs:
+                    shutil.rmtree(p)
+                    dirnames.remove(d)
+            for fn in filenames:
+                p = os.path.join(dirpath, fn)
+                rel = os.path.relpath(p, workspace)
+                want = snap.files.get(rel)
+                if want is None:
+                    os.remove(p)
+                    continue
+                seen.add(rel)
+                st = os.lstat(p)
+                if stat.S_ISLNK(st.st_mode) or (st.st_size, st.st_mtime_ns) != want:
+                    os.remove(p)
+                    shutil.copy2(os.path.join(snap.path, rel), p)
+                    copied += 1
+        for rel in snap.files.keys() - seen:
+            dst = os.path.join(workspace, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(os.path.join(snap.path, rel), dst)
+            copied += 1
+        return copied
+
+    def acquire(self, task: TaskSpec) -> str:
+        """A clean workspace for `task`, reusing a released one when possible."""
+        snap_path = self.snapshot(task)
+        key = self._key(task)
+        with self._lock:
+            free = self._free.get(key)
+            ws = free.pop() if free else None
+        if ws is not None:
+            n = self.restore(task, ws)
+            with self._lock:
+                self.files_restored += n
+            return ws
+        ws = tempfile.mkdtemp(prefix=f"ws_{task.name}_", dir=self.base_dir)
+        shutil.copytree(snap_path, ws, dirs_exist_ok=True)
+        with self._lock:
+            self._owner[ws] = key
+        return ws
+
+    def release(self, workspace: str):
+        """Hand `workspace` back for reuse by later `acquire` calls."""
+        with self._lock:
+            key = self._owner.get(workspace)
+            if key is not None:
+                self._free.setdefault(key, []).append(workspace)
+
+    def reset(self, task: TaskSpec, workspace: Optional[str]=None) -> str:
+        """Restore `workspace` in place if it belongs to `task`, else swap it for one that does."""
+        t0 = time.perf_counter()
+        n = 0
+        if workspace is not None and self._owner.get(workspace) == self._key(task):
+            n = self.restore(task, workspace)
+            ws = workspace
+        else:
+            if workspace is not None:
+                self.release(workspace)
+            ws = self.acquire(task)
+        with self._lock:
+            self.resets += 1
+            self.files_restored += n
+            self.reset_s_total += time.perf_counter() - t0
+        return ws
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "resets": self.resets,
+                "mean_reset_s": (self.reset_s_total / self.resets) if self.resets else 0.0,
+                "files_restored": self.files_restored,
+                "snapshots": len(self._snapshots),
+                "workspaces": len(self._owner),
+            }
+
+    def close(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._free.clear()
+            self._owner.clear()
+        shutil.rmtree(self.base_dir, ignore_errors=True)
@@ -0,0 +1,337 @@
+from __future__ import annotations
+import asyncio
+import codecs
+import json
+import os
+import subprocess
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
+from .types import RunResult, ResourceLimits
+from .rust_runner import RETRY_OPS, _result_from_payload, serve_died
+from .fork_server import PytestForkServer
+from .capture import DEFAULT_MAX_OUTPUT_BYTES, BoundedCapture, _killpg, _reap
+from .scheduler import SandboxScheduler, default_scheduler
+from .sharding import TestDurations
+from .shared import PytestCall, PytestSteps, fallback_apply, fallback_read_file, native_apply, pytest_steps
+from tu_agent.utils import trace
+from tu_agent.utils.text import PytestSummaryDetector
+from tu_agent.utils.diff import PatchSet
+
+async def _drain(stream: asyncio.StreamReader, cap: BoundedCapture, on_text: Optional[Callable[[str], None]]):
+    # incremental, so a character split across reads isn't replaced
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace") if on_text else None
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        cap.feed(chunk)
+        if decoder is not None:
+            on_text(decoder.decode(chunk))
+    if decoder is not None:
+        on_text(decoder.decode(b"", final=True))
+
+async def _wait_exit(p: subprocess.Popen, timeout_s: Optional[float]) -> bool:
+    """`capture._wait_exit` on the event loop: True once `p` exits, left unreaped for `_reap`; False on timeout."""
+    try:
+        pidfd = os.pidfd_open(p.pid)
+    except (AttributeError, OSError):
+        # no pidfds: poll without reaping
+        deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        delay = 0.001
+        while os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 0.05)
+        return True
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(True))
+    try:
+        return await asyncio.wait_for(exited, timeout_s)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+async def _read_pipe(pipe) -> Tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+def _feed(pipe, data: bytes):
+    try:
+        pipe.write(data)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+async def async_stream_run(
+    cmd: List[str],
+    cwd: str,
+    timeout_ms: int,
+    max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES,
+    on_stdout: Optional[Callable[[str], None]]=None,
+    stdin: Optional[bytes]=None,
+) -> RunResult:
+    """asyncio counterpart of `capture.stream_run` (same bounded capture, meta and `rusage`).
+
+    The child is started with `subprocess.Popen` rather than asyncio's, whose
+    child watcher would reap it first: exit is awaited on a pidfd and the
+    child is reaped with `os.wait4` for its resource usage.
+    """
+    t0 = time.time()
+    p = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    out_cap = BoundedCapture(max_output_bytes)
+    err_cap = BoundedCapture(max_output_bytes)
+    (out, out_t), (err, err_t) = await _read_pipe(p.stdout), await _read_pipe(p.stderr)
+    readers = asyncio.gather(_drain(out, out_cap, on_stdout), _drain(err, err_cap, None))
+    # a thread, so a child that never reads stdin can't block the loop
+    feeder = asyncio.ensure_future(asyncio.to_thread(_feed, p.stdin, stdin)) if stdin is not None else None
+    timed_out = not await _wait_exit(p, timeout_ms / 1000.0)
+    # Also takes down anything left in the group; the leader is still unreaped,
+    # so its pgid can't have been reused.
+    _killpg(p)
+    if timed_out:
+        await _wait_exit(p, None)
+    rusage = _reap(p)
+    try:
+        # a grandchild outside the group may still hold the pipes open
+        await asyncio.wait_for(asyncio.gather(readers, *([feeder] if feeder is not None else [])), 1.0)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        out_t.close()
+        err_t.close()
+    return RunResult(
+        ok=p.returncode == 0 and not timed_out,
+        exit_code=p.returncode,
+        duration_s=time.time()-t0,
+        stdout=out_cap.getvalue().decode("utf-8", errors="replace"),
+        stderr=err_cap.getvalue().decode("utf-8", errors="replace"),
+        meta={
+            "timed_out": timed_out,
+            "truncated": out_cap.truncated or err_cap.truncated,
+            "stdout_bytes": out_cap.total,
+            "stderr_bytes": err_cap.total,
+        },
+        rusage=rusage,
+    )
+
+class _AsyncServeConnection:
+    """`sandbox_runner --root <root> serve` driven over asyncio pipes."""
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def start(cls, runner_path: str, root: str, timeout_ms: int, max_output_bytes: int) -> "_AsyncServeConnection":
+        proc = await asyncio.create_subprocess_exec(
+            runner_path, "--root", root, "--timeout-ms", str(timeout_ms), "serve",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            # a reply line carries up to two capped, JSON-escaped streams
+            limit=8 * max_output_bytes + (1 << 20),
+        )
+        return cls(proc)
+
+    async def request(self, req: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with self.lock:
+            try:
+                with trace.span("rust.serve.roundtrip"):
+                    self.proc.stdin.write((json.dumps(req) + "\n").encode("utf-8"))
+                    await self.proc.stdin.drain()
+                    reply = await self.proc.stdout.readline()
+            except (BrokenPipeError, ConnectionResetError, ValueError, asyncio.LimitOverrunError):
+                return None
+        if not reply:
+            return None
+        try:
+            with trace.span("rust.decode"):
+                payload = json.loads(reply)
+        except json.JSONDecodeError:
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    async def close(self):
+        try:
+            self.proc.stdin.close()
+        except (OSError, RuntimeError):
+            pass
+        try:
+            await asyncio.wait_for(self.proc.wait(), 1.0)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+
+class AsyncAutoRunner:
+    """asyncio version of `AutoRunner` with the same `run_cmd`/`pytest`/`read_file`/`apply_diff` surface.
+
+    Every call is a coroutine, so one event loop can keep many episodes'
+    tool calls in flight without a thread each. Per-call children are
+    started by `async_stream_run` with a blocking `subprocess.Popen` (the
+    fork/exec runs on the loop thread); their pipes and exit are then
+    awaited on the loop. Only the Rust runner's long-lived `serve` process
+    goes through `asyncio.create_subprocess_exec`. Backend choice
+    (Rust runner, serve mode, native diff, fallback), `limits` and admission
+    through the shared `scheduler` match `AutoRunner`. The fork server is
+    synchronous, so its calls run in worker threads.
+
+    Each concurrent call holds a few pipes. For very high concurrency, raise
+    the fd limit (`ulimit -n`) along with the rollout's semaphore.
+    """
+
+    def __init__(self, runner_path: str, persistent: bool=True, fork_server: bool=False, native_diff: bool=True,
+                 max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES, limits: ResourceLimits=ResourceLimits(),
+                 scheduler: Optional[SandboxScheduler]=None):
+        self.runner_path = runner_path
+        self.persistent = persistent
+        self.native_diff = native_diff
+        self.max_output_bytes = max_output_bytes
+        self.limits = limits
+        self.scheduler = scheduler or default_scheduler()
+        self.has_rust = os.path.exists(runner_path)
+        self._fork = PytestForkServer(max_output_bytes=max_output_bytes, limits=limits) if fork_server else None
+        self._servers: Dict[str, _AsyncServeConnection] = {}
+        self._starting: Dict[str, asyncio.Lock] = {}
+        self.test_durations = TestDurations()
+
+    async def close(self, root: Optional[str]=None):
+        """Release per-workspace resources held for `root` (all of them if None)."""
+        if root is None:
+            conns = list(self._servers.values())
+            self._servers.clear()
+            if self._fork:
+                await asyncio.to_thread(self._fork.close)
+        else:
+            conn = self._servers.pop(root, None)
+            conns = [conn] if conn is not None else []
+            self._starting.pop(root, None)
+        for conn in conns:
+            await conn.close()
+
+    async def _server(self, root: str, timeout_ms: int) -> _AsyncServeConnection:
+        lock = self._starting.setdefault(root, asyncio.Lock())
+        async with lock:
+            conn = self._servers.get(root)
+            if conn is None or conn.proc.returncode is not None:
+                conn = await _AsyncServeConnection.start(self.runner_path, root, timeout_ms, self.max_output_bytes)
+                self._servers[root] = conn
+            return conn
+
+    async def _rust(self, req: Dict[str, Any], args: List[str], root: str, timeout_ms: int, stdin: Optional[str]=None) -> RunResult:
+        if self.persistent:
+            conn = await self._server(root, timeout_ms)
+            t0 = time.perf_counter()
+            payload = await conn.request(dict(req, timeout_ms=timeout_ms, max_output_bytes=self.max_output_bytes, **self.limits.request_fields()))
+            if payload is not None:
+                return _result_from_payload(payload, 1, "", "")
+            await self.close(root)
+            if req["op"] not in RETRY_OPS:
+                return serve_died(req["op"], time.perf_counter() - t0)
+        cmd = [self.runner_path, "--root", root, "--timeout-ms", str(timeout_ms), "--max-output-bytes", str(self.max_output_bytes)] + self.limits.cli_args() + args
+        # the runner enforces timeout_ms itself; this bound only guards against a wedged runner
+        rr = await async_stream_run(cmd, cwd=root, timeout_ms=timeout_ms + 10_000,
+                                    max_output_bytes=4 * self.max_output_bytes + (1 << 20),
+                                    stdin=stdin.encode("utf-8") if stdin is not None else None)
+        try:
+            payload = json.loads(rr.stdout) if rr.stdout.strip().startswith("{") else None
+        except json.JSONDecodeError:
+            payload = None
+        return _result_from_payload(payload, rr.exit_code, rr.stdout, rr.stderr)
+
+    async def _fallback_run(self, cmd: List[str], root: str, timeout_ms: int, on_stdout=None) -> RunResult:
+        rr = await async_stream_run(cmd, cwd=root, timeout_ms=timeout_ms, max_output_bytes=self.max_output_bytes, on_stdout=on_stdout)
+        rr.meta.update(fallback=True, cmd=cmd)
+        return rr
+
+    async def _admitted(self, tool: str, fn: Callable[[], Awaitable[RunResult]], procs: int=1) -> RunResult:
+        t0 = time.perf_counter_ns()
+        async with self.scheduler.aslot(tool, self.limits, procs) as wait_s:
+            trace.record("sched.wait", t0, int(wait_s * 1e9), tool=tool)
+            with trace.span(f"runner.{tool}"):
+                rr = await fn()
+        rr.meta["sched_wait_s"] = wait_s
+        return rr
+
+    async def run_cmd(self, cmd: List[str], root: str, timeout_ms: int=10_000) -> RunResult:
+        if self.has_rust: return await self._admitted("run", lambda: self._rust({"op": "run", "argv": cmd}, ["run", "--"] + cmd, root, timeout_ms))
+        return await self._admitted("run", lambda: self._fallback_run(cmd, root=root, timeout_ms=timeout_ms))
+
+    async def _pytest(self, root: str, timeout_ms: int, args: List[str]) -> RunResult:
+        if self._fork: return await asyncio.to_thread(self._fork.pytest, root, timeout_ms, args)
+        if self.has_rust: return await self._rust({"op": "pytest", "args": args}, ["pytest", "--"] + args if args else ["pytest"], root, timeout_ms)
+        det = PytestSummaryDetector()
+        rr = await self._fallback_run(["python","-m","pytest","-q"] + args, root=root, timeout_ms=timeout_ms, on_stdout=det.feed)
+        if det.finish().found:
+            rr.meta["pytest_summary"] = det.counts
+        return rr
+
+    async def _rust_sharded(self, root: str, timeout_ms: int, args: List[str], shards: int) -> RunResult:
+        durations = self.test_durations.lookup()
+        fd, path = tempfile.mkstemp(prefix="tu_agent_durations_", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(durations, f)
+            return await self._rust({"op": "pytest", "args": args, "shards": shards, "durations": durations},
+                                    ["pytest", "--shards", str(shards), "--durations", path, "--"] + args, root, timeout_ms)
+        finally:
+            os.remove(path)
+
+    async def _pytest_call(self, root: str, timeout_ms: int, call: PytestCall) -> RunResult:
+        args, shards = call
+        if shards > 1: return await self._rust_sharded(root, timeout_ms, args, shards)
+        return await self._pytest(root, timeout_ms, args)
+
+    async def _drive_pytest(self, root: str, timeout_ms: int, steps: PytestSteps) -> RunResult:
+        try:
+            batch = next(steps)
+            while True:
+                results = await asyncio.gather(*(self._pytest_call(root, timeout_ms, c) for c in batch))
+                batch = steps.send(list(results))
+        except StopIteration as e:
+            return e.value
+
+    async def pytest(self, root: str, timeout_ms: int=20_000, args: Optional[List[str]]=None, report: bool=False, shards: int=1) -> RunResult:
+        """See `AutoRunner.pytest`."""
+        args = list(args or [])
+        if shards <= 1 and not report:
+            return await self._admitted("pytest", lambda: self._pytest(root, timeout_ms, args))
+        steps = pytest_steps(args, root, report, shards, self.test_durations, rust_shards=self.has_rust and not self._fork)
+        return await self._admitted("pytest", lambda: self._drive_pytest(root, timeout_ms, steps), procs=max(1, shards))
+
+    async def read_file(self, path: str, root: str, timeout_ms: int=5_000) -> RunResult:
+        if self.has_rust: return await self._admitted("read_file", lambda: self._rust({"op": "read-file", "path": path}, ["read-file", "--path", path], root, timeout_ms))
+        return fallback_read_file(path, root)
+
+    async def apply_diff(self, unified_diff: str, root: str, timeout_ms: int=5_000, parsed: Optional[PatchSet]=None) -> RunResult:
+        native = None
+        if self.native_diff:
+            # in-process and small: not worth a thread hop
+            native = native_apply(unified_diff, root, parsed)
+            if not native.meta.get("unparsed"):
+                return native
+        if self.has_rust:
+            rr = await self._admitted("apply_diff", lambda: self._rust({"op": "apply-diff", "patch": unified_diff}, ["apply-diff"], root, timeout_ms, stdin=unified_diff))
+        else:
+            rr = await self._admitted("apply_diff", lambda: self._fallback_apply(unified_diff, root, timeout_ms))
+        if native is not None:
+            rr.meta["native_error"] = native.stderr
+        return rr
+
+    async def _fallback_apply(self, unified_diff: str, root: str, timeout_ms: int) -> RunResult:
+        steps = fallback_apply(unified_diff, root)
+        try:
+            cmd = next(steps)
+            while True:
+                cmd = steps.send(await self._fallback_run(cmd, root=root, timeout_ms=timeout_ms))
+        except StopIteration as e:
+            return e.value
@@ -1,71 +1,151 @@
 from __future__ import annotations
 import os
-import shutil
-import subprocess
 import time
-from typing import List, Optional
-from .types import RunResult
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+from .types import RunResult, ResourceLimits
 from .rust_runner import RustSandboxRunner
+from .fork_server import PytestForkServer
+from .capture import DEFAULT_MAX_OUTPUT_BYTES, stream_run
+from .scheduler import SandboxScheduler, default_scheduler
+from .sharding import TestDurations
+from .shared import PytestCall, PytestSteps, fallback_apply, fallback_read_file, native_apply, pytest_steps
+from tu_agent.utils import trace
+from tu_agent.utils.text import PytestSummaryDetector
+from tu_agent.utils.diff import PatchSet
 
 class AutoRunner:
     """Uses Rust runner if present; otherwise falls back to a simple Python subprocess runner.
 
     The fallback is NOT a sandbox.
+
+    By default the Rust runner is driven in `serve` mode (one long-lived
+    process per workspace); pass `persistent=False` to spawn it per call.
+
+    With `fork_server=True`, `pytest` runs in a child forked from a warm
+    interpreter that already imported pytest (see `fork_server.py`).
+
+    With `native_diff=True` (default), `apply_diff` uses the in-process
+    engine in `tu_agent.utils.diff` instead of spawning git apply / patch.
+    Its result is final for any patch it parses, rejected hunks included;
+    only a patch it cannot parse goes to git apply / patch (through the Rust
+    runner if present), with the parse error in `meta["native_error"]`.
+
+    Child output is captured up to `max_output_bytes` per stream (head and
+    tail kept); `meta["truncated"]` says whether anything was dropped.
+
+    Sandboxed children get `limits` (the Python fallback applies none) and
+    are admitted through `scheduler`, the process-wide
+    `default_scheduler()` unless one is given; `meta["sched_wait_s"]` is
+    the time spent queued.
     """
 
-    def __init__(self, runner_path: str):
+    def __init__(self, runner_path: str, persistent: bool=True, fork_server: bool=False, native_diff: bool=True,
+                 max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES, limits: ResourceLimits=ResourceLimits(),
+                 scheduler: Optional[SandboxScheduler]=None):
         self.runner_path = runner_path
-        self._rust = RustSandboxRunner(runner_path) if os.path.exists(runner_path) else None
-
-    def _fallback_run(self, cmd: List[str], root: str, timeout_ms: int) -> RunResult:
-        t0 = time.time()
-        p = subprocess.run(
-            cmd,
-            cwd=root,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=False,
-            timeout=timeout_ms/1000.0,
-        )
-        return RunResult(
-            ok=p.returncode == 0,
-            exit_code=p.returncode,
-            duration_s=time.time()-t0,
-            stdout=p.stdout.decode('utf-8', errors='replace'),
-            stderr=p.stderr.decode('utf-8', errors='replace'),
-            meta={"fallback": True, "cmd": cmd},
-        )
+        self.native_diff = native_diff
+        self.max_output_bytes = max_output_bytes
+        self.limits = limits
+        self.scheduler = scheduler or default_scheduler()
+        self._rust = RustSandboxRunner(runner_path, persistent=persistent, max_output_bytes=max_output_bytes, limits=limits) if os.path.exists(runner_path) else None
+        self._fork = PytestForkServer(max_output_bytes=max_output_bytes, limits=limits) if fork_server else None
+        # per-test durations from sharded runs, to balance the next ones
+        self.test_durations = TestDurations()
+
+    def close(self, root: Optional[str]=None):
+        """Release per-workspace resources held for `root` (all of them if None)."""
+        if self._rust: self._rust.close(root)
+        if self._fork and root is None: self._fork.close()
+
+    def _fallback_run(self, cmd: List[str], root: str, timeout_ms: int, on_stdout=None) -> RunResult:
+        rr = stream_run(cmd, cwd=root, timeout_ms=timeout_ms, max_output_bytes=self.max_output_bytes, on_stdout=on_stdout)
+        rr.meta.update(fallback=True, cmd=cmd)
+        return rr
+
+    def _admitted(self, tool: str, fn: Callable[[], RunResult], procs: int=1) -> RunResult:
+        t0 = time.perf_counter_ns()
+        with self.scheduler.slot(tool, self.limits, procs) as wait_s:
+            trace.record("sched.wait", t0, int(wait_s * 1e9), tool=tool)
+            with trace.span(f"runner.{tool}"):
+                rr = fn()
+        rr.meta["sched_wait_s"] = wait_s
+        return rr
 
     def run_cmd(self, cmd: List[str], root: str, timeout_ms: int=10_000) -> RunResult:
-        if self._rust: return self._rust.run_cmd(cmd, root=root, timeout_ms=timeout_ms)
-        return self._fallback_run(cmd, root=root, timeout_ms=timeout_ms)
+        if self._rust: return self._admitted("run", lambda: self._rust.run_cmd(cmd, root=root, timeout_ms=timeout_ms))
+        return self._admitted("run", lambda: self._fallback_run(cmd, root=root, timeout_ms=timeout_ms))
 
-    def pytest(self, root: str, timeout_ms: int=20_000) -> RunResult:
-        if self._rust: return self._rust.pytest(root=root, timeout_ms=timeout_ms)
-        return self._fallback_run(["python","-m","pytest","-q"], root=root, timeout_ms=timeout_ms)
+    def _pytest(self, root: str, timeout_ms: int, args: List[str]) -> RunResult:
+        if self._fork: return self._fork.pytest(root=root, timeout_ms=timeout_ms, args=args)
+        if self._rust: return self._rust.pytest(root=root, timeout_ms=timeout_ms, args=args)
+        det = PytestSummaryDetector()
+        rr = self._fallback_run(["python","-m","pytest","-q"] + args, root=root, timeout_ms=timeout_ms, on_stdout=det.feed)
+        if det.finish().found:
+            rr.meta["pytest_summary"] = det.counts
+        return rr
 
-    def read_file(self, path: str, root: str, timeout_ms: int=5_000) -> RunResult:
-        if self._rust: return self._rust.read_file(path, root=root, timeout_ms=timeout_ms)
-        abs_path = os.path.abspath(os.path.join(root, path))
-        if not abs_path.startswith(os.path.abspath(root) + os.sep):
-            return RunResult(False, 1, 0.0, "", "path escapes root", {"fallback": True})
+    def _pytest_call(self, root: str, timeout_ms: int, call: PytestCall) -> RunResult:
+        args, shards = call
+        if shards > 1: return self._rust.pytest(root=root, timeout_ms=timeout_ms, args=args, shards=shards, durations=self.test_durations.lookup())
+        return self._pytest(root, timeout_ms, args)
+
+    def _drive_pytest(self, root: str, timeout_ms: int, steps: PytestSteps) -> RunResult:
         try:
-            with open(abs_path,'r',encoding='utf-8') as f:
-                return RunResult(True,0,0.0,f.read(),"",{"fallback": True})
-        except Exception as e:
-            return RunResult(False,1,0.0,"",str(e),{"fallback": True})
-
-    def apply_diff(self, unified_diff: str, root: str, timeout_ms: int=5_000) -> RunResult:
-        if self._rust: return self._rust.apply_diff(unified_diff, root=root, timeout_ms=timeout_ms)
-        # fallback: try git apply then patch
-        patch_path = os.path.join(root, '.tu_agent_patch.diff')
-        with open(patch_path,'w',encoding='utf-8') as f:
-            f.write(unified_diff)
-        res = self._fallback_run(["git","apply","--unsafe-paths","--whitespace=nowarn", ".tu_agent_patch.diff"], root=root, timeout_ms=timeout_ms)
-        if not res.ok:
-            res = self._fallback_run(["patch","-p1","-i",".tu_agent_patch.diff"], root=root, timeout_ms=timeout_ms)
+            batch = next(steps)
+            while True:
+                if len(batch) == 1:
+                    results = [self._pytest_call(root, timeout_ms, batch[0])]
+                else:
+                    with ThreadPoolExecutor(len(batch)) as ex:
+                        results = list(ex.map(lambda c: self._pytest_call(root, timeout_ms, c), batch))
+                batch = steps.send(results)
+        except StopIteration as e:
+            return e.value
+
+    def pytest(self, root: str, timeout_ms: int=20_000, args: Optional[List[str]]=None, report: bool=False, shards: int=1) -> RunResult:
+        """Run `pytest -q` plus `args` in `root`.
+
+        With `report=True`, per-test outcomes are read back from a JUnit XML
+        report into `meta["tests"]` (see `test_report.py`); the key is absent
+        if pytest produced no report (e.g. it was killed on timeout).
+
+        With `shards > 1`, the tests are split across up to that many
+        concurrent pytest processes, balanced by the durations of earlier
+        sharded runs (see `sharding.py`). Each process gets `limits` and
+        `timeout_ms`, and the run takes one scheduler slot per shard.
+        `meta["shards"]` describes the shards.
+        """
+        args = list(args or [])
+        if shards <= 1 and not report:
+            return self._admitted("pytest", lambda: self._pytest(root, timeout_ms, args))
+        steps = pytest_steps(args, root, report, shards, self.test_durations, rust_shards=self._rust is not None and not self._fork)
+        return self._admitted("pytest", lambda: self._drive_pytest(root, timeout_ms, steps), procs=max(1, shards))
+
+    def read_file(self, path: str, root: str, timeout_ms: int=5_000) -> RunResult:
+        if self._rust: return self._admitted("read_file", lambda: self._rust.read_file(path, root=root, timeout_ms=timeout_ms))
+        return fallback_read_file(path, root)
+
+    def apply_diff(self, unified_diff: str, root: str, timeout_ms: int=5_000, parsed: Optional[PatchSet]=None) -> RunResult:
+        native = None
+        if self.native_diff:
+            native = native_apply(unified_diff, root, parsed)
+            if not native.meta.get("unparsed"):
+                return native
+        # a patch the native parser can't read (e.g. git binary or rename headers)
+        if self._rust:
+            rr = self._admitted("apply_diff", lambda: self._rust.apply_diff(unified_diff, root=root, timeout_ms=timeout_ms))
+        else:
+            rr = self._admitted("apply_diff", lambda: self._fallback_apply(unified_diff, root, timeout_ms))
+        if native is not None:
+            rr.meta["native_error"] = native.stderr
+        return rr
+
+    def _fallback_apply(self, unified_diff: str, root: str, timeout_ms: int) -> RunResult:
+        steps = fallback_apply(unified_diff, root)
         try:
-            os.remove(patch_path)
-        except OSError:
-            pass
-        return res
+            cmd = next(steps)
+            while True:
+                cmd = steps.send(self._fallback_run(cmd, root=root, timeout_ms=timeout_ms))
+        except StopIteration as e:
+            return e.value
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import codecs
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+from .types import RunResult, ResourceUsage
+
+# Per stream: the first half and the last half of this many bytes are kept.
+DEFAULT_MAX_OUTPUT_BYTES = 1 << 20
+
+def truncation_marker(dropped: int) -> bytes:
+    return f"\n... [{dropped} bytes truncated] ...\n".encode("utf-8")
+
+class _Ring:
+    """Fixed-size byte ring keeping the most recent `size` bytes written."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.full = False
+
+    def write(self, data: bytes):
+        n = len(data)
+        if self.size == 0 or n == 0:
+            return
+        if n >= self.size:
+            self.buf[:] = data[-self.size:]
+            self.pos = 0
+            self.full = True
+            return
+        end = self.pos + n
+        if end <= self.size:
+            self.buf[self.pos:end] = data
+        else:
+            k = self.size - self.pos
+            self.buf[self.pos:] = data[:k]
+            self.buf[:n - k] = data[k:]
+        self.full = self.full or end >= self.size
+        self.pos = end % self.size
+
+    def getvalue(self) -> bytes:
+        if not self.full:
+            return bytes(self.buf[:self.pos])
+        return bytes(self.buf[self.pos:]) + bytes(self.buf[:self.pos])
+
+class BoundedCapture:
+    """Keeps the head and tail of a byte stream within `max_bytes` total."""
+
+    def __init__(self, max_bytes: int=DEFAULT_MAX_OUTPUT_BYTES):
+        self.head_cap = max_bytes - max_bytes // 2
+        self.head = bytearray()
+        self.tail = _Ring(max_bytes // 2)
+        self.total = 0
+
+    def feed(self, data: bytes):
+        self.total += len(data)
+        room = self.head_cap - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail.write(data)
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > self.head_cap + self.tail.size
+
+    def getvalue(self) -> bytes:
+        tail = self.tail.getvalue()
+        if not self.truncated:
+            return bytes(self.head) + tail
+        return bytes(self.head) + truncation_marker(self.total - len(self.head) - len(tail)) + tail
+
+def _drain(pipe, cap: BoundedCapture, on_text: Optional[Callable[[str], None]]):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace") if on_text else None
+    fd = pipe.fileno()
+    try:
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            cap.feed(chunk)
+            if decoder is not None:
+                on_text(decoder.decode(chunk))
+        if decoder is not None:
+            on_text(decoder.decode(b"", final=True))
+    finally:
+        pipe.close()
+
+def _wait_exit(p: subprocess.Popen, timeout_s: float) -> bool:
+    """Block until `p` exits (without reaping it where pidfds exist); False on timeout."""
+    try:
+        pidfd = os.pidfd_open(p.pid)
+    except (AttributeError, OSError):
+        try:
+            p.wait(timeout=timeout_s)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+    try:
+        return bool(select.select([pidfd], [], [], timeout_s)[0])
+    finally:
+        os.close(pidfd)
+
+def _killpg(p: subprocess.Popen):
+    # Normally the leader is still unreaped here, so its pgid can't have been reused.
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _reap(p: subprocess.Popen) -> Optional[ResourceUsage]:
+    """Reap `p` with `os.wait4` for its resource usage; plain `wait()` where that is missing."""
+    if p.returncode is not None or not hasattr(os, "wait4"):
+        p.wait()
+        return None
+    try:
+        _, status, ru = os.wait4(p.pid, 0)
+    except ChildProcessError:
+        # already reaped (the Popen fallback in _wait_exit)
+        p.wait()
+        return None
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return ResourceUsage.from_rusage(ru)
+
+def stream_run(
+    cmd: List[str],
+    cwd: str,
+    timeout_ms: int,
+    max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES,
+    on_stdout: Optional[Callable[[str], None]]=None,
+) -> RunResult:
+    """Run `cmd`, draining stdout/stderr as they are produced into bounded head+tail buffers.
+
+    `on_stdout` sees every decoded stdout chunk (e.g. a PytestSummaryDetector)
+    even when the stored output is truncated.
+    """
+    t0 = time.time()
+    # Own session/process group, as in the Rust runner, so timeouts take down grandchildren.
+    p = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         start_new_session=True)
+    out_cap = BoundedCapture(max_output_bytes)
+    err_cap = BoundedCapture(max_output_bytes)
+    readers = [
+        threading.Thread(target=_drain, args=(p.stdout, out_cap, on_stdout), daemon=True),
+        threading.Thread(target=_drain, args=(p.stderr, err_cap, None), daemon=True),
+    ]
+    for t in readers:
+        t.start()
+    timed_out = not _wait_exit(p, timeout_ms / 1000.0)
+    # kills (never reaps) whatever the command left running in its group; _reap waits on the leader
+    _killpg(p)
+    rusage = _reap(p)
+    for t in readers:
+        # a grandchild may still hold the pipes open; don't wait on it forever
+        t.join(timeout=1.0)
+    return RunResult(
+        ok=p.returncode == 0 and not timed_out,
+        exit_code=p.returncode,
+        duration_s=time.time()-t0,
+        stdout=out_cap.getvalue().decode("utf-8", errors="replace"),
+        stderr=err_cap.getvalue().decode("utf-8", errors="replace"),
+        meta={
+            "timed_out": timed_out,
+            "truncated": out_cap.truncated or err_cap.truncated,
+            "stdout_bytes": out_cap.total,
+            "stderr_bytes": err_cap.total,
+        },
+        rusage=rusage,
+    )
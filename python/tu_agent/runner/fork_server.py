@@ -0,0 +1,335 @@
+"""Warm pytest fork-server.
+
+The server process imports pytest once and then, per request, forks a child
+that chdirs into the workspace, applies the same rlimits as the Rust runner
+and calls `pytest.main`. The reply uses the Rust runner's `RunnerOutput`
+JSON shape, so callers get the usual stdout/exit-code contract without paying
+interpreter startup and pytest import on every test action.
+
+Protocol: one JSON request per line on stdin ({"root": ..., "args": [...],
+"timeout_ms": ..., "max_output_bytes": ..., "cpu_secs"/"mem_mb"/"nofile": ...}),
+one JSON reply per line.
+
+Run as: python -m tu_agent.runner.fork_server
+"""
+from __future__ import annotations
+import importlib
+import json
+import os
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from typing import List, Optional, Dict, Any, Tuple
+from .types import RunResult, ResourceLimits, ResourceUsage
+from .rust_runner import _result_from_payload
+from .capture import DEFAULT_MAX_OUTPUT_BYTES, BoundedCapture
+
+PYTEST_ARGS = ["-q"]
+
+
+def _warm_imports():
+    import pytest  # noqa: F401
+    from _pytest.config import default_plugins
+    for name in default_plugins:
+        try:
+            importlib.import_module(f"_pytest.{name}")
+        except ImportError:
+            pass
+
+def _set_rlimits(limits: ResourceLimits):
+    # Mirrors run_command in rust/sandbox_runner/src/main.rs: 0 leaves a limit unchanged.
+    import resource
+    for res, lim in (
+        (resource.RLIMIT_CPU, limits.cpu_s),
+        (resource.RLIMIT_NOFILE, limits.nofile),
+        (resource.RLIMIT_AS, limits.mem_mb * 1024 * 1024),
+    ):
+        if lim <= 0:
+            continue
+        try:
+            resource.setrlimit(res, (lim, lim))
+        except (ValueError, OSError):
+            # best effort, like the Rust runner
+            pass
+
+def _purge_project_modules(root: str):
+    prefix = os.path.realpath(root) + os.sep
+    for name, mod in list(sys.modules.items()):
+        f = getattr(mod, "__file__", None)
+        if f and os.path.realpath(f).startswith(prefix):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+
+def _child(root: str, args: List[str], out_fd: int, err_fd: int, pycache_dir: str, proto_fd: int, limits: ResourceLimits):
+    code = 1
+    try:
+        os.close(proto_fd)
+        os.setpgid(0, 0)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        os.chdir(root)
+        _set_rlimits(limits)
+        _purge_project_modules(root)
+        # Fresh bytecode cache per run: a patch can keep a file's size and
+        # mtime second, which would make a workspace __pycache__ look valid.
+        sys.pycache_prefix = pycache_dir
+        sys.dont_write_bytecode = True
+        # `python -m pytest` puts the cwd first on sys.path; do the same.
+        sys.path.insert(0, root)
+        os.environ["PYTHONUNBUFFERED"] = "1"
+        import pytest
+        code = int(pytest.main(list(args)))
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+def _read(fd: int, streams: Dict[int, BoundedCapture]):
+    chunk = os.read(fd, 65536)
+    if chunk:
+        streams[fd].feed(chunk)
+    else:
+        del streams[fd]
+        os.close(fd)
+
+def _wait(pid: int, timeout_s: float, streams: Dict[int, BoundedCapture]) -> Optional[Tuple[int, Any]]:
+    """Wait for `pid`, draining `streams` (pipe fd -> capture) meanwhile; (wait status, rusage) or None on timeout."""
+    deadline = time.monotonic() + timeout_s
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+    try:
+        while True:
+            done, status, ru = os.wait4(pid, os.WNOHANG)
+            if done:
+                return status, ru
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            fds = list(streams) + ([pidfd] if pidfd is not None else [])
+            for fd in select.select(fds, [], [], left if pidfd is not None else min(0.005, left))[0]:
+                if fd in streams:
+                    _read(fd, streams)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+def _drain(streams: Dict[int, BoundedCapture], timeout_s: float=1.0):
+    """Read `streams` to EOF; a leftover writer gets `timeout_s` before its pipes are dropped."""
+    deadline = time.monotonic() + timeout_s
+    while streams:
+        left = deadline - time.monotonic()
+        ready = select.select(list(streams), [], [], max(0.0, left))[0]
+        if not ready:
+            break
+        for fd in ready:
+            _read(fd, streams)
+    for fd in list(streams):
+        os.close(fd)
+    streams.clear()
+
+def _killpg(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def handle(req: Dict[str, Any], proto_fd: int) -> Dict[str, Any]:
+    root = str(req["root"])
+    args = list(req.get("args") or PYTEST_ARGS)
+    timeout_ms = int(req.get("timeout_ms", 20_000))
+    max_output_bytes = int(req.get("max_output_bytes", DEFAULT_MAX_OUTPUT_BYTES))
+    d = ResourceLimits()
+    limits = ResourceLimits(int(req.get("cpu_secs", d.cpu_s)), int(req.get("mem_mb", d.mem_mb)), int(req.get("nofile", d.nofile)))
+    command = ["pytest"] + args
+    if not os.path.isdir(root):
+        raise ValueError(f"root is not a directory: {root}")
+
+    # Output goes through pipes into bounded captures as it is produced, as in
+    # `capture.stream_run`, so a test that prints forever can't fill the disk.
+    scratch = tempfile.mkdtemp(prefix="tu_agent_fork_")
+    try:
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        out_cap = BoundedCapture(max_output_bytes)
+        err_cap = BoundedCapture(max_output_bytes)
+        streams = {out_r: out_cap, err_r: err_cap}
+        t0 = time.time()
+        pid = os.fork()
+        if pid == 0:
+            os.close(out_r)
+            os.close(err_r)
+            _child(root, args, out_w, err_w, os.path.join(scratch, "pycache"), proto_fd, limits)
+        os.close(out_w)
+        os.close(err_w)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+
+        try:
+            reaped = _wait(pid, timeout_ms / 1000.0, streams)
+            timed_out = reaped is None
+            # kills whatever the tests left running in the group, so the pipes reach EOF
+            _killpg(pid)
+            if timed_out:
+                _, status, ru = os.wait4(pid, 0)
+            else:
+                status, ru = reaped
+        finally:
+            _drain(streams)
+        duration_s = time.time() - t0
+
+        exited = os.WIFEXITED(status)
+        exit_code = os.WEXITSTATUS(status) if exited else 1
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        "ok": exited and exit_code == 0 and not timed_out,
+        "exit_code": exit_code,
+        "duration_s": duration_s,
+        "stdout": out_cap.getvalue().decode("utf-8", errors="replace"),
+        "stderr": err_cap.getvalue().decode("utf-8", errors="replace"),
+        "timed_out": timed_out,
+        "killed": timed_out,
+        "command": command,
+        "truncated": out_cap.truncated or err_cap.truncated,
+        "stdout_bytes": out_cap.total,
+        "stderr_bytes": err_cap.total,
+        "rusage": asdict(ResourceUsage.from_rusage(ru)),
+    }
+
+def serve():
+    # Keep the protocol on a private fd; anything else printing to stdout
+    # (here or in a forked child) must not corrupt it.
+    proto_fd = os.dup(1)
+    os.dup2(2, 1)
+    proto = os.fdopen(proto_fd, "wb")
+    _warm_imports()
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            out = handle(json.loads(line), proto_fd)
+        except Exception as e:
+            out = {"ok": False, "exit_code": 1, "duration_s": 0.0, "stdout": "", "stderr": f"{type(e).__name__}: {e}",
+                   "timed_out": False, "killed": False, "command": []}
+        proto.write((json.dumps(out) + "\n").encode("utf-8"))
+        proto.flush()
+
+class _Server:
+    def __init__(self, python: str):
+        pkg_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = pkg_parent + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+        self.proc = subprocess.Popen(
+            [python, "-m", "tu_agent.runner.fork_server"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=pkg_parent,
+            env=env,
+        )
+
+    def request(self, req: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            self.proc.stdin.write((json.dumps(req) + "\n").encode("utf-8"))
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline()
+        except (BrokenPipeError, OSError, ValueError):
+            return None
+        if not reply:
+            return None
+        try:
+            return json.loads(reply)
+        except json.JSONDecodeError:
+            return None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+class PytestForkServer:
+    """Client for warm pytest fork-servers.
+
+    Each in-flight request holds one server process; servers are started on
+    demand and reused, so concurrent callers (e.g. a vectorized env) each get
+    their own. This is an execution backend, not a sandbox on its own: it
+    applies the Rust runner's rlimits and timeout, nothing more.
+    """
+
+    def __init__(self, python: str = sys.executable, max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES,
+                 limits: ResourceLimits=ResourceLimits()):
+        self.python = python
+        self.max_output_bytes = max_output_bytes
+        self.limits = limits
+        self._idle: List[_Server] = []
+        self._all: List[_Server] = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> _Server:
+        with self._lock:
+            while self._idle:
+                s = self._idle.pop()
+                if s.proc.poll() is None:
+                    return s
+                self._all.remove(s)
+            s = _Server(self.python)
+            self._all.append(s)
+            return s
+
+    def _release(self, s: _Server, healthy: bool):
+        with self._lock:
+            if healthy and s.proc.poll() is None:
+                self._idle.append(s)
+                return
+            if s in self._all:
+                self._all.remove(s)
+        s.close()
+
+    def pytest(self, root: str, timeout_ms: int=20_000, args: Optional[List[str]]=None) -> RunResult:
+        """Like `pytest -q` plus `args`, as with the Rust runner's pytest op."""
+        s = self._acquire()
+        payload = s.request({"root": os.path.abspath(root), "args": PYTEST_ARGS + list(args or []), "timeout_ms": timeout_ms,
+                              "max_output_bytes": self.max_output_bytes, **self.limits.request_fields()})
+        self._release(s, payload is not None)
+        if payload is None:
+            return RunResult(False, 1, 0.0, "", "pytest fork-server died", {"fork_server": True})
+        rr = _result_from_payload(payload, 1, "", "")
+        rr.meta["fork_server"] = True
+        return rr
+
+    def close(self):
+        with self._lock:
+            servers = list(self._all)
+            self._all.clear()
+            self._idle.clear()
+        for s in servers:
+            s.close()
+
+if __name__ == "__main__":
+    serve()
@@ -2,70 +2,208 @@ from __future__ import annotations
 import json
 import os
 import subprocess
+import tempfile
+import threading
+import time
 from dataclasses import asdict
 from typing import List, Optional, Dict, Any
-from .types import RunResult
+from .types import RunResult, ResourceLimits, ResourceUsage
+from .capture import DEFAULT_MAX_OUTPUT_BYTES
+from tu_agent.utils import trace
+
+def _result_from_payload(payload: Any, returncode: int, stdout: str, stderr: str) -> RunResult:
+    if isinstance(payload, dict) and "ok" in payload:
+        return RunResult(
+            ok=bool(payload.get("ok")),
+            exit_code=int(payload.get("exit_code", returncode)),
+            duration_s=float(payload.get("duration_s", 0.0)),
+            stdout=str(payload.get("stdout", "")),
+            stderr=str(payload.get("stderr", "")),
+            meta={k:v for k,v in payload.items() if k not in {"ok","exit_code","duration_s","stdout","stderr","rusage"}},
+            rusage=ResourceUsage.from_json(payload.get("rusage")),
+        )
+
+    return RunResult(
+        ok=(returncode == 0),
+        exit_code=returncode,
+        duration_s=0.0,
+        stdout=stdout,
+        stderr=stderr,
+        meta={"raw": True},
+    )
+
+class _ServeConnection:
+    """One long-lived `sandbox_runner --root <root> serve` process (JSON lines over stdio)."""
+
+    def __init__(self, runner_path: str, root: str, timeout_ms: int):
+        self.root = root
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(
+            [runner_path, "--root", root, "--timeout-ms", str(timeout_ms), "serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def request(self, req: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Returns the decoded `RunnerOutput`, or None if the server is gone."""
+        line = (json.dumps(req) + "\n").encode("utf-8")
+        with self.lock:
+            try:
+                with trace.span("rust.serve.roundtrip"):
+                    self.proc.stdin.write(line)
+                    self.proc.stdin.flush()
+                    reply = self.proc.stdout.readline()
+            except (BrokenPipeError, OSError, ValueError):
+                return None
+        if not reply:
+            return None
+        try:
+            with trace.span("rust.decode"):
+                payload = json.loads(reply)
+        except json.JSONDecodeError:
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+# requests safe to replay through a one-shot runner when the serve process dies mid-request
+RETRY_OPS = ("run", "pytest", "read-file")
+
+def serve_died(op: str, duration_s: float) -> RunResult:
+    """The result of a request the serve process died on and that isn't safe to replay (e.g. a half-applied patch)."""
+    return RunResult(False, 1, duration_s, "", f"sandbox_runner serve exited during {op}; not retried (the workspace may be partly changed)",
+                     {"serve_died": True})
 
 class RustSandboxRunner:
     """Thin wrapper around the Rust `sandbox_runner` CLI.
 
     It expects a binary at `runner_path`. By default we look in the repo
     at: rust/sandbox_runner/target/release/sandbox_runner
+
+    With `persistent=True` each workspace root gets one long-lived
+    `sandbox_runner serve` process, so a tool call costs one JSON round trip
+    instead of a runner spawn. If a server cannot be reached the call falls
+    back to a one-shot invocation. A server that dies mid-request is only
+    replayed that way for `RETRY_OPS`; an `apply_diff` gets an error result
+    instead, since the patch may already be partly written. Call
+    `close(root)` when a workspace goes away.
     """
 
-    def __init__(self, runner_path: str):
+    def __init__(self, runner_path: str, persistent: bool=False, max_output_bytes: int=DEFAULT_MAX_OUTPUT_BYTES,
+                 limits: ResourceLimits=ResourceLimits()):
         self.runner_path = runner_path
+        self.persistent = persistent
+        self.max_output_bytes = max_output_bytes
+        self.limits = limits
+        self._servers: Dict[str, _ServeConnection] = {}
+        self._servers_lock = threading.Lock()
 
     def _call(self, args: List[str], root: str, timeout_ms: int, stdin: Optional[str]=None) -> RunResult:
-        cmd = [self.runner_path] + args + ["--root", root, "--timeout-ms", str(timeout_ms)]
+        # Global options must precede the subcommand (and `run --` swallows everything after it).
+        cmd = [self.runner_path, "--root", root, "--timeout-ms", str(timeout_ms), "--max-output-bytes", str(self.max_output_bytes)] + self.limits.cli_args() + args
+        t0 = time.perf_counter()
         try:
-            p = subprocess.run(
-                cmd,
-                input=stdin.encode("utf-8") if stdin is not None else None,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=False,
-            )
+            with trace.span("rust.spawn"):
+                p = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
         except FileNotFoundError as e:
             raise RuntimeError(f"Rust runner not found at: {self.runner_path}. Build it with cargo.") from e
+        with trace.span("rust.wait"):
+            out, err = p.communicate(stdin.encode("utf-8") if stdin is not None else None)
 
         # The runner prints JSON on stdout; if it fails, keep raw.
-        stdout = p.stdout.decode("utf-8", errors="replace")
-        stderr = p.stderr.decode("utf-8", errors="replace")
+        with trace.span("rust.decode"):
+            stdout = out.decode("utf-8", errors="replace")
+            stderr = err.decode("utf-8", errors="replace")
+            try:
+                payload = json.loads(stdout) if stdout.strip().startswith("{") else None
+            except json.JSONDecodeError:
+                payload = None
 
-        try:
-            payload = json.loads(stdout) if stdout.strip().startswith("{") else None
-        except json.JSONDecodeError:
-            payload = None
-
-        if isinstance(payload, dict) and "ok" in payload:
-            return RunResult(
-                ok=bool(payload.get("ok")),
-                exit_code=int(payload.get("exit_code", p.returncode)),
-                duration_s=float(payload.get("duration_s", 0.0)),
-                stdout=str(payload.get("stdout", "")),
-                stderr=str(payload.get("stderr", "")),
-                meta={k:v for k,v in payload.items() if k not in {"ok","exit_code","duration_s","stdout","stderr"}},
-            )
+        rr = _result_from_payload(payload, p.returncode, stdout, stderr)
+        if trace.enabled():
+            # what the call cost beyond the child's own runtime (spawn, pipes, JSON)
+            trace.observe("rust.overhead", time.perf_counter() - t0 - rr.duration_s)
+        return rr
 
-        return RunResult(
-            ok=(p.returncode == 0),
-            exit_code=p.returncode,
-            duration_s=0.0,
-            stdout=stdout,
-            stderr=stderr,
-            meta={"raw": True},
-        )
+    def _server(self, root: str, timeout_ms: int) -> _ServeConnection:
+        with self._servers_lock:
+            conn = self._servers.get(root)
+            if conn is None or conn.proc.poll() is not None:
+                try:
+                    conn = _ServeConnection(self.runner_path, root, timeout_ms)
+                except FileNotFoundError as e:
+                    raise RuntimeError(f"Rust runner not found at: {self.runner_path}. Build it with cargo.") from e
+                self._servers[root] = conn
+            return conn
+
+    def _request(self, req: Dict[str, Any], args: List[str], root: str, timeout_ms: int, stdin: Optional[str]=None) -> RunResult:
+        if self.persistent:
+            conn = self._server(root, timeout_ms)
+            t0 = time.perf_counter()
+            payload = conn.request(dict(req, timeout_ms=timeout_ms, max_output_bytes=self.max_output_bytes, **self.limits.request_fields()))
+            if payload is not None:
+                rr = _result_from_payload(payload, 1, "", "")
+                if trace.enabled():
+                    trace.observe("rust.overhead", time.perf_counter() - t0 - rr.duration_s)
+                return rr
+            self.close(root)
+            if req["op"] not in RETRY_OPS:
+                return serve_died(req["op"], time.perf_counter() - t0)
+        return self._call(args, root=root, timeout_ms=timeout_ms, stdin=stdin)
+
+    def close(self, root: Optional[str]=None):
+        """Shut down the serve process for `root` (all of them if None)."""
+        with self._servers_lock:
+            if root is None:
+                conns = list(self._servers.values())
+                self._servers.clear()
+            else:
+                conn = self._servers.pop(root, None)
+                conns = [conn] if conn is not None else []
+        for conn in conns:
+            conn.close()
 
     def run_cmd(self, cmd: List[str], root: str, timeout_ms: int=10_000) -> RunResult:
-        return self._call(["run", "--"] + cmd, root=root, timeout_ms=timeout_ms)
+        return self._request({"op": "run", "argv": cmd}, ["run", "--"] + cmd, root=root, timeout_ms=timeout_ms)
+
+    def pytest(self, root: str, timeout_ms: int=20_000, args: Optional[List[str]]=None, shards: int=1,
+               durations: Optional[Dict[str, float]]=None) -> RunResult:
+        """`python -m pytest -q` plus `args` (test selection, report options).
 
-    def pytest(self, root: str, timeout_ms: int=20_000) -> RunResult:
-        return self._call(["pytest"], root=root, timeout_ms=timeout_ms)
+        With `shards > 1` the runner splits the tests across that many
+        processes, balanced by `durations` ({nodeid: seconds}); see `sharding.py`.
+        """
+        args = list(args or [])
+        if shards <= 1:
+            return self._request({"op": "pytest", "args": args}, ["pytest", "--"] + args if args else ["pytest"], root=root, timeout_ms=timeout_ms)
+        # inline when serving, from a file in one-shot mode
+        fd, path = tempfile.mkstemp(prefix="tu_agent_durations_", suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(durations or {}, f)
+            return self._request({"op": "pytest", "args": args, "shards": shards, "durations": durations or {}},
+                                 ["pytest", "--shards", str(shards), "--durations", path, "--"] + args, root=root, timeout_ms=timeout_ms)
+        finally:
+            os.remove(path)
 
     def read_file(self, path: str, root: str, timeout_ms: int=5_000) -> RunResult:
-        return self._call(["read-file", "--path", path], root=root, timeout_ms=timeout_ms)
+        return self._request({"op": "read-file", "path": path}, ["read-file", "--path", path], root=root, timeout_ms=timeout_ms)
 
     def apply_diff(self, unified_diff: str, root: str, timeout_ms: int=5_000) -> RunResult:
-        # patch is read from stdin
-        return self._call(["apply-diff"], root=root, timeout_ms=timeout_ms, stdin=unified_diff)
+        # patch is read from stdin in one-shot mode, sent inline when serving
+        return self._request({"op": "apply-diff", "patch": unified_diff}, ["apply-diff"], root=root, timeout_ms=timeout_ms, stdin=unified_diff)
@@ -0,0 +1,229 @@
+"""Admission control for sandboxed child processes.
+
+Every runner call that starts (or talks to) a sandboxed process first takes
+a slot from a `SandboxScheduler`. Heavy tools (`pytest`, `run`) share
+`max_concurrent` slots (by default one per usable core). Their summed
+RLIMIT_AS must also fit a memory budget (by default MemTotal). Cheap tools
+(`read_file`, `apply_diff`) get a separate fast lane of `fast_lane` extra
+slots (`FAST_LANE` by default), so they never queue behind a running test
+suite; at most `max_concurrent + fast_lane` processes run at once. Waiters
+are served by tool priority, FIFO within a priority.
+
+A call that starts several processes at once (a sharded pytest run) asks
+for that many slots, and as much memory, in one admission.
+
+Runners use the process-wide `default_scheduler()` unless given their own,
+so every env in a process draws from the same budget.
+"""
+from __future__ import annotations
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional
+
+from .types import ResourceLimits
+from tu_agent.utils.stats import summarize
+
+# Lower runs first.
+TOOL_PRIORITY = {"read_file": 0, "apply_diff": 0, "run": 1, "pytest": 2}
+CHEAP_TOOLS = {"read_file", "apply_diff"}
+# Extra slots for CHEAP_TOOLS on top of max_concurrent; short-lived, so a few suffice.
+FAST_LANE = 2
+
+def usable_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+def _mem_total_mb() -> Optional[int]:
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class _Waiter:
+    __slots__ = ("tool", "heavy", "procs", "mem_mb", "t0", "wait_s", "admitted", "notify")
+
+    def __init__(self, tool: str, mem_mb: int, procs: int=1):
+        self.tool = tool
+        self.heavy = tool not in CHEAP_TOOLS
+        self.procs = max(1, procs) if self.heavy else 1
+        self.mem_mb = mem_mb * self.procs if self.heavy else 0
+        self.t0 = time.perf_counter()
+        self.wait_s = 0.0
+        self.admitted = False
+        self.notify: Optional[Callable[[], None]] = None
+
+class SandboxScheduler:
+    """Caps concurrent sandboxed processes by core count and memory budget, cheapest tools first."""
+
+    def __init__(
+        self,
+        max_concurrent: Optional[int]=None,
+        slots_per_core: float=1.0,
+        mem_budget_mb: Optional[int]=None,
+        fast_lane: Optional[int]=None,
+        wait_window: int=4096,
+    ):
+        self.max_concurrent = max_concurrent or max(1, int(usable_cpus() * slots_per_core))
+        self.mem_budget_mb = mem_budget_mb if mem_budget_mb is not None else _mem_total_mb()
+        self.fast_lane = fast_lane or FAST_LANE
+        self._lock = threading.Lock()
+        self._queues: Dict[int, Deque[_Waiter]] = {}
+        self._running = 0
+        self._running_cheap = 0
+        self._mem_in_use = 0
+        self._admitted: Dict[str, int] = {}
+        self._waits: Dict[str, Deque[float]] = {}
+        self._wait_window = wait_window
+        self.max_queue_depth = 0
+
+    def _fits(self, w: _Waiter) -> bool:
+        if not w.heavy:
+            return self._running_cheap < self.fast_lane
+        # a request bigger than the whole budget (slots or memory) still runs, alone
+        if self._running and self._running + w.procs > self.max_concurrent:
+            return False
+        if self.mem_budget_mb and self._running and self._mem_in_use + w.mem_mb > self.mem_budget_mb:
+            return False
+        return True
+
+    def _admit(self, w: _Waiter):
+        w.admitted = True
+        w.wait_s = time.perf_counter() - w.t0
+        if w.heavy:
+            self._running += w.procs
+            self._mem_in_use += w.mem_mb
+        else:
+            self._running_cheap += 1
+        self._admitted[w.tool] = self._admitted.get(w.tool, 0) + 1
+        self._waits.setdefault(w.tool, deque(maxlen=self._wait_window)).append(w.wait_s)
+
+    def _dispatch(self):
+        heavy_blocked = False
+        for prio in sorted(self._queues):
+            q = self._queues[prio]
+            while q:
+                w = q[0]
+                if w.heavy and heavy_blocked:
+                    break
+                if not self._fits(w):
+                    heavy_blocked = heavy_blocked or w.heavy
+                    break
+                q.popleft()
+                self._admit(w)
+                if w.notify is not None:
+                    w.notify()
+
+    def _enqueue(self, tool: str, limits: Optional[ResourceLimits], notify_factory: Callable[[_Waiter], Callable[[], None]],
+                 procs: int=1) -> _Waiter:
+        w = _Waiter(tool, (limits or ResourceLimits()).mem_mb, procs)
+        with self._lock:
+            prio = TOOL_PRIORITY.get(tool, 1)
+            q = self._queues.setdefault(prio, deque())
+            if not any(self._queues.values()) and self._fits(w):
+                self._admit(w)
+                return w
+            w.notify = notify_factory(w)
+            q.append(w)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+            self._dispatch()
+        return w
+
+    def _release(self, w: _Waiter):
+        with self._lock:
+            if w.heavy:
+                self._running -= w.procs
+                self._mem_in_use -= w.mem_mb
+            else:
+                self._running_cheap -= 1
+            self._dispatch()
+
+    def _withdraw(self, w: _Waiter) -> bool:
+        """Drop a waiter that gave up; returns True if it had been admitted meanwhile."""
+        with self._lock:
+            if w.admitted:
+                return True
+            q = self._queues.get(TOOL_PRIORITY.get(w.tool, 1))
+            if q is not None and w in q:
+                q.remove(w)
+            self._dispatch()
+            return False
+
+    @contextmanager
+    def slot(self, tool: str, limits: Optional[ResourceLimits]=None, procs: int=1) -> Iterator[float]:
+        """Blocks until `tool` may start `procs` processes; yields the time spent waiting, in seconds."""
+        event = threading.Event()
+        w = self._enqueue(tool, limits, lambda _w: event.set, procs)
+        if not w.admitted:
+            try:
+                event.wait()
+            except BaseException:
+                if self._withdraw(w):
+                    self._release(w)
+                raise
+        try:
+            yield w.wait_s
+        finally:
+            self._release(w)
+
+    @asynccontextmanager
+    async def aslot(self, tool: str, limits: Optional[ResourceLimits]=None, procs: int=1) -> AsyncIterator[float]:
+        """asyncio version of `slot`; grants may come from other threads."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def notify_factory(_w: _Waiter) -> Callable[[], None]:
+            def notify():
+                loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+            return notify
+
+        w = self._enqueue(tool, limits, notify_factory, procs)
+        if not w.admitted:
+            try:
+                await fut
+            except BaseException:
+                if self._withdraw(w):
+                    self._release(w)
+                raise
+        try:
+            yield w.wait_s
+        finally:
+            self._release(w)
+
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "fast_lane": self.fast_lane,
+                "mem_budget_mb": self.mem_budget_mb,
+                "running": self._running,
+                "running_cheap": self._running_cheap,
+                "mem_in_use_mb": self._mem_in_use,
+                "queue_depth": self.queue_depth(),
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": dict(self._admitted),
+                "wait_s": {tool: summarize(ws) for tool, ws in self._waits.items()},
+            }
+
+_default: Optional[SandboxScheduler] = None
+_default_lock = threading.Lock()
+
+def default_scheduler() -> SandboxScheduler:
+    """The process-wide scheduler runners share unless given their own."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SandboxScheduler()
+        return _default
@@ -0,0 +1,214 @@
+"""One pytest action split across several concurrent pytest processes.
+
+`AutoRunner.pytest(..., shards=N)` collects node ids once
+(`pytest --collect-only -q`) and assigns them to at most N shards,
+longest first, using the durations of earlier runs (`TestDurations`). Each
+shard runs the pytest command with its test paths replaced by the shard's
+own node ids, so it only collects its own tests, and argv doesn't grow with
+the rest of the suite. Collection already applied the user's selection
+(paths, `-k`, `-m`), and the other options stay as given. Past
+`ARGFILE_BYTES` the ids go in an `@argfile` (pytest >= 8.2). The shard outputs are
+merged under one pytest-style summary line, which `pytest_pass_rate` reads
+like any other run. The per-shard JUnit reports merge into one `TestReport`.
+
+The Rust runner does the same itself (`sandbox_runner pytest --shards N`,
+see `shard.rs`). These are the helpers for the other backends, and they
+produce the same merged output.
+"""
+from __future__ import annotations
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from .types import RunResult
+from .test_report import TestReport, parse_junit_xml
+from tu_agent.utils.text import SUMMARY_LINE_RE, SUMMARY_ITEM_RE
+
+# pytest options whose value is the next argument, so it isn't taken for a test path
+VALUE_OPTIONS = frozenset([
+    "-k", "-m", "-p", "-o", "-c", "-W", "-r", "-n", "--deselect", "--ignore", "--ignore-glob", "--rootdir",
+    "--basetemp", "--confcutdir", "--junitxml", "--junit-xml", "--junit-prefix", "--durations", "--durations-min",
+    "--maxfail", "--tb", "--import-mode", "--override-ini", "--log-level", "--log-file", "--log-cli-level",
+])
+# node ids (bytes, one per line) a shard takes on its command line before they move to an @argfile
+ARGFILE_BYTES = 32 * 1024
+
+# order of the merged summary line, as pytest prints it
+_SUMMARY_ORDER = ["failed", "passed", "skipped", "xfailed", "xpassed", "error", "warning"]
+
+class TestDurations:
+    """Per-nodeid test durations (seconds) from earlier runs, as an exponential moving average."""
+
+    __test__ = False
+
+    def __init__(self, alpha: float=0.5):
+        self.alpha = alpha
+        self._d: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def update(self, report: TestReport):
+        with self._lock:
+            for t in report.tests.values():
+                prev = self._d.get(t.nodeid)
+                self._d[t.nodeid] = t.duration_s if prev is None else prev + self.alpha * (t.duration_s - prev)
+
+    def lookup(self, ids: Optional[Iterable[str]]=None) -> Dict[str, float]:
+        with self._lock:
+            if ids is None:
+                return dict(self._d)
+            return {i: self._d[i] for i in ids if i in self._d}
+
+def collect_args(args: List[str]) -> List[str]:
+    # a report option would only write an empty report
+    return [a for a in args if not a.startswith("--junitxml")] + ["--collect-only"]
+
+def collected_ids(stdout: str) -> List[str]:
+    """Node ids from `pytest --collect-only -q` output (one per line, up to the first blank line)."""
+    ids = []
+    for line in stdout.splitlines():
+        if not line.strip():
+            break
+        if "::" in line and not line[0].isspace():
+            ids.append(line.rstrip())
+    return ids
+
+def split_shards(ids: List[str], n: int, durations: Dict[str, float]) -> List[List[str]]:
+    """Longest-processing-time-first assignment of `ids` to at most `n` shards.
+
+    Tests without a known duration count as the mean of the known ones (1s if
+    none are known). Ties go to the lower shard, so the split is deterministic.
+    """
+    n = max(1, min(n, len(ids)))
+    known = [durations[i] for i in ids if i in durations]
+    default = sum(known) / len(known) if known else 1.0
+    order = sorted(range(len(ids)), key=lambda i: (-durations.get(ids[i], default), i))
+    load = [0.0] * n
+    shards: List[List[int]] = [[] for _ in range(n)]
+    for i in order:
+        k = min(range(n), key=lambda j: (load[j], j))
+        load[k] += durations.get(ids[i], default)
+        shards[k].append(i)
+    # keep collection order within a shard
+    return [[ids[i] for i in sorted(s)] for s in shards]
+
+def plan_shards(collect: RunResult, n: int, durations: TestDurations) -> Optional[List[List[str]]]:
+    """The split for a collection run; None if there is nothing to split or collection failed."""
+    ids = collected_ids(collect.stdout) if collect.ok else []
+    if len(ids) < 2:
+        return None
+    return split_shards(ids, n, durations.lookup(ids))
+
+def without_test_paths(args: List[str], root: str) -> List[str]:
+    """`args` minus the test paths / node ids in it (those that exist under `root` and aren't an option's value)."""
+    out: List[str] = []
+    prev = ""
+    for a in args:
+        if prev not in VALUE_OPTIONS and not a.startswith("-") and os.path.exists(os.path.join(root, a.split("::", 1)[0])):
+            prev = a
+            continue
+        out.append(a)
+        prev = a
+    return out
+
+def shard_args(args: List[str], ids: List[str], root: str, argfile: str) -> List[str]:
+    """`args` for a shard running just `ids`; writes `argfile` when the ids are too long for argv."""
+    out = without_test_paths(args, root)
+    if sum(len(i) + 1 for i in ids) <= ARGFILE_BYTES:
+        return out + ids
+    with open(argfile, "w", encoding="utf-8") as f:
+        f.write("".join(i + "\n" for i in ids))
+    return out + ["@" + argfile]
+
+def take_summary(stdout: str) -> Tuple[str, Dict[str, int]]:
+    """Drops pytest's summary line from one shard's output and returns its counts."""
+    kept: List[str] = []
+    counts: Dict[str, int] = {}
+    for line in stdout.splitlines():
+        m = SUMMARY_LINE_RE.match(line.strip())
+        if m is None:
+            kept.append(line)
+            continue
+        counts = {}
+        for item in SUMMARY_ITEM_RE.finditer(m.group("body")):
+            what = item.group("what")
+            what = what[:-1] if what in ("errors", "warnings") else what
+            counts[what] = counts.get(what, 0) + int(item.group("n"))
+    return "".join(line + "\n" for line in kept), counts
+
+def summary_line(counts: Dict[str, int], secs: float) -> str:
+    """A pytest-style final summary line for merged counts."""
+    rank = {w: i for i, w in enumerate(_SUMMARY_ORDER)}
+    items = sorted(((w, n) for w, n in counts.items() if n > 0), key=lambda kv: (rank.get(kv[0], len(rank)), kv[0]))
+    if not items:
+        return f"no tests ran in {secs:.2f}s"
+    body = ", ".join(f"{n} {w}s" if w in ("error", "warning") and n > 1 else f"{n} {w}" for w, n in items)
+    return f"{body} in {secs:.2f}s"
+
+def merge_shards(parts: List[List[str]], results: List[RunResult], collect: RunResult, duration_s: float) -> RunResult:
+    """One RunResult for a sharded run, shaped like the Rust runner's merged output."""
+    stdout: List[str] = []
+    stderr: List[str] = []
+    counts: Dict[str, int] = {}
+    summarized = False
+    rusage = collect.rusage
+    for k, rr in enumerate(results):
+        body, c = take_summary(rr.stdout)
+        if "pytest_summary" in rr.meta:
+            # streamed from the untruncated output, so preferred
+            c = dict(rr.meta["pytest_summary"])
+        summarized = summarized or bool(c)
+        # selection happened at collection; a shard's deselections aren't results
+        for w, x in c.items():
+            if w != "deselected":
+                counts[w] = counts.get(w, 0) + x
+        stdout.append(f"==== shard {k + 1}/{len(results)}: {len(parts[k])} tests ====\n" + body)
+        if rr.stderr:
+            stderr.append(rr.stderr if rr.stderr.endswith("\n") else rr.stderr + "\n")
+        if rr.rusage is not None:
+            rusage = rr.rusage if rusage is None else rusage + rr.rusage
+    if summarized:
+        stdout.append(summary_line(counts, duration_s) + "\n")
+    meta = {k: v for k, v in results[0].meta.items() if k in ("fallback", "fork_server")}
+    meta.update(
+        timed_out=any(rr.meta.get("timed_out", False) for rr in results),
+        truncated=any(rr.meta.get("truncated", False) for rr in results),
+        stdout_bytes=sum(rr.meta.get("stdout_bytes", 0) for rr in results),
+        stderr_bytes=sum(rr.meta.get("stderr_bytes", 0) for rr in results),
+        shards=[{"tests": len(p), "exit_code": rr.exit_code, "duration_s": rr.duration_s, "timed_out": rr.meta.get("timed_out", False)}
+                for p, rr in zip(parts, results)],
+    )
+    if summarized:
+        meta["pytest_summary"] = counts
+    return RunResult(
+        ok=all(rr.ok for rr in results),
+        exit_code=max(rr.exit_code for rr in results),
+        duration_s=duration_s,
+        stdout="".join(stdout),
+        stderr="".join(stderr),
+        meta=meta,
+        rusage=rusage,
+    )
+
+def load_reports(paths: Iterable[Optional[str]]) -> Optional[TestReport]:
+    """The JUnit reports at `paths` merged into one; None if none could be read."""
+    merged: Optional[TestReport] = None
+    for path in paths:
+        if not path:
+            continue
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if not data:
+                continue
+            report = parse_junit_xml(data)
+        except (OSError, ValueError):
+            # ET.ParseError is a ValueError: half-written report
+            continue
+        if merged is None:
+            merged = report
+        else:
+            for t in report.tests.values():
+                merged.add(t)
+    return merged
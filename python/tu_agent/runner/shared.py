@@ -0,0 +1,114 @@
+"""Backend logic shared by `AutoRunner` and `AsyncAutoRunner`.
+
+In-process steps (`native_apply`, `fallback_read_file`) are plain functions.
+Steps that run child processes are generators that yield what to run and
+are sent the results, like the env's tool steps. The sync runner drives
+them with threads and the async one with `asyncio.gather`, so the two only
+differ in how a call is made.
+
+`pytest_steps` yields batches of `(pytest args, shards)` to run
+concurrently; `shards > 1` asks the Rust runner to shard the run itself.
+`fallback_apply` yields one command at a time.
+"""
+from __future__ import annotations
+import os
+import tempfile
+import time
+from dataclasses import asdict
+from typing import Generator, List, Optional, Tuple
+from .types import RunResult
+from .test_report import junit_args
+from .sharding import TestDurations, collect_args, load_reports, merge_shards, plan_shards, shard_args
+from tu_agent.utils import trace
+from tu_agent.utils.diff import PatchSet, PatchError, parse_unified_diff, apply_patch
+
+PytestCall = Tuple[List[str], int]
+PytestSteps = Generator[List[PytestCall], List[RunResult], RunResult]
+
+def pytest_steps(args: List[str], root: str, report: bool, shards: int, durations: TestDurations,
+                 rust_shards: bool) -> PytestSteps:
+    """`pytest(..., report=True)` and/or `shards > 1`; see `AutoRunner.pytest`.
+
+    With `rust_shards` the whole sharded run is one call (the Rust runner
+    collects and splits it); otherwise collection and the shards are
+    separate calls. Sharded runs feed `durations`.
+    """
+    with tempfile.TemporaryDirectory(prefix="tu_agent_pytest_") as tmp:
+        path = os.path.join(tmp, "junit.xml")
+        if shards <= 1:
+            (rr,) = yield [(args + junit_args(path), 1)]
+            paths = [path]
+        elif rust_shards:
+            (rr,) = yield [(args + junit_args(path), shards)]
+            paths = [s.get("junitxml") for s in rr.meta.get("shards") or []] or [path]
+        else:
+            t0 = time.time()
+            (collect,) = yield [(collect_args(args), 1)]
+            parts = plan_shards(collect, shards, durations)
+            if parts is None:
+                (rr,) = yield [(args + junit_args(path), 1)]
+                paths = [path]
+            else:
+                paths = [f"{path}.shard{k}" for k in range(len(parts))]
+                results = yield [(shard_args(args, parts[k], root, f"{paths[k]}.args") + junit_args(paths[k]), 1)
+                                  for k in range(len(parts))]
+                rr = merge_shards(parts, results, collect, time.time() - t0)
+        tests = load_reports(paths)
+    if tests is not None:
+        if shards > 1:
+            durations.update(tests)
+        if report:
+            rr.meta["tests"] = tests.to_json()
+    return rr
+
+def fallback_apply(unified_diff: str, root: str) -> Generator[List[str], RunResult, RunResult]:
+    """git apply, then patch if that fails, on a patch file written into `root`."""
+    patch_path = os.path.join(root, '.tu_agent_patch.diff')
+    with open(patch_path,'w',encoding='utf-8') as f:
+        f.write(unified_diff)
+    try:
+        res = yield ["git","apply","--unsafe-paths","--whitespace=nowarn", ".tu_agent_patch.diff"]
+        if not res.ok:
+            git_usage = res.rusage
+            res = yield ["patch","-p1","-i",".tu_agent_patch.diff"]
+            if git_usage is not None and res.rusage is not None:
+                # charge the failed git attempt too
+                res.rusage = git_usage + res.rusage
+        return res
+    finally:
+        try:
+            os.remove(patch_path)
+        except OSError:
+            pass
+
+@trace.traced("runner.apply_diff.native")
+def native_apply(unified_diff: str, root: str, parsed: Optional[PatchSet]) -> RunResult:
+    t0 = time.time()
+    meta = {"native_diff": True}
+    if parsed is None:
+        try:
+            parsed = parse_unified_diff(unified_diff)
+        except PatchError as e:
+            # the only case the callers hand to git apply / patch
+            meta["unparsed"] = True
+            return RunResult(False, 1, time.time()-t0, "", str(e), meta)
+    try:
+        res = apply_patch(parsed, root)
+    except (PatchError, OSError, UnicodeError) as e:
+        return RunResult(False, 1, time.time()-t0, "", str(e), meta)
+    meta.update(
+        files=res.files,
+        applied_hunks=[asdict(h) for h in res.applied],
+        rejected_hunks=[asdict(h) for h in res.rejected],
+    )
+    return RunResult(res.ok, 0 if res.ok else 1, time.time()-t0, "", res.message, meta)
+
+def fallback_read_file(path: str, root: str) -> RunResult:
+    abs_path = os.path.abspath(os.path.join(root, path))
+    if not abs_path.startswith(os.path.abspath(root) + os.sep):
+        return RunResult(False, 1, 0.0, "", "path escapes root", {"fallback": True})
+    try:
+        with open(abs_path,'r',encoding='utf-8') as f:
+            return RunResult(True,0,0.0,f.read(),"",{"fallback": True})
+    except Exception as e:
+        return RunResult(False,1,0.0,"",str(e),{"fallback": True})
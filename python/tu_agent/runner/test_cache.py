@@ -0,0 +1,124 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Dict, Any, List, Optional, Tuple
+from .types import RunResult, ResourceUsage
+
+# Not part of the workspace "state": build/test by-products and patch leftovers.
+IGNORED_DIRS = {"__pycache__", ".pytest_cache", ".git", ".mypy_cache", ".ruff_cache"}
+IGNORED_SUFFIXES = (".pyc", ".pyo", ".rej", ".orig", ".diff")
+
+def workspace_digest(root: str, command: List[str]) -> str:
+    """sha256 over the test command and every tracked file (path + contents) under `root`."""
+    h = hashlib.sha256()
+    h.update(json.dumps(command).encode("utf-8"))
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in IGNORED_DIRS]
+        for fn in filenames:
+            if fn.endswith(IGNORED_SUFFIXES):
+                continue
+            entries.append(os.path.relpath(os.path.join(dirpath, fn), root))
+    for rel in sorted(entries):
+        try:
+            with open(os.path.join(root, rel), "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        h.update(b"\0" + rel.replace(os.sep, "/").encode("utf-8") + b"\0")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+class TestResultCache:
+    """Content-addressed cache of pytest results keyed on workspace state.
+
+    Entries live in an in-memory LRU; with `disk_dir` they are also written
+    there (one JSON file per key, atomically renamed into place) so several
+    processes can share results. Safe to share between threads.
+    """
+
+    __test__ = False  # not a pytest test class
+
+    def __init__(self, max_entries: int=4096, disk_dir: Optional[str]=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self._mem: "OrderedDict[str, Tuple[RunResult, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def key(self, root: str, command: List[str]) -> str:
+        return workspace_digest(root, command)
+
+    def _disk_path(self, key: str) -> str:
+        assert self.disk_dir is not None
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _remember(self, key: str, entry: Tuple[RunResult, float]):
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Tuple[RunResult, float]]:
+        """Returns (RunResult, pass_rate) for a cached workspace state, else None."""
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                self._mem.move_to_end(key)
+        if entry is None and self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                    d = json.load(f)
+                res = dict(d["result"])
+                res["rusage"] = ResourceUsage.from_json(res.get("rusage"))
+                entry = (RunResult(**res), float(d["pass_rate"]))
+            except (OSError, ValueError, KeyError, TypeError):
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        rr, pass_rate = entry
+        return RunResult(rr.ok, rr.exit_code, rr.duration_s, rr.stdout, rr.stderr, dict(rr.meta, cached=True), rr.rusage), pass_rate
+
+    def put(self, key: str, rr: RunResult, pass_rate: float):
+        entry = (rr, pass_rate)
+        with self._lock:
+            self._remember(key, entry)
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"result": asdict(rr), "pass_rate": pass_rate}, f)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "entries": len(self._mem),
+            }
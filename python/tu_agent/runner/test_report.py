@@ -0,0 +1,117 @@
+"""Structured pytest results read back from a JUnit XML report.
+
+`AutoRunner.pytest(..., report=True)` asks pytest for
+`--junitxml=<tmp> -o junit_family=xunit1` (xunit1 keeps the `file`
+attribute) and stores the parsed outcomes in `RunResult.meta["tests"]` as
+`{nodeid: {"outcome", "duration_s", "file"}}`, which stays JSON-friendly for
+the test cache.
+"""
+from __future__ import annotations
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, asdict
+from typing import Dict, Any, Iterable, List, Optional
+from tu_agent.utils.trace import traced
+
+# Worst first: when pytest reports a nodeid twice (e.g. call passed, teardown errored), the worse one wins.
+OUTCOME_RANK = {"error": 0, "failed": 1, "passed": 2, "xfailed": 3, "skipped": 4}
+
+def junit_args(path: str) -> List[str]:
+    return [f"--junitxml={path}", "-o", "junit_family=xunit1"]
+
+@dataclass
+class TestOutcome:
+    __test__ = False  # not a pytest test class
+
+    nodeid: str
+    outcome: str  # passed | failed | error | skipped | xfailed
+    duration_s: float
+    file: str
+
+class TestReport:
+    """Per-test outcomes of one (possibly partial) pytest run."""
+
+    __test__ = False
+
+    def __init__(self, tests: Optional[Dict[str, TestOutcome]]=None):
+        self.tests: Dict[str, TestOutcome] = dict(tests or {})
+
+    def add(self, t: TestOutcome):
+        prev = self.tests.get(t.nodeid)
+        if prev is None or OUTCOME_RANK[t.outcome] < OUTCOME_RANK[prev.outcome]:
+            self.tests[t.nodeid] = t
+
+    @property
+    def files(self) -> List[str]:
+        return sorted({t.file for t in self.tests.values()})
+
+    @property
+    def collection_errors(self) -> List[str]:
+        """Files that failed to import (their nodeid is the file path itself)."""
+        return [t.nodeid for t in self.tests.values() if t.outcome == "error" and t.nodeid == t.file]
+
+    def counts(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for t in self.tests.values():
+            out[t.outcome] = out.get(t.outcome, 0) + 1
+        return out
+
+    @property
+    def pass_rate(self) -> float:
+        """passed / (passed + failed + error); skips and xfails don't count. -1.0 if nothing ran."""
+        c = self.counts()
+        total = c.get("passed", 0) + c.get("failed", 0) + c.get("error", 0)
+        return c.get("passed", 0) / total if total > 0 else -1.0
+
+    def pass_vector(self) -> Dict[str, bool]:
+        """nodeid -> passed, for tests with a pass/fail verdict, in nodeid order."""
+        return {k: self.tests[k].outcome == "passed" for k in sorted(self.tests)
+                if self.tests[k].outcome in ("passed", "failed", "error")}
+
+    def merged(self, rerun: "TestReport", files: Iterable[str]) -> "TestReport":
+        """This report with every test from `files` replaced by the results in `rerun`."""
+        files = set(files)
+        out = TestReport({k: t for k, t in self.tests.items() if t.file not in files})
+        for t in rerun.tests.values():
+            out.add(t)
+        return out
+
+    def to_json(self) -> Dict[str, Dict[str, Any]]:
+        return {k: {f: v for f, v in asdict(t).items() if f != "nodeid"} for k, t in self.tests.items()}
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Dict[str, Any]]) -> "TestReport":
+        return cls({k: TestOutcome(nodeid=k, outcome=v["outcome"], duration_s=float(v.get("duration_s", 0.0)), file=v.get("file", ""))
+                    for k, v in d.items()})
+
+def _nodeid(classname: str, name: str, file: str) -> str:
+    if not classname:
+        # collection failure: name is the dotted module, the nodeid is the file
+        return file or name
+    if not file:
+        return f"{classname}::{name}"
+    module = file[:-3].replace("/", ".") if file.endswith(".py") else file.replace("/", ".")
+    rest = classname[len(module) + 1:].split(".") if classname.startswith(module + ".") else []
+    return "::".join([file] + [c for c in rest if c] + [name])
+
+@traced("parse.junit_xml")
+def parse_junit_xml(data: bytes) -> TestReport:
+    """Parse pytest's JUnit XML (xunit1 family) into a TestReport."""
+    report = TestReport()
+    root = ET.fromstring(data)
+    for case in root.iter("testcase"):
+        file = (case.get("file") or "").replace("\\", "/")
+        nodeid = _nodeid(case.get("classname") or "", case.get("name") or "", file)
+        outcome = "passed"
+        for child in case:
+            if child.tag == "error":
+                outcome = "error"
+            elif child.tag == "failure":
+                outcome = "failed"
+            elif child.tag == "skipped":
+                outcome = "xfailed" if child.get("type") == "pytest.xfail" else "skipped"
+        try:
+            duration = float(case.get("time") or 0.0)
+        except ValueError:
+            duration = 0.0
+        report.add(TestOutcome(nodeid=nodeid, outcome=outcome, duration_s=duration, file=file or nodeid))
+    return report
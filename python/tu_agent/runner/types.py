@@ -1,6 +1,37 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from dataclasses import dataclass, fields
+from typing import Optional, Dict, Any, List
+
+@dataclass(frozen=True)
+class ResourceUsage:
+    """Kernel accounting (`wait4`) for a reaped child and the descendants it waited for."""
+    user_s: float = 0.0
+    sys_s: float = 0.0
+    max_rss_kb: int = 0
+    inblock: int = 0
+    oublock: int = 0
+    nvcsw: int = 0
+    nivcsw: int = 0
+
+    @property
+    def cpu_s(self) -> float:
+        return self.user_s + self.sys_s
+
+    @classmethod
+    def from_rusage(cls, ru: Any) -> "ResourceUsage":
+        """From a `resource.struct_rusage` (as returned by `os.wait4`); Linux reports ru_maxrss in KiB."""
+        return cls(ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_inblock, ru.ru_oublock, ru.ru_nvcsw, ru.ru_nivcsw)
+
+    @classmethod
+    def from_json(cls, d: Optional[Dict[str, Any]]) -> Optional["ResourceUsage"]:
+        if not isinstance(d, dict):
+            return None
+        return cls(**{f.name: type(f.default)(d.get(f.name, f.default)) for f in fields(cls)})
+
+    def __add__(self, o: "ResourceUsage") -> "ResourceUsage":
+        """Totals for two sequential commands (peak RSS is the larger peak)."""
+        return ResourceUsage(self.user_s + o.user_s, self.sys_s + o.sys_s, max(self.max_rss_kb, o.max_rss_kb),
+                             self.inblock + o.inblock, self.oublock + o.oublock, self.nvcsw + o.nvcsw, self.nivcsw + o.nivcsw)
 
 @dataclass
 class RunResult:
@@ -10,8 +41,24 @@ class RunResult:
     stdout: str
     stderr: str
     meta: Dict[str, Any]
+    # None when nothing was spawned (in-process ops, cache reuse) or the platform can't tell
+    rusage: Optional[ResourceUsage] = None
 
     @property
     def combined(self) -> str:
         return (self.stdout or "") + ("\n" if self.stdout and self.stderr else "") + (self.stderr or "")
 
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """rlimits applied to a sandboxed child; 0 leaves that limit unchanged."""
+    cpu_s: int = 2
+    mem_mb: int = 512
+    nofile: int = 256
+
+    def request_fields(self) -> Dict[str, Any]:
+        """Per-request overrides in the runner's serve protocol."""
+        return {"cpu_secs": self.cpu_s, "mem_mb": self.mem_mb, "nofile": self.nofile}
+
+    def cli_args(self) -> List[str]:
+        return ["--cpu-secs", str(self.cpu_s), "--mem-mb", str(self.mem_mb), "--nofile", str(self.nofile)]
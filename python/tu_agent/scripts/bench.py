@@ -0,0 +1,276 @@
+"""End-to-end benchmarks for the env and runner hot paths.
+
+Suites (`--suites`, all by default):
+- reset: `ToolUseCodingEnv.reset()` latency per task.
+- tools: apply_diff / pytest / read_file latency under each backend:
+  - `rust`: RustSandboxRunner driven through `serve`;
+  - `auto`: AutoRunner as the env uses it, with native diff and the
+    scheduler;
+  - `fallback`: AutoRunner without the Rust binary and without native diff.
+- agents: steps/s and per-step latency of the random and Q-learning agents
+  over every task.
+- scaling: random-agent steps/s of `VecToolUseCodingEnv` as the env count
+  doubles up to `--max-envs`.
+
+Results are written as JSON (`--out`). Latencies are in seconds, with
+percentiles from `utils.stats.summarize`. `--compare baseline.json` flags
+a result as a regression when its p50/p90 latency grows, or its steps/s
+drops, by more than `--threshold`. Any regression makes the exit status 1.
+`--current results.json` compares an existing results file instead of
+running the suites again.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from tu_agent.agents.q_learning import QLearningAgent, QLearnConfig
+from tu_agent.agents.random_agent import RandomAgent
+from tu_agent.env.task_loader import load_task
+from tu_agent.env.tool_env import ToolUseCodingEnv
+from tu_agent.env.vec_env import make_vec_env
+from tu_agent.runner.auto_runner import AutoRunner
+from tu_agent.runner.rust_runner import RustSandboxRunner
+from tu_agent.runner.scheduler import usable_cpus
+from tu_agent.utils.stats import summarize, time_calls
+
+SUITES = ("reset", "tools", "agents", "scaling")
+# metrics compared against a baseline: (key, True if higher is better)
+LATENCY_METRICS = (("p50", False), ("p90", False))
+THROUGHPUT_METRICS = (("steps_per_s", True),)
+
+Results = Dict[str, Dict[str, Any]]
+
+def latency(samples: List[float]) -> Dict[str, Any]:
+    return dict(summarize(samples), kind="latency")
+
+def throughput(steps: int, wall_s: float, step_times: List[float]) -> Dict[str, Any]:
+    return {"kind": "throughput", "steps": steps, "wall_s": wall_s,
+            "steps_per_s": steps / wall_s if wall_s > 0 else 0.0, "step_s": summarize(step_times)}
+
+def bench_reset(tasks_root: str, tasks: List[str], runner: AutoRunner, iters: int, warmup: int) -> Results:
+    out: Results = {}
+    for task in tasks:
+        env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=task)
+        try:
+            out[f"reset/{task}"] = latency(time_calls(env.reset, iters, warmup))
+        finally:
+            env.close()
+    return out
+
+def _applicable_patch(task_dir: str, workspace: str) -> Optional[str]:
+    """A candidate diff of the task that applies to its pristine files, if any."""
+    task = load_task(os.path.dirname(task_dir), os.path.basename(task_dir))
+    probe = AutoRunner("/nonexistent", native_diff=True)
+    for patch in task.patches:
+        scratch = tempfile.mkdtemp(prefix="tu_agent_bench_probe_")
+        try:
+            shutil.copytree(workspace, scratch, dirs_exist_ok=True)
+            if probe.apply_diff(patch["diff"], scratch).ok:
+                return patch["diff"]
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return None
+
+def bench_tools(tasks_root: str, task: str, runner_path: str, iters: int, warmup: int) -> Results:
+    task_dir = os.path.join(tasks_root, task)
+    root = tempfile.mkdtemp(prefix="tu_agent_bench_")
+    backends: Dict[str, Callable[[], Any]] = {
+        "fallback": lambda: AutoRunner("/nonexistent", native_diff=False),
+    }
+    if os.path.exists(runner_path):
+        backends["rust"] = lambda: RustSandboxRunner(runner_path, persistent=True)
+        backends["auto"] = lambda: AutoRunner(runner_path)
+    else:
+        print(f"note: {runner_path} not found; skipping the rust and auto backends", file=sys.stderr)
+    out: Results = {}
+    try:
+        shutil.copytree(task_dir, root, dirs_exist_ok=True)
+        diff = _applicable_patch(task_dir, root)
+        pristine = {}
+        for dirpath, _dirnames, filenames in os.walk(task_dir):
+            for fn in filenames:
+                p = os.path.join(dirpath, fn)
+                with open(p, "rb") as f:
+                    pristine[os.path.relpath(p, task_dir)] = f.read()
+
+        def restore():
+            for rel, data in pristine.items():
+                with open(os.path.join(root, rel), "wb") as f:
+                    f.write(data)
+
+        for name, make in backends.items():
+            r = make()
+            try:
+                if diff is not None:
+                    out[f"tools/{name}/apply_diff"] = latency(time_calls(lambda: r.apply_diff(diff, root), iters, warmup, setup=restore))
+                restore()
+                out[f"tools/{name}/read_file"] = latency(time_calls(lambda: r.read_file("src/solution.py", root), iters, warmup))
+                out[f"tools/{name}/pytest"] = latency(time_calls(lambda: r.pytest(root), iters, warmup))
+            finally:
+                r.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return out
+
+def _run_episodes(env: ToolUseCodingEnv, agent: Any, episodes: int) -> Dict[str, Any]:
+    step_times: List[float] = []
+    t0 = time.perf_counter()
+    for _ in range(episodes):
+        obs = env.reset()
+        done = False
+        while not done:
+            a = agent.act(obs)
+            s0 = time.perf_counter()
+            next_obs, r, done, _info = env.step(a)
+            step_times.append(time.perf_counter() - s0)
+            agent.observe(obs, a, r, next_obs, done)
+            obs = next_obs
+    return throughput(len(step_times), time.perf_counter() - t0, step_times)
+
+def bench_agents(tasks_root: str, tasks: List[str], runner: AutoRunner, episodes: int, max_steps: int) -> Results:
+    out: Results = {}
+    for task in tasks:
+        env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=task, max_steps=max_steps)
+        try:
+            action_size = env.reset()["action_size"]
+            agents = {
+                "random": RandomAgent(seed=0),
+                "qlearn": QLearningAgent(action_size=action_size, cfg=QLearnConfig(seed=0)),
+            }
+            for name, agent in agents.items():
+                out[f"agents/{name}/{task}"] = _run_episodes(env, agent, episodes)
+        finally:
+            env.close()
+    return out
+
+def bench_scaling(tasks_root: str, task: str, runner: AutoRunner, max_envs: int, steps_per_env: int, max_steps: int) -> Results:
+    out: Results = {}
+    n = 1
+    while n <= max_envs:
+        venv = make_vec_env(tasks_root, runner, task, num_envs=n, max_steps=max_steps)
+        try:
+            agent = RandomAgent(seed=0)
+            obs = venv.reset()
+            step_times: List[float] = []
+            t0 = time.perf_counter()
+            for _ in range(steps_per_env):
+                s0 = time.perf_counter()
+                obs, _r, _d, _i = venv.step([agent.act(o) for o in obs])
+                step_times.append(time.perf_counter() - s0)
+            res = throughput(n * steps_per_env, time.perf_counter() - t0, step_times)
+            res["num_envs"] = n
+            out[f"scaling/{n}"] = res
+        finally:
+            venv.close()
+        n *= 2
+    return out
+
+def compare(current: Results, baseline: Results, threshold: float) -> List[str]:
+    """One line per metric that got worse than `baseline` by more than `threshold` (a fraction)."""
+    regressions = []
+    for name, cur in sorted(current.items()):
+        base = baseline.get(name)
+        if base is None or base.get("kind") != cur.get("kind"):
+            continue
+        metrics = LATENCY_METRICS if cur["kind"] == "latency" else THROUGHPUT_METRICS
+        for key, higher_better in metrics:
+            b, c = base.get(key), cur.get(key)
+            if not b or c is None:
+                continue
+            change = (c - b) / b
+            if (-change if higher_better else change) > threshold:
+                regressions.append(f"{name} {key}: {b:.6g} -> {c:.6g} ({change:+.1%})")
+    return regressions
+
+def _fmt(name: str, r: Dict[str, Any]) -> str:
+    if r["kind"] == "latency":
+        return f"{name:<36}{r['p50']*1e3:10.2f}{r['p90']*1e3:10.2f}{r['p99']*1e3:10.2f} ms  (n={r['n']})"
+    return f"{name:<36}{r['steps_per_s']:10.1f} steps/s  step p50 {r['step_s']['p50']*1e3:.2f} ms  ({r['steps']} steps)"
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmarks for env reset, runner tools, agents and parallel scaling')
+    ap.add_argument('--runner', default=None, help='Path to sandbox_runner binary')
+    ap.add_argument('--suites', default=','.join(SUITES), help=f'Comma-separated subset of {",".join(SUITES)}')
+    ap.add_argument('--tasks', default=None, help='Comma-separated tasks (default: every tasks/bugfix_*)')
+    ap.add_argument('--iters', type=int, default=20, help='Timed calls per latency case')
+    ap.add_argument('--warmup', type=int, default=2)
+    ap.add_argument('--episodes', type=int, default=5, help='Episodes per agent and task')
+    ap.add_argument('--max-steps', type=int, default=10)
+    ap.add_argument('--max-envs', type=int, default=4, help='Largest env count in the scaling suite')
+    ap.add_argument('--scaling-steps', type=int, default=10, help='Vec steps per env count in the scaling suite')
+    ap.add_argument('--out', default=None, help='Write results JSON here')
+    ap.add_argument('--current', default=None, help='Compare this results JSON instead of running the suites')
+    ap.add_argument('--compare', default=None, help='Baseline results JSON to check for regressions')
+    ap.add_argument('--threshold', type=float, default=0.10, help='Relative slowdown flagged as a regression')
+    args = ap.parse_args()
+
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+    tasks_root = os.path.join(repo_root, 'tasks')
+    runner_path = args.runner or os.path.join(repo_root, 'rust', 'sandbox_runner', 'target', 'release', 'sandbox_runner')
+
+    if args.current:
+        with open(args.current, 'r', encoding='utf-8') as f:
+            doc = json.load(f)
+    else:
+        suites = [s for s in args.suites.split(',') if s]
+        unknown = set(suites) - set(SUITES)
+        if unknown:
+            raise SystemExit(f"unknown suites: {sorted(unknown)}")
+        tasks = args.tasks.split(',') if args.tasks else sorted(t for t in os.listdir(tasks_root) if t.startswith('bugfix_'))
+        runner = AutoRunner(runner_path)
+        results: Results = {}
+        try:
+            if 'reset' in suites:
+                results.update(bench_reset(tasks_root, tasks, runner, args.iters, args.warmup))
+            if 'tools' in suites:
+                for task in tasks[:1]:
+                    results.update(bench_tools(tasks_root, task, runner_path, args.iters, args.warmup))
+            if 'agents' in suites:
+                results.update(bench_agents(tasks_root, tasks, runner, args.episodes, args.max_steps))
+            if 'scaling' in suites:
+                results.update(bench_scaling(tasks_root, tasks[0], runner, args.max_envs, args.scaling_steps, args.max_steps))
+        finally:
+            runner.close()
+        doc = {
+            "meta": {
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": usable_cpus(),
+                "runner": runner_path if os.path.exists(runner_path) else None,
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        if args.out:
+            tmp = f"{args.out}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(doc, f, indent=1, sort_keys=True)
+            os.replace(tmp, args.out)
+
+    for name, r in sorted(doc["results"].items()):
+        print(_fmt(name, r))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(doc["results"], baseline["results"], args.threshold)
+        missing = sorted(set(baseline["results"]) - set(doc["results"]))
+        if missing:
+            print(f"not in current results: {', '.join(missing)}")
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"no regressions over {args.threshold:.0%} against {args.compare}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+import argparse
+import os
+import shutil
+import tempfile
+from typing import Dict
+from tu_agent.runner.rust_runner import RustSandboxRunner
+from tu_agent.utils.stats import summarize, time_calls
+
+def bench(runner_path: str, root: str, iters: int, warmup: int, persistent: bool) -> Dict[str, Dict[str, float]]:
+    """Per-call latency of small runner operations: a no-op command, read-file, a 50 ms sleep."""
+    r = RustSandboxRunner(runner_path, persistent=persistent)
+    try:
+        cases = {
+            "run:true": lambda: r.run_cmd(["true"], root),
+            "read-file": lambda: r.read_file("src/solution.py", root),
+            "run:sleep50ms": lambda: r.run_cmd(["sleep", "0.05"], root),
+        }
+        return {name: summarize(time_calls(fn, iters, warmup)) for name, fn in cases.items()}
+    finally:
+        r.close()
+
+def main():
+    ap = argparse.ArgumentParser(description='Per-call latency microbenchmark for sandbox_runner')
+    ap.add_argument('--runner', default=None, help='Path to sandbox_runner binary')
+    ap.add_argument('--baseline-runner', default=None, help='Second binary to compare against (e.g. an older build)')
+    ap.add_argument('--task', default='bugfix_1', help='Task whose files are used as the workspace')
+    ap.add_argument('--iters', type=int, default=200)
+    ap.add_argument('--warmup', type=int, default=10)
+    ap.add_argument('--persistent', action='store_true', help='Go through `sandbox_runner serve` instead of one process per call')
+    args = ap.parse_args()
+
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+    runner_path = args.runner or os.path.join(repo_root, 'rust', 'sandbox_runner', 'target', 'release', 'sandbox_runner')
+    runners = [('runner', runner_path)]
+    if args.baseline_runner:
+        runners.insert(0, ('baseline', args.baseline_runner))
+
+    root = tempfile.mkdtemp(prefix='tu_agent_bench_')
+    try:
+        shutil.copytree(os.path.join(repo_root, 'tasks', args.task), root, dirs_exist_ok=True)
+        results = {label: bench(path, root, args.iters, args.warmup, args.persistent) for label, path in runners}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    mode = 'serve' if args.persistent else 'one-shot'
+    print(f"{mode}, {args.iters} iters, latency in ms")
+    print(f"{'case':<16}{'binary':<10}{'p50':>9}{'p90':>9}{'p99':>9}{'mean':>9}")
+    for case in results['runner']:
+        for label, _ in runners:
+            s = results[label][case]
+            print(f"{case:<16}{label:<10}{s['p50']*1e3:9.3f}{s['p90']*1e3:9.3f}{s['p99']*1e3:9.3f}{s['mean']*1e3:9.3f}")
+        if args.baseline_runner:
+            base, new = results['baseline'][case]['p50'], results['runner'][case]['p50']
+            print(f"{'':<16}{'p50 delta':<10}{(new - base)*1e3:+9.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+from __future__ import annotations
+import argparse
+import os
+from tu_agent.env.task_registry import TaskRegistry
+
+def main():
+    ap = argparse.ArgumentParser(description='Pack tasks/<name>/ directories into a single SQLite task registry')
+    ap.add_argument('--tasks-root', default=None, help='Directory containing one sub-directory per task')
+    ap.add_argument('--out', required=True, help='Registry file to create or update')
+    ap.add_argument('--task', action='append', default=None, help='Only pack this task (repeatable)')
+    args = ap.parse_args()
+
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+    tasks_root = args.tasks_root or os.path.join(repo_root, 'tasks')
+
+    n = TaskRegistry.pack(tasks_root, args.out, names=args.task)
+    reg = TaskRegistry(args.out)
+    total = sum(reg.manifest(name).total_size for name in reg.names())
+    print(f"packed {n} task(s) into {args.out} ({len(reg)} total, {total} bytes of files)")
+    reg.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,9 @@ import argparse
 import os
 from tu_agent.env.tool_env import ToolUseCodingEnv
 from tu_agent.runner.auto_runner import AutoRunner
+from tu_agent.env.task_registry import TaskRegistry
+from tu_agent.env.trajectory import TrajectoryWriter
+from tu_agent.utils import trace
 from tu_agent.agents.random_agent import RandomAgent
 from tu_agent.agents.q_learning import QLearningAgent, QLearnConfig
 
@@ -12,33 +15,56 @@ def main():
     ap.add_argument('--agent', choices=['random','qlearn'], default='random')
     ap.add_argument('--max-steps', type=int, default=10)
     ap.add_argument('--runner', default=None, help='Path to sandbox_runner binary')
+    ap.add_argument('--task-registry', default=None, help='Load tasks from this packed registry (see pack_tasks)')
+    ap.add_argument('--fork-server', action='store_true', help='Run pytest in a warm pre-forked interpreter')
+    ap.add_argument('--q-table', default=None, help='Start the qlearn agent from a Q-table saved by train_qlearn --save-q')
+    ap.add_argument('--record', default=None, help='Append the episode to this trajectory directory')
+    ap.add_argument('--trace', default=None, help='Trace env/runner spans; write a Chrome trace here and print per-span latencies')
+    ap.add_argument('--incremental-tests', action='store_true', help='Rerun only tests whose imports reach files touched since the last run')
+    ap.add_argument('--test-shards', type=int, default=1, help='Split each test action across up to this many pytest processes')
+    ap.add_argument('--cpu-time-penalty', action='store_true', help='Charge the time penalty on sandboxed CPU time instead of wall time')
     args = ap.parse_args()
+    tracer = trace.enable() if args.trace else None
 
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
     tasks_root = os.path.join(repo_root, 'tasks')
 
     runner_path = args.runner or os.path.join(repo_root, 'rust', 'sandbox_runner', 'target', 'release', 'sandbox_runner')
-    runner = AutoRunner(runner_path)
+    runner = AutoRunner(runner_path, fork_server=args.fork_server)
+    registry = TaskRegistry(args.task_registry) if args.task_registry else None
 
-    env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps)
+    env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps, task_registry=registry, incremental_tests=args.incremental_tests, time_penalty_clock='cpu' if args.cpu_time_penalty else 'wall', test_shards=args.test_shards)
 
     obs = env.reset()
     if args.agent == 'random':
         agent = RandomAgent(seed=0)
     else:
-        agent = QLearningAgent(action_size=obs['action_size'], cfg=QLearnConfig(eps=0.05))
+        cfg = QLearnConfig(eps=0.05)
+        agent = QLearningAgent.load(args.q_table, cfg) if args.q_table else QLearningAgent(action_size=obs['action_size'], cfg=cfg)
 
+    writer = TrajectoryWriter(args.record) if args.record else None
+    buf = writer.episode() if writer is not None else None
     total = 0.0
     done = False
     while not done:
         a = agent.act(obs)
         next_obs, r, done, info = env.step(a)
         agent.observe(obs, a, r, next_obs, done)
+        if buf is not None:
+            buf.add(obs, a, r, next_obs, done, info)
         total += r
         obs = next_obs
         print(f"step={obs['step']:2d} action={a:2d} tool={info.tool:10s} pass={info.pass_rate:.2f} r={r:+.3f} msg={info.message[:120]!r}")
     print(f"TOTAL REWARD: {total:.3f}")
+    if writer is not None:
+        writer.commit(buf)
+        writer.close()
     env.close()
+    runner.close()
+    if tracer is not None:
+        trace.disable()
+        tracer.export_chrome(args.trace)
+        print(trace.format_summary(tracer))
 
 if __name__ == '__main__':
     main()
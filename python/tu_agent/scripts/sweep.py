@@ -0,0 +1,241 @@
+"""Train and evaluate Q-learning over a grid of task x seed x config on a process pool.
+
+Each cell trains a fresh `QLearningAgent` (`QLearnConfig(alpha, gamma,
+eps, seed)`) on one task for `--episodes` episodes, then runs
+`--eval-episodes` greedy episodes (eps 0, no updates). Cells run in
+`--workers` spawned processes. Each has its own runner, workspace and
+sandbox scheduler, with the machine's cores split between workers.
+
+Every finished cell is appended to `--out` as one JSON line, flushed and
+fsynced. Rerunning the same command resumes: cells already in the file are
+skipped, except ones that recorded an error. At the end, results are
+averaged over seeds per task and config and printed.
+
+    python -m tu_agent.scripts.sweep --seeds 0,1,2 --eps 0.1,0.2 --out sweep.jsonl
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Set
+
+from tu_agent.agents.q_learning import QLearningAgent, QLearnConfig
+from tu_agent.env.task_registry import TaskRegistry
+from tu_agent.env.tool_env import ToolUseCodingEnv
+from tu_agent.runner.auto_runner import AutoRunner
+from tu_agent.runner.scheduler import SandboxScheduler, usable_cpus
+
+@dataclass(frozen=True)
+class Cell:
+    task: str
+    seed: int
+    alpha: float
+    gamma: float
+    eps: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.task}/seed={self.seed}/alpha={self.alpha:g}/gamma={self.gamma:g}/eps={self.eps:g}"
+
+def _floats(s: str) -> List[float]:
+    return [float(x) for x in s.split(',') if x]
+
+def _episodes(env: ToolUseCodingEnv, agent: QLearningAgent, n: int, learn: bool) -> Dict[str, float]:
+    successes = steps = 0
+    total = 0.0
+    for _ in range(n):
+        obs = env.reset()
+        done = False
+        while not done:
+            a = agent.act(obs)
+            next_obs, r, done, info = env.step(a)
+            if learn:
+                agent.observe(obs, a, r, next_obs, done)
+            obs = next_obs
+            total += r
+            steps += 1
+        successes += info.pass_rate >= 1.0
+    return {"success_rate": successes / n if n else 0.0, "mean_return": total / n if n else 0.0, "steps": steps}
+
+def run_cell(cell: Cell, opts: Dict[str, Any]) -> Dict[str, Any]:
+    """Train then evaluate one cell; the record written to the results file."""
+    rec: Dict[str, Any] = dict(asdict(cell), cell=cell.key, pid=os.getpid())
+    t0 = time.perf_counter()
+    runner: Optional[AutoRunner] = None
+    env: Optional[ToolUseCodingEnv] = None
+    try:
+        runner = AutoRunner(opts['runner_path'], fork_server=opts['fork_server'],
+                            scheduler=SandboxScheduler(max_concurrent=opts['max_concurrent']))
+        registry = TaskRegistry(opts['task_registry']) if opts['task_registry'] else None
+        env = ToolUseCodingEnv(tasks_root=opts['tasks_root'], runner=runner, task_name=cell.task, max_steps=opts['max_steps'], task_registry=registry)
+        env.reset()
+        agent = QLearningAgent(env.action_size, QLearnConfig(cell.alpha, cell.gamma, cell.eps, cell.seed))
+        train = _episodes(env, agent, opts['episodes'], learn=True)
+        agent.cfg = QLearnConfig(cell.alpha, cell.gamma, 0.0, cell.seed)
+        ev = _episodes(env, agent, opts['eval_episodes'], learn=False)
+        wall = time.perf_counter() - t0
+        steps = train['steps'] + ev['steps']
+        rec.update(
+            episodes=opts['episodes'],
+            train_success_rate=train['success_rate'],
+            train_mean_return=train['mean_return'],
+            eval_episodes=opts['eval_episodes'],
+            eval_success_rate=ev['success_rate'],
+            eval_mean_return=ev['mean_return'],
+            steps=steps,
+            steps_per_s=steps / wall if wall > 0 else 0.0,
+            wall_s=wall,
+        )
+    except Exception:
+        rec.update(error=traceback.format_exc(limit=5), wall_s=time.perf_counter() - t0)
+    finally:
+        if env is not None:
+            env.close()
+        if runner is not None:
+            runner.close()
+    return rec
+
+def load_done(path: str) -> Dict[str, Dict[str, Any]]:
+    """Finished cells in an existing results file (cell key -> record); errors and torn lines don't count."""
+    done: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+            if isinstance(rec, dict) and 'cell' in rec and 'error' not in rec:
+                done[rec['cell']] = rec
+    return done
+
+def end_torn_line(path: str):
+    """Terminate a last line an interrupted run left unfinished, so the next record starts on its own."""
+    try:
+        with open(path, 'rb+') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+    except FileNotFoundError:
+        pass
+
+def check_tasks(tasks: Optional[List[str]], tasks_root: str, task_registry: Optional[str]) -> List[str]:
+    """The tasks to sweep (default: all of them), exiting on any that don't exist before a worker starts."""
+    if task_registry is not None:
+        if not os.path.exists(task_registry):
+            raise SystemExit(f"task registry not found: {task_registry}")
+        registry = TaskRegistry(task_registry)
+        try:
+            known = registry.names()
+        finally:
+            registry.close()
+    else:
+        known = sorted(t for t in os.listdir(tasks_root) if os.path.isdir(os.path.join(tasks_root, t)))
+    if tasks is None:
+        return [t for t in known if t.startswith('bugfix_')] if task_registry is None else known
+    missing = [t for t in tasks if t not in known]
+    if missing:
+        where = task_registry if task_registry is not None else tasks_root
+        raise SystemExit(f"unknown task(s) {', '.join(missing)} (not in {where})")
+    return tasks
+
+def aggregate(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Means over seeds per (task, alpha, gamma, eps)."""
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for r in records:
+        groups.setdefault((r['task'], r['alpha'], r['gamma'], r['eps']), []).append(r)
+    out = []
+    for (task, alpha, gamma, eps), rs in sorted(groups.items()):
+        out.append({
+            "task": task, "alpha": alpha, "gamma": gamma, "eps": eps, "seeds": len(rs),
+            "eval_success_rate": sum(r['eval_success_rate'] for r in rs) / len(rs),
+            "train_success_rate": sum(r['train_success_rate'] for r in rs) / len(rs),
+            "steps_per_s": sum(r['steps_per_s'] for r in rs) / len(rs),
+            "wall_s": sum(r['wall_s'] for r in rs) / len(rs),
+        })
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description='Parallel task x seed x config training/evaluation sweep')
+    ap.add_argument('--tasks', default=None, help='Comma-separated tasks (default: every tasks/bugfix_*, or every registry task)')
+    ap.add_argument('--seeds', default='0', help='Comma-separated agent seeds')
+    ap.add_argument('--alpha', default='0.2', help='Comma-separated learning rates')
+    ap.add_argument('--gamma', default='0.95', help='Comma-separated discounts')
+    ap.add_argument('--eps', default='0.2', help='Comma-separated exploration rates')
+    ap.add_argument('--episodes', type=int, default=200, help='Training episodes per cell')
+    ap.add_argument('--eval-episodes', type=int, default=20, help='Greedy evaluation episodes per cell')
+    ap.add_argument('--max-steps', type=int, default=10)
+    ap.add_argument('--workers', type=int, default=None, help='Cells run at once (default: one per core)')
+    ap.add_argument('--out', default='sweep.jsonl', help='Results file: one JSON line per finished cell; resumed if it exists')
+    ap.add_argument('--runner', default=None, help='Path to sandbox_runner binary')
+    ap.add_argument('--task-registry', default=None, help='Load tasks from this packed registry (see pack_tasks)')
+    ap.add_argument('--fork-server', action='store_true', help='Run pytest in a warm pre-forked interpreter')
+    args = ap.parse_args()
+
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+    tasks_root = os.path.join(repo_root, 'tasks')
+    tasks = check_tasks(args.tasks.split(',') if args.tasks else None, tasks_root, args.task_registry)
+    seeds = [int(s) for s in args.seeds.split(',') if s]
+    cells = [Cell(t, s, a, g, e) for t, s, a, g, e in
+             itertools.product(tasks, seeds, _floats(args.alpha), _floats(args.gamma), _floats(args.eps))]
+
+    done = load_done(args.out)
+    todo = [c for c in cells if c.key not in done]
+    workers = max(1, min(args.workers or usable_cpus(), len(todo) or 1))
+    opts = {
+        'tasks_root': tasks_root,
+        'runner_path': args.runner or os.path.join(repo_root, 'rust', 'sandbox_runner', 'target', 'release', 'sandbox_runner'),
+        'task_registry': args.task_registry,
+        'fork_server': args.fork_server,
+        'max_steps': args.max_steps,
+        'episodes': args.episodes,
+        'eval_episodes': args.eval_episodes,
+        # split the cores between workers rather than give each a full default scheduler
+        'max_concurrent': max(1, usable_cpus() // workers),
+    }
+    print(f"sweep: {len(cells)} cells, {len(cells) - len(todo)} already in {args.out}, running {len(todo)} on {workers} workers")
+
+    records = [done[c.key] for c in cells if c.key in done]
+    end_torn_line(args.out)
+    failed: Set[str] = set()
+    t0 = time.perf_counter()
+    # spawn: workers start from a clean interpreter rather than a fork of this one
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool, \
+            open(args.out, 'a', encoding='utf-8') as out:
+        futures = {pool.submit(run_cell, c, opts): c for c in todo}
+        try:
+            for n, fut in enumerate(as_completed(futures), 1):
+                rec = fut.result()
+                out.write(json.dumps(rec, sort_keys=True) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+                if 'error' in rec:
+                    failed.add(rec['cell'])
+                    print(f"[{n}/{len(todo)}] {rec['cell']}: error\n{rec['error']}")
+                    continue
+                records.append(rec)
+                print(f"[{n}/{len(todo)}] {rec['cell']}: eval success {rec['eval_success_rate']:.2f}, "
+                      f"train success {rec['train_success_rate']:.2f}, {rec['steps_per_s']:.1f} steps/s, {rec['wall_s']:.1f}s")
+        except KeyboardInterrupt:
+            pool.shutdown(cancel_futures=True)
+            raise SystemExit(f"interrupted; {len(records)} cells are in {args.out}, rerun to resume")
+    print(f"sweep finished in {time.perf_counter() - t0:.1f}s ({len(failed)} failed)")
+
+    print(f"{'task':<16}{'alpha':>7}{'gamma':>7}{'eps':>6}{'seeds':>6}{'eval':>7}{'train':>7}{'steps/s':>9}{'wall_s':>8}")
+    for g in aggregate(records):
+        print(f"{g['task']:<16}{g['alpha']:>7g}{g['gamma']:>7g}{g['eps']:>6g}{g['seeds']:>6}{g['eval_success_rate']:7.2f}"
+              f"{g['train_success_rate']:7.2f}{g['steps_per_s']:9.1f}{g['wall_s']:8.1f}")
+    if failed:
+        raise SystemExit(f"{len(failed)} cell(s) failed; rerun to retry them")
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,28 @@
 from __future__ import annotations
 import argparse
+import asyncio
+import multiprocessing
 import os
+import shutil
+import tempfile
+import time
 from tu_agent.env.tool_env import ToolUseCodingEnv
+from tu_agent.env.vec_env import make_vec_env
+from tu_agent.env.async_rollout import rollout, summarize_episodes
+from tu_agent.env.trajectory import TrajectoryReader, TrajectoryWriter, batch_obs
+from tu_agent.env.replay_env import ReplayEnv, TransitionModel
+from tu_agent.env.obs_array import obs_get
 from tu_agent.runner.auto_runner import AutoRunner
+from tu_agent.runner.async_runner import AsyncAutoRunner
+from tu_agent.runner.scheduler import SandboxScheduler, default_scheduler
+from tu_agent.env.task_registry import TaskRegistry
+from tu_agent.runner.test_cache import TestResultCache
 from tu_agent.agents.q_learning import QLearningAgent, QLearnConfig
+from tu_agent.agents.distributed import Learner, parse_address, run_actor
+from tu_agent.utils import trace
+
+# trajectory columns offline training reads
+TRAIN_COLUMNS = ['action', 'reward', 'done', 'max_steps'] + [p + f for p in ('obs_', 'next_') for f in ('step', 'tool_calls', 'best_pass_rate', 'last_pass_rate')]
 
 def main():
     ap = argparse.ArgumentParser()
@@ -11,33 +30,301 @@ def main():
     ap.add_argument('--episodes', type=int, default=2000)
     ap.add_argument('--max-steps', type=int, default=10)
     ap.add_argument('--runner', default=None, help='Path to sandbox_runner binary')
+    ap.add_argument('--task-registry', default=None, help='Load tasks from this packed registry (see pack_tasks)')
+    ap.add_argument('--fork-server', action='store_true', help='Run pytest in a warm pre-forked interpreter')
+    ap.add_argument('--test-cache', action='store_true', help='Reuse pytest results for already-seen workspace states')
+    ap.add_argument('--test-cache-dir', default=None, help='Also persist the test cache here (shared across processes)')
+    ap.add_argument('--incremental-tests', action='store_true', help='Rerun only tests whose imports reach files touched since the last run')
+    ap.add_argument('--test-shards', type=int, default=1, help='Split each test action across up to this many pytest processes')
+    ap.add_argument('--cpu-time-penalty', action='store_true', help='Charge the time penalty on sandboxed CPU time instead of wall time')
+    ap.add_argument('--obs-mode', choices=['dict', 'array'], default='dict', help='Observation type; array writes into preallocated float64 buffers')
+    ap.add_argument('--num-envs', type=int, default=1, help='Step this many workspaces in parallel')
+    ap.add_argument('--max-concurrent', type=int, default=None, help='Sandboxed processes allowed at once (default: one per core)')
+    ap.add_argument('--async-episodes', type=int, default=0, help='Keep this many episodes in flight on one asyncio event loop')
+    ap.add_argument('--actors', type=int, default=0, help='Train with this many local actor processes feeding one learner')
+    ap.add_argument('--remote-actors', type=int, default=0, help='Also wait for this many actors started elsewhere with --connect')
+    ap.add_argument('--learner-address', default=None, help='Learner socket: a Unix socket path or host:port (default: a temp socket)')
+    ap.add_argument('--connect', default=None, help='Run only as an actor for the learner at this address (key in $TU_AGENT_AUTHKEY)')
+    ap.add_argument('--actor-batch', type=int, default=64, help='Transitions per batch an actor sends the learner')
+    ap.add_argument('--sync-every', type=int, default=1, help='Send an actor the Q-table once its copy is this many updates old')
+    ap.add_argument('--load-q', default=None, help='Start from the Q-table saved in this .npy file')
+    ap.add_argument('--shared-q', action='store_true', help='Memory-map --load-q read-write so concurrent trainers update one table')
+    ap.add_argument('--save-q', default=None, help='Save the trained Q-table to this .npy file')
+    ap.add_argument('--record', default=None, help='Append every episode to this trajectory directory')
+    ap.add_argument('--offline', default=None, help='Train from a recorded trajectory directory instead of the env')
+    ap.add_argument('--epochs', type=int, default=1, help='Passes over the --offline trajectories')
+    ap.add_argument('--batch-size', type=int, default=4096, help='Transitions per update batch with --offline')
+    ap.add_argument('--replay-model', default=None, help='Serve steps from this transition table (recording and saving misses)')
+    ap.add_argument('--explore-depth', type=int, default=0, help='Record every state up to this many applied patches before training')
+    ap.add_argument('--verify-every', type=int, default=0, help='With --replay-model, check every Nth episode against the real env')
+    ap.add_argument('--trace', default=None, help='Trace env/runner spans; write a Chrome trace here and print per-span latencies')
     args = ap.parse_args()
 
+    tracer = trace.enable() if args.trace else None
+    try:
+        train(args)
+    finally:
+        if tracer is not None:
+            trace.disable()
+            tracer.export_chrome(args.trace)
+            print(trace.format_summary(tracer))
+            print(f"chrome trace written to {args.trace}")
+
+def train(args):
+    if args.offline:
+        train_offline(args)
+        return
+
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
     tasks_root = os.path.join(repo_root, 'tasks')
 
     runner_path = args.runner or os.path.join(repo_root, 'rust', 'sandbox_runner', 'target', 'release', 'sandbox_runner')
-    runner = AutoRunner(runner_path)
+    if args.connect or args.actors or args.remote_actors:
+        if args.record or args.replay_model:
+            raise SystemExit("--record and --replay-model don't combine with actor/learner training")
+        if args.connect:
+            actor_main(args, tasks_root, runner_path, parse_address(args.connect), authkey_from_env(required=True))
+        else:
+            train_distributed(args, tasks_root, runner_path)
+        return
+
+    scheduler = SandboxScheduler(max_concurrent=args.max_concurrent) if args.max_concurrent else default_scheduler()
+    runner = AutoRunner(runner_path, fork_server=args.fork_server, scheduler=scheduler)
+    registry = TaskRegistry(args.task_registry) if args.task_registry else None
+    test_cache = TestResultCache(disk_dir=args.test_cache_dir) if (args.test_cache or args.test_cache_dir) else None
+
+    writer = TrajectoryWriter(args.record) if args.record else None
+
+    if args.async_episodes > 0:
+        asyncio.run(train_async(args, tasks_root, runner_path, test_cache, registry, scheduler, writer))
+        close_writer(writer)
+        return
+
+    if args.num_envs > 1:
+        train_vec(args, tasks_root, runner, test_cache, registry, writer)
+        runner.close()
+        close_writer(writer)
+        return
 
-    env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps)
+    env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps, task_registry=registry, test_cache=test_cache, incremental_tests=args.incremental_tests, time_penalty_clock=penalty_clock(args), test_shards=args.test_shards, obs_mode=args.obs_mode)
 
     obs = env.reset()
-    agent = QLearningAgent(action_size=obs['action_size'], cfg=QLearnConfig(alpha=0.2, gamma=0.95, eps=0.2, seed=0))
+    agent = make_agent(args, env.action_size)
+
+    replay = None
+    if args.replay_model:
+        model = TransitionModel.load(args.replay_model) if os.path.exists(args.replay_model) else None
+        replay = ReplayEnv.wrap(env, model)
+        if args.explore_depth > 0:
+            n = replay.model.explore(env, max_depth=args.explore_depth)
+            print(f"explored {replay.model.stats()} in {n} real steps")
+    step_env = replay if replay is not None else env
 
     successes = 0
+    mismatches = 0
     for ep in range(1, args.episodes + 1):
-        obs = env.reset()
+        obs = step_env.reset()
         done = False
+        buf = writer.episode() if writer is not None else None
+        actions = []
         while not done:
             a = agent.act(obs)
-            next_obs, r, done, info = env.step(a)
+            next_obs, r, done, info = step_env.step(a)
             agent.observe(obs, a, r, next_obs, done)
+            if buf is not None:
+                buf.add(obs, a, r, next_obs, done, info)
+            actions.append(a)
             obs = next_obs
+        if buf is not None:
+            writer.commit(buf)
+        if replay is not None and args.verify_every > 0 and ep % args.verify_every == 0:
+            diffs = replay.verify(actions)
+            mismatches += len(diffs)
+            for d in diffs:
+                print(f"replay mismatch (ep={ep}): {d}")
         if info.pass_rate >= 1.0:
             successes += 1
         if ep % 200 == 0:
-            print(f"ep={ep} success_rate(last {ep}): {successes/ep:.3f} best_pass={obs['best_pass_rate']:.2f}")
+            print(f"ep={ep} success_rate(last {ep}): {successes/ep:.3f} best_pass={obs_get(obs, 'best_pass_rate'):.2f}")
+    if replay is not None:
+        replay.model.save(args.replay_model)
+        print(f"replay env: {replay.stats()} mismatches={mismatches}")
+    if env.workspace_pool is not None:
+        print(f"workspace pool: {env.workspace_pool.stats()}")
+    if env.file_cache is not None:
+        print(f"file cache: {env.file_cache.stats()}")
+    finish_agent(args, agent)
+    close_writer(writer)
     env.close()
+    runner.close()
+    if test_cache is not None:
+        print(f"test cache: {test_cache.stats()}")
+
+def penalty_clock(args) -> str:
+    return 'cpu' if args.cpu_time_penalty else 'wall'
+
+AGENT_CFG = QLearnConfig(alpha=0.2, gamma=0.95, eps=0.2, seed=0)
+
+def make_agent(args, action_size: int) -> QLearningAgent:
+    cfg = AGENT_CFG
+    if args.load_q:
+        agent = QLearningAgent.load(args.load_q, cfg, mmap_mode='r+' if args.shared_q else None)
+        if agent.action_size != action_size:
+            raise SystemExit(f"{args.load_q} has {agent.action_size} actions, task has {action_size}")
+        return agent
+    return QLearningAgent(action_size=action_size, cfg=cfg)
+
+def finish_agent(args, agent: QLearningAgent):
+    if args.save_q:
+        agent.save(args.save_q)
+        print(f"saved Q-table to {args.save_q}")
+    agent.q.close()
+
+def close_writer(writer):
+    if writer is not None:
+        print(f"recorded {writer.episodes} episodes ({writer.rows} steps) in {writer.path}")
+        writer.close()
+
+def train_offline(args):
+    """Q-learning over recorded transitions; no sandbox involved."""
+    with TrajectoryReader(args.offline) as traj:
+        if len(traj) == 0:
+            raise SystemExit(f"{args.offline} holds no transitions")
+        agent = make_agent(args, max(traj.column('action_size')))
+        t0 = time.perf_counter()
+        for epoch in range(1, args.epochs + 1):
+            for batch in traj.iter_batches(args.batch_size, columns=TRAIN_COLUMNS):
+                agent.observe_batch(batch_obs(batch, 'obs_'), batch['action'], batch['reward'], batch_obs(batch, 'next_'), batch['done'])
+        dt = time.perf_counter() - t0
+        print(f"offline: {args.epochs} epoch(s) over {len(traj)} transitions / {traj.num_episodes} episodes, {args.epochs * len(traj) / dt:,.0f} transitions/s")
+    finish_agent(args, agent)
+
+def train_vec(args, tasks_root: str, runner: AutoRunner, test_cache=None, registry=None, writer=None):
+    venv = make_vec_env(tasks_root, runner, args.task, num_envs=args.num_envs, max_steps=args.max_steps, task_registry=registry, test_cache=test_cache, incremental_tests=args.incremental_tests, time_penalty_clock=penalty_clock(args), test_shards=args.test_shards, obs_mode=args.obs_mode)
+    obs = venv.reset()
+    agent = make_agent(args, venv.action_sizes[0])
+
+    successes = 0
+    ep = 0
+    bufs = [writer.episode() for _ in range(venv.num_envs)] if writer is not None else None
+    while ep < args.episodes:
+        # array mode: the whole batch as one contiguous block
+        actions = agent.act_batch(venv.obs_batch if venv.obs_batch is not None else obs)
+        next_obs, rewards, dones, infos = venv.step(actions)
+        finals = [venv.terminal_obs[i] if dones[i] else next_obs[i] for i in range(venv.num_envs)]
+        agent.observe_batch(obs, actions, rewards, finals, dones)
+        for i in range(venv.num_envs):
+            if bufs is not None:
+                bufs[i].add(obs[i], actions[i], rewards[i], finals[i], dones[i], infos[i])
+            if not dones[i]:
+                continue
+            if bufs is not None:
+                writer.commit(bufs[i])
+                bufs[i] = writer.episode()
+            ep += 1
+            if infos[i].pass_rate >= 1.0:
+                successes += 1
+            if ep % 200 == 0:
+                print(f"ep={ep} success_rate(last {ep}): {successes/ep:.3f} best_pass={obs_get(finals[i], 'best_pass_rate'):.2f}")
+        obs = next_obs
+    finish_agent(args, agent)
+    venv.close()
+    print(f"sandbox scheduler: {runner.scheduler.stats()}")
+    if test_cache is not None:
+        print(f"test cache: {test_cache.stats()}")
+
+async def train_async(args, tasks_root: str, runner_path: str, test_cache=None, registry=None, scheduler=None, writer=None):
+    runner = AsyncAutoRunner(runner_path, fork_server=args.fork_server, scheduler=scheduler)
+    probe = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, task_registry=registry)
+    await probe.areset()
+    agent = make_agent(args, probe.action_size)
+    await probe.aclose()
+
+    def make_env():
+        return ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps, task_registry=registry, test_cache=test_cache, incremental_tests=args.incremental_tests, time_penalty_clock=penalty_clock(args), test_shards=args.test_shards, obs_mode=args.obs_mode)
+
+    done = []
+    def on_episode(res):
+        done.append(res)
+        if len(done) % 200 == 0:
+            print(f"ep={len(done)} success_rate(last {len(done)}): {summarize_episodes(done)['success_rate']:.3f}")
+
+    bufs = {}
+    def on_step(i, obs, a, r, next_obs, done, info):
+        buf = bufs.setdefault(i, writer.episode())
+        buf.add(obs, a, r, next_obs, done, info)
+        if done:
+            writer.commit(bufs.pop(i))
+
+    results = await rollout(make_env, agent, args.episodes, concurrency=args.async_episodes, on_episode=on_episode,
+                            on_step=on_step if writer is not None else None)
+    print(f"async rollout: {summarize_episodes(results)}")
+    finish_agent(args, agent)
+    print(f"sandbox scheduler: {runner.scheduler.stats()}")
+    await runner.close()
+    if test_cache is not None:
+        print(f"test cache: {test_cache.stats()}")
+
+
+def authkey_from_env(required: bool=False) -> bytes:
+    key = os.environ.get('TU_AGENT_AUTHKEY', '').encode()
+    if not key and required:
+        raise SystemExit("set TU_AGENT_AUTHKEY to the learner's key")
+    return key or os.urandom(16)
+
+def actor_main(args, tasks_root: str, runner_path: str, address, authkey: bytes):
+    runner = AutoRunner(runner_path, fork_server=args.fork_server)
+    registry = TaskRegistry(args.task_registry) if args.task_registry else None
+    # only the disk cache is shared between actors
+    test_cache = TestResultCache(disk_dir=args.test_cache_dir) if args.test_cache_dir else None
+    env = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, max_steps=args.max_steps, task_registry=registry, test_cache=test_cache, incremental_tests=args.incremental_tests, time_penalty_clock=penalty_clock(args), test_shards=args.test_shards, obs_mode=args.obs_mode)
+    try:
+        stats = run_actor(address, authkey, env, AGENT_CFG, batch_size=args.actor_batch)
+    finally:
+        env.close()
+        runner.close()
+    print(f"actor {stats['actor']}: {stats['episodes']} episodes ({stats['episodes_per_s']:.2f}/s), {stats['syncs']} table syncs")
+
+def train_distributed(args, tasks_root: str, runner_path: str):
+    """One learner in this process; `--actors` local actor processes plus any `--remote-actors`."""
+    registry = TaskRegistry(args.task_registry) if args.task_registry else None
+    runner = AutoRunner(runner_path)
+    probe = ToolUseCodingEnv(tasks_root=tasks_root, runner=runner, task_name=args.task, task_registry=registry)
+    probe.reset()
+    agent = make_agent(args, probe.action_size)
+    probe.close()
+    runner.close()
+
+    tmpdir = None
+    if args.learner_address:
+        address = parse_address(args.learner_address)
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='tu_learner_')
+        address = os.path.join(tmpdir, 'learner.sock')
+    authkey = authkey_from_env()
+    learner = Learner(agent, address, authkey, sync_every=args.sync_every, max_episodes=args.episodes)
+    print(f"learner listening on {learner.address}")
+    if args.remote_actors and 'TU_AGENT_AUTHKEY' not in os.environ:
+        print("warning: TU_AGENT_AUTHKEY is unset, so remote actors can't authenticate")
+    # spawn, not fork: the probe's runner may have left threads behind
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=actor_main, args=(args, tasks_root, runner_path, learner.address, authkey), daemon=True)
+             for _ in range(args.actors)]
+    for p in procs:
+        p.start()
+    try:
+        until = (lambda: all(not p.is_alive() for p in procs)) if not args.remote_actors else None
+        learner.serve(args.actors + args.remote_actors, until=until)
+    finally:
+        for p in procs:
+            p.join(timeout=30)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    st = learner.stats()
+    print(f"learner: {st['episodes']} episodes / {st['transitions']} transitions from {st['actors']} actors, "
+          f"{st['transitions_per_s']:.1f} transitions/s, success_rate {st['success_rate']:.3f}, update busy {st['update_busy']:.1%}")
+    print(f"staleness: lag p50 {st['lag']['p50']:.0f} max {st['lag']['max']:.0f} updates, age p50 {st['age_s']['p50']:.3f}s max {st['age_s']['max']:.3f}s; {st['syncs']} syncs")
+    finish_agent(args, agent)
 
 if __name__ == '__main__':
     main()
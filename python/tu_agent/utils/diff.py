@@ -0,0 +1,355 @@
+"""In-process unified-diff parsing and application.
+
+Patches are parsed once into `PatchSet`s (file headers + hunks) and applied
+to file contents in memory, matching context like `patch -p1` does: at the
+stated line first, then at the nearest offset, then with up to `fuzz`
+context lines ignored at each end of the hunk. A patch is applied
+atomically: if any hunk is rejected nothing is written, as with `git apply`.
+
+Lines are split on "\n" only, on the patch side and the file side alike, so
+a "\r" stays part of the line it ends: a CRLF patch matches a CRLF file and
+writes CRLF lines back, as `git apply` does.
+
+Header paths go through the same checks as the Rust runner's
+`validate_patch_paths`, and resolved targets must stay inside the root.
+"""
+from __future__ import annotations
+import os
+import re
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+DEV_NULL = "/dev/null"
+
+class PatchError(ValueError):
+    pass
+
+@dataclass
+class Hunk:
+    old_start: int
+    old_len: int
+    new_start: int
+    new_len: int
+    # (tag, text) with tag in " ", "-", "+"; text has no "\n" (a "\r" is kept)
+    lines: List[Tuple[str, str]]
+    old_no_eol: bool = False
+    new_no_eol: bool = False
+
+    @property
+    def old_lines(self) -> List[str]:
+        return [t for tag, t in self.lines if tag != "+"]
+
+    @property
+    def new_lines(self) -> List[str]:
+        return [t for tag, t in self.lines if tag != "-"]
+
+@dataclass
+class FilePatch:
+    old_path: Optional[str]  # None for /dev/null (file creation)
+    new_path: Optional[str]  # None for /dev/null (file deletion)
+    hunks: List[Hunk] = field(default_factory=list)
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path or ""
+
+@dataclass
+class PatchSet:
+    files: List[FilePatch]
+
+    @property
+    def paths(self) -> List[str]:
+        out: List[str] = []
+        for fp in self.files:
+            for p in (fp.old_path, fp.new_path):
+                if p and p not in out:
+                    out.append(p)
+        return out
+
+@dataclass
+class HunkResult:
+    path: str
+    index: int
+    applied: bool
+    offset: int = 0
+    fuzz: int = 0
+    reversed: bool = False  # rejected because it looks already applied
+
+@dataclass
+class ApplyResult:
+    ok: bool
+    applied: List[HunkResult]
+    rejected: List[HunkResult]
+    files: List[str]
+    message: str = ""
+
+def validate_patch_path(p: str) -> None:
+    if p.startswith("/") or ".." in p or "\\" in p or "\0" in p:
+        raise PatchError(f"unsafe patch path in header: {p}")
+
+def _header_path(rest: str) -> Optional[str]:
+    p = rest.split("\t", 1)[0].strip()
+    if p == DEV_NULL:
+        return None
+    if not p:
+        raise PatchError("empty path in patch header")
+    validate_patch_path(p)
+    if p.startswith(("a/", "b/")):
+        p = p[2:]
+    return p
+
+def parse_unified_diff(text: str) -> PatchSet:
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    files: List[FilePatch] = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not (line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ ")):
+            # git extended headers, "diff --git", "index ...", garbage: skip
+            i += 1
+            continue
+        fp = FilePatch(old_path=_header_path(line[4:]), new_path=_header_path(lines[i + 1][4:]))
+        if fp.old_path is None and fp.new_path is None:
+            raise PatchError("patch header has /dev/null on both sides")
+        i += 2
+        while i < len(lines) and lines[i].startswith("@@"):
+            m = HUNK_RE.match(lines[i])
+            if not m:
+                raise PatchError(f"malformed hunk header: {lines[i]}")
+            h = Hunk(
+                old_start=int(m.group(1)),
+                old_len=int(m.group(2)) if m.group(2) is not None else 1,
+                new_start=int(m.group(3)),
+                new_len=int(m.group(4)) if m.group(4) is not None else 1,
+                lines=[],
+            )
+            i += 1
+            old_seen = new_seen = 0
+            while i < len(lines) and (old_seen < h.old_len or new_seen < h.new_len or lines[i].startswith("\\")):
+                body = lines[i]
+                if body.startswith("\\"):
+                    # "\ No newline at end of file" refers to the previous line
+                    if h.lines:
+                        tag = h.lines[-1][0]
+                        if tag in " -":
+                            h.old_no_eol = True
+                        if tag in " +":
+                            h.new_no_eol = True
+                    i += 1
+                    continue
+                # an empty context line whose leading space was stripped (maybe leaving its "\r")
+                tag, t = (body[0], body[1:]) if body not in ("", "\r") else (" ", body)
+                if tag not in " -+":
+                    raise PatchError(f"malformed hunk line: {body!r}")
+                h.lines.append((tag, t))
+                if tag != "+":
+                    old_seen += 1
+                if tag != "-":
+                    new_seen += 1
+                i += 1
+            if old_seen != h.old_len or new_seen != h.new_len:
+                raise PatchError(f"truncated hunk in {fp.path}")
+            fp.hunks.append(h)
+        if not fp.hunks:
+            raise PatchError(f"no hunks for {fp.path}")
+        files.append(fp)
+    if not files:
+        raise PatchError("no file headers found in patch")
+    return PatchSet(files=files)
+
+def _split(text: str) -> Tuple[List[str], bool]:
+    if not text:
+        return [], True
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+        return lines, True
+    return lines, False
+
+def _join(lines: List[str], eol: bool) -> str:
+    if not lines:
+        return ""
+    return "\n".join(lines) + ("\n" if eol else "")
+
+def _trimmed(h: Hunk, fuzz: int) -> Tuple[int, int]:
+    """How many context lines to drop at the (top, bottom) of `h` for a given fuzz."""
+    lead = 0
+    for tag, _ in h.lines:
+        if tag != " ":
+            break
+        lead += 1
+    trail = 0
+    for tag, _ in reversed(h.lines):
+        if tag != " ":
+            break
+        trail += 1
+    if lead == len(h.lines):  # context-only hunk
+        return 0, 0
+    # As in GNU patch, fuzz counts from the longer side: a hunk with 3 lines of
+    # leading but 2 of trailing context drops at most fuzz-1 at the bottom.
+    context = max(lead, trail)
+    return max(0, min(lead, fuzz + lead - context)), max(0, min(trail, fuzz + trail - context))
+
+def _find(lines: List[str], old: List[str], expected: int, lo: int) -> Optional[int]:
+    n = len(old)
+    hi = len(lines) - n
+    if hi < lo:
+        return None
+    expected = min(max(expected, lo), hi)
+    for delta in range(0, max(expected - lo, hi - expected) + 1):
+        for pos in ((expected, ) if delta == 0 else (expected - delta, expected + delta)):
+            if lo <= pos <= hi and lines[pos:pos + n] == old:
+                return pos
+    return None
+
+def apply_hunks(text: str, hunks: List[Hunk], path: str="", fuzz: int=2) -> Tuple[Optional[str], List[HunkResult]]:
+    """Apply `hunks` to `text`; returns (new_text or None if any hunk was rejected, per-hunk results)."""
+    lines, eol = _split(text)
+    results: List[HunkResult] = []
+    ok = True
+    shift = 0  # how far earlier hunks moved later line numbers
+    lo = 0
+    for idx, h in enumerate(hunks):
+        placed = None
+        rev = False
+        tried = set()
+        for f in range(0, fuzz + 1):
+            top, bottom = _trimmed(h, f)
+            if (top, bottom) in tried:
+                continue
+            tried.add((top, bottom))
+            body = h.lines[top:len(h.lines) - bottom]
+            old = [t for tag, t in body if tag != "+"]
+            new = [t for tag, t in body if tag != "-"]
+            start = (h.old_start - 1 if h.old_len else h.old_start) + top + shift
+            pos = _find(lines, old, start, lo)
+            if pos is not None:
+                placed = (pos, old, new, f, pos - start)
+                break
+            if f == 0 and h.new_lines != h.old_lines and _find(lines, h.new_lines, start, 0) is not None:
+                # Like patch(1): an exact reverse match means "previously applied", don't fuzz it in again.
+                rev = True
+                break
+        if placed is None:
+            ok = False
+            results.append(HunkResult(path=path, index=idx, applied=False, reversed=rev))
+            continue
+        pos, old, new, f, offset = placed
+        lines[pos:pos + len(old)] = new
+        shift += len(new) - len(old) + offset
+        lo = pos + len(new)
+        results.append(HunkResult(path=path, index=idx, applied=True, offset=offset, fuzz=f))
+        if lo >= len(lines):
+            if h.new_no_eol:
+                eol = False
+            elif h.old_no_eol:
+                eol = True
+    if not ok:
+        return None, results
+    return _join(lines, eol), results
+
+def _resolve(root: str, rel: str) -> str:
+    root_real = os.path.realpath(root)
+    p = os.path.realpath(os.path.join(root_real, rel))
+    if not p.startswith(root_real + os.sep):
+        raise PatchError(f"path escapes root: {rel}")
+    return p
+
+def apply_to_files(patch: PatchSet, files: Dict[str, Optional[str]], fuzz: int=2) -> Tuple[ApplyResult, Dict[str, Optional[str]]]:
+    """Apply `patch` to in-memory `files` (relpath -> text, None if absent).
+
+    Returns the result and the updated contents of every touched path
+    (None meaning the file is deleted). Paths not in `files` count as absent.
+    """
+    out: Dict[str, Optional[str]] = {}
+    applied: List[HunkResult] = []
+    rejected: List[HunkResult] = []
+    errors: List[str] = []
+    for fp in patch.files:
+        src_path = fp.old_path
+        cur = None
+        if src_path is not None:
+            cur = out[src_path] if src_path in out else files.get(src_path)
+            if cur is None:
+                errors.append(f"error: {src_path}: No such file in workspace")
+                rejected.extend(HunkResult(path=fp.path, index=i, applied=False) for i in range(len(fp.hunks)))
+                continue
+        elif (out.get(fp.path) if fp.path in out else files.get(fp.path)) is not None:
+            errors.append(f"error: {fp.path}: already exists in workspace")
+            rejected.extend(HunkResult(path=fp.path, index=i, applied=False) for i in range(len(fp.hunks)))
+            continue
+        new_text, results = apply_hunks(cur or "", fp.hunks, path=fp.path, fuzz=fuzz)
+        for r in results:
+            (applied if r.applied else rejected).append(r)
+            if not r.applied:
+                why = " (reversed or previously applied)" if r.reversed else ""
+                errors.append(f"Hunk #{r.index + 1} FAILED at {fp.hunks[r.index].old_start}{why} ({fp.path}).")
+        if new_text is None:
+            continue
+        if fp.new_path is None:
+            out[fp.old_path] = None  # type: ignore[index]
+        else:
+            if fp.old_path is not None and fp.old_path != fp.new_path:
+                out[fp.old_path] = None
+            out[fp.new_path] = new_text
+    ok = not rejected
+    if not ok:
+        errors.insert(0, f"error: patch failed: {len(rejected)} out of {len(applied) + len(rejected)} hunks FAILED")
+    return ApplyResult(ok=ok, applied=applied, rejected=rejected, files=list(out), message="\n".join(errors)), out
+
+def _umask() -> int:
+    """The process umask, read without setting it (`os.umask` would, for every thread)."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0o022
+
+def _write_atomic(path: str, text: str):
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    # new files get the mode open() would give them, not mkstemp's 0600
+    mode = os.stat(path).st_mode & 0o7777 if os.path.exists(path) else 0o666 & ~_umask()
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=".tu_agent_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", errors="surrogateescape", newline="") as f:
+            f.write(text)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def apply_patch(patch: PatchSet, root: str, fuzz: int=2) -> ApplyResult:
+    """Apply `patch` to the workspace at `root`, writing only the touched files."""
+    targets = {rel: _resolve(root, rel) for rel in patch.paths}
+    current: Dict[str, Optional[str]] = {}
+    for rel, p in targets.items():
+        try:
+            with open(p, "r", encoding="utf-8", errors="surrogateescape", newline="") as f:
+                current[rel] = f.read()
+        except FileNotFoundError:
+            current[rel] = None
+    result, updated = apply_to_files(patch, current, fuzz=fuzz)
+    if not result.ok:
+        result.files = []
+        return result
+    for rel, text in updated.items():
+        if text is None:
+            try:
+                os.remove(targets[rel])
+            except FileNotFoundError:
+                pass
+        elif text != current.get(rel):
+            _write_atomic(targets[rel], text)
+    return result
@@ -0,0 +1,38 @@
+from __future__ import annotations
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+def percentile(sorted_xs: Sequence[float], q: float) -> float:
+    """Linear-interpolated percentile (q in [0, 100]) of an already sorted sequence."""
+    if not sorted_xs:
+        return float("nan")
+    pos = (len(sorted_xs) - 1) * q / 100.0
+    lo = math.floor(pos)
+    hi = min(lo + 1, len(sorted_xs) - 1)
+    return sorted_xs[lo] + (sorted_xs[hi] - sorted_xs[lo]) * (pos - lo)
+
+def summarize(xs: Iterable[float], qs: Sequence[float]=(50, 90, 99)) -> Dict[str, float]:
+    """n, mean, min, max and the requested percentiles (keys "p50", ...)."""
+    s = sorted(xs)
+    out: Dict[str, float] = {"n": len(s), "mean": (sum(s) / len(s)) if s else float("nan")}
+    out["min"] = s[0] if s else float("nan")
+    out["max"] = s[-1] if s else float("nan")
+    for q in qs:
+        out[f"p{q:g}"] = percentile(s, q)
+    return out
+
+def time_calls(fn: Callable[[], object], iters: int, warmup: int=0, setup: Optional[Callable[[], object]]=None) -> List[float]:
+    """Wall time of `iters` calls to `fn` after `warmup` untimed ones; `setup` runs untimed before each call."""
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    out = []
+    for _ in range(iters):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - t0)
+    return out
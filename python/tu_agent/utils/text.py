@@ -1,9 +1,12 @@
 import re
+from typing import Dict, Optional
+from tu_agent.utils.trace import traced
 
 PASSED_RE = re.compile(r"(?P<n>\d+)\s+passed", re.IGNORECASE)
 FAILED_RE = re.compile(r"(?P<n>\d+)\s+failed", re.IGNORECASE)
 SKIPPED_RE = re.compile(r"(?P<n>\d+)\s+skipped", re.IGNORECASE)
 
+@traced("parse.pytest_pass_rate")
 def parse_pytest_pass_rate(output: str) -> float:
     """Best-effort parse of pytest summary.
 
@@ -23,3 +26,80 @@ def parse_pytest_pass_rate(output: str) -> float:
     if total <= 0:
         return -1.0
     return passed / total
+
+# Final pytest summary, with or without -q:
+#   "2 failed, 1 passed in 0.04s"  /  "==== 3 passed, 1 warning in 0.10s ===="
+SUMMARY_LINE_RE = re.compile(r"^=*\s*(?P<body>(?:\d+ [a-z]+)(?:, \d+ [a-z]+)*|no tests ran)\s+in\s+[\d.]+s\b")
+SUMMARY_ITEM_RE = re.compile(r"(?P<n>\d+) (?P<what>[a-z]+)")
+
+class PytestSummaryDetector:
+    """Incrementally finds pytest's final summary line in streamed output.
+
+    Feed it text chunks as they arrive; only the current partial line is
+    buffered, so the full output never has to be kept or rescanned.
+    """
+
+    def __init__(self):
+        self._partial = ""
+        self.counts: Optional[Dict[str, int]] = None
+
+    def _line(self, line: str):
+        m = SUMMARY_LINE_RE.match(line.strip())
+        if not m:
+            return
+        counts: Dict[str, int] = {}
+        for item in SUMMARY_ITEM_RE.finditer(m.group("body")):
+            what = item.group("what")
+            # "1 error" / "2 errors", "1 warning" / "3 warnings"
+            what = what[:-1] if what in ("errors", "warnings") else what
+            counts[what] = counts.get(what, 0) + int(item.group("n"))
+        self.counts = counts
+
+    def feed(self, text: str):
+        if not text:
+            return
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        if len(self._partial) > 4096:
+            # no summary line is this long; don't let a runaway line grow the buffer
+            self._partial = self._partial[-4096:]
+        for line in lines:
+            self._line(line)
+
+    def finish(self) -> "PytestSummaryDetector":
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ""
+        return self
+
+    @property
+    def found(self) -> bool:
+        return self.counts is not None
+
+    @property
+    def pass_rate(self) -> float:
+        """Same contract as parse_pytest_pass_rate: passed/(passed+failed), or -1.0."""
+        if self.counts is None:
+            return -1.0
+        passed = self.counts.get("passed", 0)
+        total = passed + self.counts.get("failed", 0)
+        return passed / total if total > 0 else -1.0
+
+# The summary is the last line; look only this far back when no streamed summary is available.
+SUMMARY_TAIL_CHARS = 4096
+
+@traced("parse.pytest_summary")
+def pytest_pass_rate(stdout: str, summary: Optional[Dict[str, int]]=None) -> float:
+    """Pass rate from a streamed summary if given, else from the tail of `stdout`.
+
+    Falls back to `parse_pytest_pass_rate` over the whole text if no summary line is found.
+    """
+    det = PytestSummaryDetector()
+    if summary is not None:
+        det.counts = dict(summary)
+    else:
+        det.feed(stdout[-SUMMARY_TAIL_CHARS:])
+        det.finish()
+    if det.found:
+        return det.pass_rate
+    return parse_pytest_pass_rate(stdout)
@@ -0,0 +1,250 @@
+"""Opt-in tracing: nested timing spans, per-name latency histograms, Chrome trace export.
+
+    from tu_agent.utils import trace
+    tracer = trace.enable()
+    with trace.span("env.step", tool="pytest"):
+        ...
+    tracer.histograms()["env.step"].summary()
+    tracer.export_chrome("trace.json")   # open in chrome://tracing or Perfetto
+
+Tracing is off by default. Until `enable()` is called, `span()` returns a
+shared no-op context manager after one global check, and `observe()` and
+`record()` return immediately.
+
+Nesting follows a `contextvars` stack, so both threads and asyncio tasks
+keep their own parent chains. Each event goes into a bounded ring buffer
+(`max_events`) with its thread id. Aggregates don't depend on that buffer:
+every finished span also lands in the histogram for its name, so long runs
+keep exact counts and approximate percentiles after old events drop out.
+"""
+from __future__ import annotations
+import contextvars
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Histogram buckets grow by 2**(1/8) (~9%) from 1 us; values are in seconds.
+_BUCKET_BASE_S = 1e-6
+_BUCKETS_PER_OCTAVE = 8
+
+class LatencyHistogram:
+    """Log-bucketed histogram of durations (seconds): exact count/sum/min/max, percentiles within ~5%."""
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, x: float):
+        self.count += 1
+        self.total += x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        b = int(math.log2(x / _BUCKET_BASE_S) * _BUCKETS_PER_OCTAVE) + 1 if x > _BUCKET_BASE_S else 0
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return float("nan")
+        rank = q / 100.0 * (self.count - 1)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen > rank:
+                # geometric middle of the bucket, clamped to what was observed
+                mid = _BUCKET_BASE_S * 2 ** ((b - 0.5) / _BUCKETS_PER_OCTAVE) if b else _BUCKET_BASE_S / 2
+                return min(max(mid, self.min), self.max)
+        return self.max
+
+    def summary(self, qs=(50, 90, 99)) -> Dict[str, float]:
+        out = {"n": self.count, "mean": self.total / self.count if self.count else float("nan"),
+               "min": self.min if self.count else float("nan"), "max": self.max if self.count else float("nan")}
+        for q in qs:
+            out[f"p{q:g}"] = self.percentile(q)
+        return out
+
+    def merge(self, other: "LatencyHistogram"):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for b, n in other.buckets.items():
+            self.buckets[b] = self.buckets.get(b, 0) + n
+
+# (name, start_ns, dur_ns, tid, depth, args)
+Event = Tuple[str, int, int, int, int, Optional[Dict[str, Any]]]
+
+_depth: contextvars.ContextVar[int] = contextvars.ContextVar("tu_agent_trace_depth", default=0)
+
+class Tracer:
+    """Collects spans: a bounded event buffer for Chrome export plus a histogram per span name."""
+
+    def __init__(self, max_events: int=1_000_000):
+        self.events: Deque[Event] = deque(maxlen=max_events)
+        self._hists: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+        self._t0_ns = time.perf_counter_ns()
+        self.dropped = 0
+
+    def record(self, name: str, start_ns: int, dur_ns: int, depth: int=0, args: Optional[Dict[str, Any]]=None):
+        with self._lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((name, start_ns, dur_ns, threading.get_ident(), depth, args))
+            h = self._hists.get(name)
+            if h is None:
+                h = self._hists[name] = LatencyHistogram()
+            h.add(dur_ns / 1e9)
+
+    def observe(self, name: str, seconds: float):
+        """Add a duration to the `name` histogram without an event (e.g. a derived overhead)."""
+        with self._lock:
+            h = self._hists.get(name)
+            if h is None:
+                h = self._hists[name] = LatencyHistogram()
+            h.add(max(0.0, seconds))
+
+    def histograms(self) -> Dict[str, LatencyHistogram]:
+        with self._lock:
+            return dict(self._hists)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per-name histogram summaries (seconds), sorted by total time spent."""
+        hists = self.histograms()
+        return {n: dict(h.summary(), total=h.total) for n, h in sorted(hists.items(), key=lambda kv: -kv[1].total)}
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Trace-event JSON ("X" complete events, microseconds) for chrome://tracing / Perfetto."""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+        out = []
+        for name, start_ns, dur_ns, tid, _depth, args in events:
+            ev = {"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                  "ts": (start_ns - self._t0_ns) / 1e3, "dur": dur_ns / 1e3}
+            if args:
+                ev["args"] = args
+            out.append(ev)
+        return {"traceEvents": out, "displayTimeUnit": "ms", "otherData": {"dropped_events": self.dropped}}
+
+    def export_chrome(self, path: str):
+        tmp = f"{path}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f, default=str)
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self._hists = {}
+            self.dropped = 0
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start", "token")
+
+    def __init__(self, tracer: Tracer, name: str, args: Optional[Dict[str, Any]]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        """Attach more args to the span (e.g. a result known only at the end)."""
+        if self.args is None:
+            self.args = {}
+        self.args.update(args)
+
+    def __enter__(self) -> "_Span":
+        self.token = _depth.set(_depth.get() + 1)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        dur = time.perf_counter_ns() - self.start
+        _depth.reset(self.token)
+        self.tracer.record(self.name, self.start, dur, _depth.get(), self.args)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+_tracer: Optional[Tracer] = None
+
+def enable(tracer: Optional[Tracer]=None) -> Tracer:
+    """Start tracing into `tracer` (a new one if None) and return it."""
+    global _tracer
+    _tracer = tracer or Tracer()
+    return _tracer
+
+def disable() -> Optional[Tracer]:
+    """Stop tracing; returns the tracer that was active."""
+    global _tracer
+    t, _tracer = _tracer, None
+    return t
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+def enabled() -> bool:
+    return _tracer is not None
+
+def span(name: str, **args):
+    """Context manager timing a nested span; a shared no-op when tracing is off."""
+    t = _tracer
+    if t is None:
+        return _NOOP
+    return _Span(t, name, args or None)
+
+def observe(name: str, seconds: float):
+    t = _tracer
+    if t is not None:
+        t.observe(name, seconds)
+
+def record(name: str, start_ns: int, dur_ns: int, **args):
+    """Add an already-measured span (perf_counter_ns clock) at the current nesting depth."""
+    t = _tracer
+    if t is not None:
+        t.record(name, start_ns, dur_ns, _depth.get(), args or None)
+
+def traced(name: Optional[str]=None) -> Callable[[F], F]:
+    """Decorator wrapping every call in `span(name or qualname)`."""
+    def deco(fn: F) -> F:
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            if _tracer is None:
+                return fn(*a, **kw)
+            with _Span(_tracer, label, None):
+                return fn(*a, **kw)
+        return wrapper  # type: ignore[return-value]
+    return deco
+
+def format_summary(tracer: Tracer, top: int=20) -> str:
+    """The `top` span names by total time, as a fixed-width table in milliseconds."""
+    lines = [f"{'span':<32}{'n':>8}{'total':>11}{'p50':>10}{'p90':>10}{'p99':>10}"]
+    for name, s in list(tracer.summary().items())[:top]:
+        lines.append(f"{name:<32}{s['n']:>8}{s['total']*1e3:11.1f}{s['p50']*1e3:10.3f}{s['p90']*1e3:10.3f}{s['p99']*1e3:10.3f}")
+    return "\n".join(lines)
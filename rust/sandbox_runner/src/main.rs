@@ -1,13 +1,19 @@
 use anyhow::{anyhow, Context, Result};
 use clap::{Parser, Subcommand};
 use regex::Regex;
-use serde::Serialize;
+use serde::{Deserialize, Serialize};
 use std::fs;
-use std::io::{Read};
+use std::collections::{BTreeMap, HashMap, VecDeque};
+use std::io::{BufRead, BufReader, Read, Write};
 use std::path::{Path, PathBuf};
 use std::process::{Command, Stdio};
+use std::sync::atomic::{AtomicU64, Ordering};
 use std::time::{Duration, Instant};
 
+mod shard;
+
+const DEFAULT_MAX_OUTPUT_BYTES: usize = 1 << 20;
+
 #[derive(Parser, Debug)]
 #[command(name = "sandbox_runner", version, about = "Best-effort sandboxed runner for untrusted evaluation.")]
 struct Cli {
@@ -19,6 +25,22 @@ struct Cli {
     #[arg(long, default_value_t = 10000)]
     timeout_ms: u64,
 
+    /// Per-stream output cap in bytes; the first and last halves are kept.
+    #[arg(long, default_value_t = DEFAULT_MAX_OUTPUT_BYTES)]
+    max_output_bytes: usize,
+
+    /// RLIMIT_CPU for the child, in seconds (0 = leave unchanged).
+    #[arg(long, default_value_t = 2)]
+    cpu_secs: u64,
+
+    /// RLIMIT_AS for the child, in MiB (0 = leave unchanged).
+    #[arg(long, default_value_t = 512)]
+    mem_mb: u64,
+
+    /// RLIMIT_NOFILE for the child (0 = leave unchanged).
+    #[arg(long, default_value_t = 256)]
+    nofile: u64,
+
     #[command(subcommand)]
     cmd: Commands,
 }
@@ -31,8 +53,17 @@ enum Commands {
         argv: Vec<String>,
     },
 
-    /// Convenience: run python -m pytest -q
-    Pytest {},
+    /// Convenience: run python -m pytest -q [-- <extra pytest args...>]
+    Pytest {
+        /// Split the collected tests across up to this many concurrent pytest processes.
+        #[arg(long, default_value_t = 1)]
+        shards: usize,
+        /// JSON object {nodeid: seconds} from earlier runs, used to balance the shards.
+        #[arg(long)]
+        durations: Option<PathBuf>,
+        #[arg(last = true)]
+        args: Vec<String>,
+    },
 
     /// Read a file (path relative to root). Prints JSON with stdout=contents.
     ReadFile {
@@ -42,6 +73,87 @@ enum Commands {
 
     /// Apply a unified diff patch read from stdin. Uses git apply or patch.
     ApplyDiff {},
+
+    /// Serve JSON-lines requests (one `Request` per line, one `RunnerOutput` per line)
+    /// on stdin/stdout, or on a Unix socket if --socket is given.
+    Serve {
+        #[arg(long)]
+        socket: Option<PathBuf>,
+    },
+}
+
+/// One operation, shared by the one-shot CLI and `serve` mode.
+#[derive(Deserialize, Debug)]
+#[serde(tag = "op", rename_all = "kebab-case")]
+enum Op {
+    Run { argv: Vec<String> },
+    Pytest {
+        #[serde(default)]
+        args: Vec<String>,
+        #[serde(default = "one_shard")]
+        shards: usize,
+        /// nodeid -> seconds, as with --durations
+        #[serde(default)]
+        durations: HashMap<String, f64>,
+    },
+    ReadFile { path: String },
+    ApplyDiff { patch: String },
+}
+
+fn one_shard() -> usize {
+    1
+}
+
+/// A `serve` request line, e.g. {"op": "read-file", "path": "src/solution.py"}.
+#[derive(Deserialize, Debug)]
+struct Request {
+    #[serde(flatten)]
+    op: Op,
+    /// Overrides the server's --timeout-ms for this request.
+    #[serde(default)]
+    timeout_ms: Option<u64>,
+    /// Overrides the server's --max-output-bytes for this request.
+    #[serde(default)]
+    max_output_bytes: Option<usize>,
+    /// Override the server's --cpu-secs / --mem-mb / --nofile for this request.
+    #[serde(default)]
+    cpu_secs: Option<u64>,
+    #[serde(default)]
+    mem_mb: Option<u64>,
+    #[serde(default)]
+    nofile: Option<u64>,
+}
+
+/// Per-request execution settings.
+#[derive(Clone, Copy, Debug)]
+struct RunOpts {
+    timeout_ms: u64,
+    max_output_bytes: usize,
+    cpu_secs: u64,
+    mem_mb: u64,
+    nofile: u64,
+}
+
+impl RunOpts {
+    fn from_cli(cli: &Cli) -> Self {
+        RunOpts {
+            timeout_ms: cli.timeout_ms,
+            max_output_bytes: cli.max_output_bytes,
+            cpu_secs: cli.cpu_secs,
+            mem_mb: cli.mem_mb,
+            nofile: cli.nofile,
+        }
+    }
+
+    fn with_request(self, req: &Request) -> Self {
+        RunOpts {
+            timeout_ms: req.timeout_ms.unwrap_or(self.timeout_ms),
+            max_output_bytes: req.max_output_bytes.unwrap_or(self.max_output_bytes),
+            cpu_secs: req.cpu_secs.unwrap_or(self.cpu_secs),
+            mem_mb: req.mem_mb.unwrap_or(self.mem_mb),
+            nofile: req.nofile.unwrap_or(self.nofile),
+        }
+    }
 }
 
 #[derive(Serialize)]
@@ -56,23 +168,103 @@ struct RunnerOutput {
     timed_out: bool,
     killed: bool,
     command: Vec<String>,
+    /// Output exceeded max_output_bytes and the middle was dropped.
+    truncated: bool,
+    stdout_bytes: u64,
+    stderr_bytes: u64,
+    /// Kernel accounting for the reaped child (unix only; null when nothing ran).
+    rusage: Option<Usage>,
+    /// Per-shard results of a sharded pytest run (absent otherwise).
+    #[serde(skip_serializing_if = "Option::is_none")]
+    shards: Option<Vec<ShardOutput>>,
+}
+
+#[derive(Serialize)]
+struct ShardOutput {
+    tests: usize,
+    exit_code: i32,
+    duration_s: f64,
+    timed_out: bool,
+    /// This shard's JUnit report, when the args asked for one.
+    junitxml: Option<String>,
+}
+
+/// What `wait4` reports for a child and the descendants it waited for.
+#[derive(Serialize, Default, Clone, Copy)]
+struct Usage {
+    user_s: f64,
+    sys_s: f64,
+    /// Peak resident set size in KiB.
+    max_rss_kb: i64,
+    /// Block input / output operations.
+    inblock: i64,
+    oublock: i64,
+    /// Voluntary / involuntary context switches.
+    nvcsw: i64,
+    nivcsw: i64,
+}
+
+impl Usage {
+    /// Totals for two sequential commands (peak RSS is the larger peak).
+    fn add(self, o: Usage) -> Usage {
+        Usage {
+            user_s: self.user_s + o.user_s,
+            sys_s: self.sys_s + o.sys_s,
+            max_rss_kb: self.max_rss_kb.max(o.max_rss_kb),
+            inblock: self.inblock + o.inblock,
+            oublock: self.oublock + o.oublock,
+            nvcsw: self.nvcsw + o.nvcsw,
+            nivcsw: self.nivcsw + o.nivcsw,
+        }
+    }
+
+    #[cfg(unix)]
+    fn from_rusage(ru: &libc::rusage) -> Usage {
+        let secs = |tv: libc::timeval| tv.tv_sec as f64 + tv.tv_usec as f64 / 1e6;
+        // Linux reports ru_maxrss in KiB, macOS in bytes.
+        let rss_div = if cfg!(target_os = "macos") { 1024 } else { 1 };
+        Usage {
+            user_s: secs(ru.ru_utime),
+            sys_s: secs(ru.ru_stime),
+            max_rss_kb: ru.ru_maxrss as i64 / rss_div,
+            inblock: ru.ru_inblock as i64,
+            oublock: ru.ru_oublock as i64,
+            nvcsw: ru.ru_nvcsw as i64,
+            nivcsw: ru.ru_nivcsw as i64,
+        }
+    }
+}
+
+fn error_output(e: anyhow::Error) -> RunnerOutput {
+    RunnerOutput {
+        ok: false,
+        exit_code: 1,
+        duration_s: 0.0,
+        stdout: "".into(),
+        stderr: format!("{:#}", e),
+        timed_out: false,
+        killed: false,
+        command: vec![],
+        truncated: false,
+        stdout_bytes: 0,
+        stderr_bytes: 0,
+        rusage: None,
+        shards: None,
+    }
 }
 
 fn main() {
     let cli = Cli::parse();
-    let out = match run(cli) {
-        Ok(o) => o,
-        Err(e) => RunnerOutput {
-            ok: false,
-            exit_code: 1,
-            duration_s: 0.0,
-            stdout: "".into(),
-            stderr: format!("{:#}", e),
-            timed_out: false,
-            killed: false,
-            command: vec![],
-        },
-    };
+    if let Commands::Serve { socket } = &cli.cmd {
+        let opts = RunOpts::from_cli(&cli);
+        if let Err(e) = serve_main(&cli.root, opts, socket.as_deref()) {
+            eprintln!("sandbox_runner serve: {:#}", e);
+            std::process::exit(1);
+        }
+        return;
+    }
+
+    let out = run(cli).unwrap_or_else(error_output);
 
     // Always print JSON on stdout for machine parsing.
     println!("{}", serde_json::to_string(&out).unwrap());
@@ -130,19 +322,46 @@ fn validate_patch_paths(patch: &str) -> Result<()> {
 
 fn run(cli: Cli) -> Result<RunnerOutput> {
     let root = canonicalize_root(&cli.root)?;
-    match cli.cmd {
-        Commands::Run { argv } => {
+    let opts = RunOpts::from_cli(&cli);
+    let op = match cli.cmd {
+        Commands::Run { argv } => Op::Run { argv },
+        Commands::Pytest { args, shards, durations } => {
+            let durations = match durations {
+                Some(p) => {
+                    let data = fs::read(&p).with_context(|| format!("failed to read durations: {}", p.display()))?;
+                    serde_json::from_slice(&data).context("durations must be a JSON object of seconds")?
+                }
+                None => HashMap::new(),
+            };
+            Op::Pytest { args, shards, durations }
+        }
+        Commands::ReadFile { path } => Op::ReadFile { path },
+        Commands::ApplyDiff {} => {
+            let mut patch = String::new();
+            std::io::stdin().read_to_string(&mut patch)?;
+            Op::ApplyDiff { patch }
+        }
+        Commands::Serve { .. } => unreachable!("serve is handled in main"),
+    };
+    execute(&root, opts, op)
+}
+
+fn execute(root: &Path, opts: RunOpts, op: Op) -> Result<RunnerOutput> {
+    match op {
+        Op::Run { argv } => {
             if argv.is_empty() {
                 return Err(anyhow!("missing command argv"));
             }
-            run_command(&root, cli.timeout_ms, &argv)
+            run_command(root, opts, &argv)
         }
-        Commands::Pytest {} => {
-            // Use python -m pytest -q
-            run_command(&root, cli.timeout_ms, &vec!["python".into(), "-m".into(), "pytest".into(), "-q".into()])
+        Op::Pytest { args, shards, durations } => {
+            if shards > 1 {
+                return run_sharded_pytest(root, opts, &args, shards, &durations);
+            }
+            run_command(root, opts, &pytest_argv(&args))
         }
-        Commands::ReadFile { path } => {
-            let p = ensure_within_root(&root, &path)?;
+        Op::ReadFile { path } => {
+            let p = ensure_within_root(root, &path)?;
             let bytes = fs::read(&p).with_context(|| format!("read failed: {}", p.display()))?;
             let s = String::from_utf8_lossy(&bytes).to_string();
             Ok(RunnerOutput {
@@ -154,11 +373,14 @@ fn run(cli: Cli) -> Result<RunnerOutput> {
                 timed_out: false,
                 killed: false,
                 command: vec!["read-file".into(), path],
+                truncated: false,
+                stdout_bytes: bytes.len() as u64,
+                stderr_bytes: 0,
+                rusage: None,
+                shards: None,
             })
         }
-        Commands::ApplyDiff {} => {
-            let mut patch = String::new();
-            std::io::stdin().read_to_string(&mut patch)?;
+        Op::ApplyDiff { patch } => {
             validate_patch_paths(&patch)?;
 
             // Write patch to a temp file inside root to avoid cross-dir references
@@ -166,7 +388,7 @@ fn run(cli: Cli) -> Result<RunnerOutput> {
             fs::write(&patch_path, patch.as_bytes()).context("failed to write temp patch")?;
 
             // Try git apply first, then fall back to patch(1)
-            let git_res = run_command(&root, cli.timeout_ms, &vec![
+            let git_res = run_command(root, opts, &vec![
                 "git".into(), "apply".into(),
                 "--unsafe-paths".into(),
                 "--whitespace=nowarn".into(),
@@ -174,25 +396,236 @@ fn run(cli: Cli) -> Result<RunnerOutput> {
             ]);
 
             let out = match git_res {
-                Ok(o) if o.ok => o,
-                _ => {
+                Ok(o) if o.ok => Ok(o),
+                git_res => {
                     // patch -p1 < .tu_agent_patch.diff
                     // We'll run: patch -p1 -i .tu_agent_patch.diff
-                    run_command(&root, cli.timeout_ms, &vec![
+                    let git_usage = git_res.ok().and_then(|o| o.rusage);
+                    run_command(root, opts, &vec![
                         "patch".into(), "-p1".into(), "-i".into(), ".tu_agent_patch.diff".into()
-                    ])?
+                    ]).map(|mut o| {
+                        // charge the failed git attempt too
+                        if let (Some(g), Some(p)) = (git_usage, o.rusage) {
+                            o.rusage = Some(g.add(p));
+                        }
+                        o
+                    })
                 }
             };
 
-            // Cleanup temp patch
+            // Cleanup temp patch (also when patch(1) could not be spawned,
+            // so a long-lived server does not leave it behind)
             let _ = fs::remove_file(&patch_path);
 
-            Ok(out)
+            out
+        }
+    }
+}
+
+/// python -m pytest -q, plus any extra args (test selection, report options)
+fn pytest_argv(args: &[String]) -> Vec<String> {
+    let mut argv: Vec<String> = vec!["python".into(), "-m".into(), "pytest".into(), "-q".into()];
+    argv.extend(args.iter().cloned());
+    argv
+}
+
+static ARGFILES: AtomicU64 = AtomicU64::new(0);
+
+/// `args` for shard `k`: its own JUnit report path, and its own node ids in place of the test paths.
+/// Returns the args, the report path and the @argfile written for long id lists (the caller removes it).
+fn shard_args(args: &[String], root: &Path, k: usize, ids: &[String]) -> Result<(Vec<String>, Option<String>, Option<PathBuf>)> {
+    let mut out = Vec::with_capacity(args.len() + ids.len());
+    let mut junit = None;
+    let args = shard::without_test_paths(args, root);
+    let mut it = args.iter();
+    while let Some(a) = it.next() {
+        if let Some(p) = a.strip_prefix("--junitxml=") {
+            let p = format!("{}.shard{}", p, k);
+            out.push(format!("--junitxml={}", p));
+            junit = Some(p);
+        } else if a == "--junitxml" {
+            out.push(a.clone());
+            if let Some(p) = it.next() {
+                let p = format!("{}.shard{}", p, k);
+                out.push(p.clone());
+                junit = Some(p);
+            }
+        } else {
+            out.push(a.clone());
+        }
+    }
+    if ids.iter().map(|id| id.len() + 1).sum::<usize>() <= shard::ARGFILE_BYTES {
+        out.extend(ids.iter().cloned());
+        return Ok((out, junit, None));
+    }
+    let n = ARGFILES.fetch_add(1, Ordering::Relaxed);
+    let argfile = std::env::temp_dir().join(format!("sandbox_runner_{}_{}.shard{}.args", std::process::id(), n, k));
+    let mut body = String::new();
+    for id in ids {
+        body.push_str(id);
+        body.push('\n');
+    }
+    fs::write(&argfile, body).with_context(|| format!("writing {}", argfile.display()))?;
+    out.push(format!("@{}", argfile.display()));
+    Ok((out, junit, Some(argfile)))
+}
+
+/// Collect once, run up to `shards` pytest processes concurrently (each under
+/// `opts`' limits and timeout) and merge them into one output.
+fn run_sharded_pytest(root: &Path, opts: RunOpts, args: &[String], shards: usize, durations: &HashMap<String, f64>) -> Result<RunnerOutput> {
+    let start = Instant::now();
+    // a report option would only write an empty report here
+    let mut collect_args: Vec<String> = args.iter().filter(|a| !a.starts_with("--junitxml")).cloned().collect();
+    collect_args.push("--collect-only".into());
+    let collect = run_command(root, opts, &pytest_argv(&collect_args))?;
+    let ids = shard::collected_ids(&collect.stdout);
+    if !collect.ok || ids.len() < 2 {
+        // nothing to split, or collection failed: a plain run reports it as usual
+        return run_command(root, opts, &pytest_argv(args));
+    }
+    let parts = shard::split(&ids, shards, durations);
+    let outs: Vec<Result<(RunnerOutput, Option<String>)>> = std::thread::scope(|s| {
+        let handles: Vec<_> = (0..parts.len())
+            .map(|k| {
+                let parts = &parts;
+                s.spawn(move || {
+                    let (a, junit, argfile) = shard_args(args, root, k, &parts[k])?;
+                    let out = run_command(root, opts, &pytest_argv(&a)).map(|o| (o, junit));
+                    if let Some(f) = argfile {
+                        let _ = fs::remove_file(f);
+                    }
+                    out
+                })
+            })
+            .collect();
+        handles
+            .into_iter()
+            .map(|h| h.join().unwrap_or_else(|_| Err(anyhow!("shard thread panicked"))))
+            .collect()
+    });
+
+    let n = parts.len();
+    let mut stdout = String::new();
+    let mut stderr = String::new();
+    let mut counts: BTreeMap<String, u64> = BTreeMap::new();
+    let mut summarized = false;
+    let (mut ok, mut exit_code, mut timed_out, mut killed, mut truncated) = (true, 0, false, false, false);
+    let (mut stdout_bytes, mut stderr_bytes) = (0, 0);
+    let mut rusage = collect.rusage;
+    let mut infos = Vec::with_capacity(n);
+    for (k, out) in outs.into_iter().enumerate() {
+        let (o, junitxml) = out?;
+        let (body, c) = shard::take_summary(&o.stdout);
+        summarized |= !c.is_empty();
+        // selection happened at collection; a shard's deselections aren't results
+        for (w, x) in c.into_iter().filter(|(w, _)| w != "deselected") {
+            *counts.entry(w).or_insert(0) += x;
+        }
+        stdout.push_str(&format!("==== shard {}/{}: {} tests ====\n", k + 1, n, parts[k].len()));
+        stdout.push_str(&body);
+        if !o.stderr.is_empty() {
+            stderr.push_str(&o.stderr);
+            if !o.stderr.ends_with('\n') {
+                stderr.push('\n');
+            }
+        }
+        ok &= o.ok;
+        exit_code = exit_code.max(o.exit_code);
+        timed_out |= o.timed_out;
+        killed |= o.killed;
+        truncated |= o.truncated;
+        stdout_bytes += o.stdout_bytes;
+        stderr_bytes += o.stderr_bytes;
+        rusage = match (rusage, o.rusage) {
+            (Some(a), Some(b)) => Some(a.add(b)),
+            (a, b) => a.or(b),
+        };
+        infos.push(ShardOutput { tests: parts[k].len(), exit_code: o.exit_code, duration_s: o.duration_s, timed_out: o.timed_out, junitxml });
+    }
+    let duration_s = start.elapsed().as_secs_f64();
+    if summarized {
+        stdout.push_str(&shard::summary_line(&counts, duration_s));
+        stdout.push('\n');
+    }
+    Ok(RunnerOutput {
+        ok,
+        exit_code,
+        duration_s,
+        stdout,
+        stderr,
+        timed_out,
+        killed,
+        command: pytest_argv(args),
+        truncated,
+        stdout_bytes,
+        stderr_bytes,
+        rusage,
+        shards: Some(infos),
+    })
+}
+
+fn serve_main(root: &Path, opts: RunOpts, socket: Option<&Path>) -> Result<()> {
+    let root = canonicalize_root(root)?;
+    let Some(socket) = socket else {
+        let stdin = std::io::stdin();
+        let stdout = std::io::stdout();
+        return serve(&root, opts, stdin.lock(), stdout.lock());
+    };
+
+    #[cfg(unix)]
+    {
+        use std::os::unix::net::UnixListener;
+        // A stale socket from a previous server would make bind fail.
+        let _ = fs::remove_file(socket);
+        let listener = UnixListener::bind(socket)
+            .with_context(|| format!("failed to bind socket: {}", socket.display()))?;
+        for stream in listener.incoming() {
+            let stream = match stream {
+                Ok(s) => s,
+                Err(e) => {
+                    eprintln!("sandbox_runner serve: accept failed: {}", e);
+                    continue;
+                }
+            };
+            let root = root.clone();
+            std::thread::spawn(move || {
+                let reader = match stream.try_clone() {
+                    Ok(r) => BufReader::new(r),
+                    Err(_) => return,
+                };
+                let _ = serve(&root, opts, reader, stream);
+            });
         }
+        Ok(())
+    }
+    #[cfg(not(unix))]
+    {
+        Err(anyhow!("--socket is only supported on Unix: {}", socket.display()))
     }
 }
 
-fn run_command(root: &Path, timeout_ms: u64, argv: &Vec<String>) -> Result<RunnerOutput> {
+/// Answer one `RunnerOutput` line per request line until EOF.
+fn serve<R: BufRead, W: Write>(root: &Path, opts: RunOpts, reader: R, mut writer: W) -> Result<()> {
+    for line in reader.lines() {
+        let line = line?;
+        if line.trim().is_empty() {
+            continue;
+        }
+        let out = match serde_json::from_str::<Request>(&line) {
+            Ok(req) => {
+                let req_opts = opts.with_request(&req);
+                execute(root, req_opts, req.op).unwrap_or_else(error_output)
+            }
+            Err(e) => error_output(anyhow!("invalid request: {}", e)),
+        };
+        serde_json::to_writer(&mut writer, &out)?;
+        writer.write_all(b"\n")?;
+        writer.flush()?;
+    }
+    Ok(())
+}
+
+fn run_command(root: &Path, opts: RunOpts, argv: &Vec<String>) -> Result<RunnerOutput> {
     let start = Instant::now();
     let mut cmd = Command::new(&argv[0]);
     cmd.args(&argv[1..]);
@@ -209,57 +642,220 @@ fn run_command(root: &Path, timeout_ms: u64, argv: &Vec<String>) -> Result<Runne
     #[cfg(unix)]
     {
         use std::os::unix::process::CommandExt;
-        cmd.pre_exec(move || {
-            // CPU seconds, address space, open files
-            set_rlimit(libc::RLIMIT_CPU, 2, 2)?;
-            set_rlimit(libc::RLIMIT_NOFILE, 256, 256)?;
-            // 512MB address space (best-effort, may be ignored on some OS)
-            set_rlimit(libc::RLIMIT_AS, 512 * 1024 * 1024, 512 * 1024 * 1024)?;
-            Ok(())
-        });
+        // Own process group, so a timeout can take down pytest's children too.
+        cmd.process_group(0);
+        let (cpu, nofile, mem) = (opts.cpu_secs, opts.nofile, opts.mem_mb * 1024 * 1024);
+        // SAFETY: the closure only calls setrlimit, which is async-signal-safe.
+        unsafe {
+            cmd.pre_exec(move || {
+                // CPU seconds, address space, open files; 0 leaves a limit unchanged
+                if cpu > 0 {
+                    set_rlimit(libc::RLIMIT_CPU, cpu, cpu)?;
+                }
+                if nofile > 0 {
+                    set_rlimit(libc::RLIMIT_NOFILE, nofile, nofile)?;
+                }
+                // address space (best-effort, may be ignored on some OS)
+                if mem > 0 {
+                    set_rlimit(libc::RLIMIT_AS, mem, mem)?;
+                }
+                Ok(())
+            });
+        }
     }
 
     let mut child = cmd.spawn().with_context(|| format!("failed to spawn: {:?}", argv))?;
 
-    let timeout = Duration::from_millis(timeout_ms);
-    let mut timed_out = false;
-    let mut killed = false;
+    // Drain both pipes while the child runs, keeping only a bounded head + tail.
+    let stdout_reader = spawn_capture(child.stdout.take(), opts.max_output_bytes);
+    let stderr_reader = spawn_capture(child.stderr.take(), opts.max_output_bytes);
 
-    loop {
-        if start.elapsed() >= timeout {
-            timed_out = true;
-            // kill child
-            let _ = child.kill();
-            killed = true;
-            break;
-        }
-        match child.try_wait()? {
-            Some(_status) => break,
-            None => std::thread::sleep(Duration::from_millis(10)),
-        }
-    }
+    let timeout = Duration::from_millis(opts.timeout_ms);
+    let timed_out = !wait_exit(&mut child, timeout);
+    // Also clears out anything the command left running in its group, which
+    // would otherwise keep the pipes (and the reader threads) open.
+    kill_group(&mut child);
+    let killed = timed_out;
+    let (status, rusage) = reap(&mut child)?;
 
-    let output = child.wait_with_output()?;
+    let stdout = stdout_reader.join().unwrap_or_default();
+    let stderr = stderr_reader.join().unwrap_or_default();
     let duration_s = start.elapsed().as_secs_f64();
-    let exit_code = output.status.code().unwrap_or(if output.status.success() { 0 } else { 1 });
-
-    let stdout = String::from_utf8_lossy(&output.stdout).to_string();
-    let stderr = String::from_utf8_lossy(&output.stderr).to_string();
+    let exit_code = status.code().unwrap_or(if status.success() { 0 } else { 1 });
 
     Ok(RunnerOutput {
-        ok: output.status.success() && !timed_out,
+        ok: status.success() && !timed_out,
         exit_code,
         duration_s,
-        stdout,
-        stderr,
+        truncated: stdout.truncated() || stderr.truncated(),
+        stdout_bytes: stdout.total,
+        stderr_bytes: stderr.total,
+        stdout: stdout.into_string(),
+        stderr: stderr.into_string(),
         timed_out,
         killed,
         command: argv.clone(),
+        rusage,
+        shards: None,
     })
 }
 
+/// Reaps `child`, collecting its resource usage with `wait4` where available.
+#[cfg(unix)]
+fn reap(child: &mut std::process::Child) -> Result<(std::process::ExitStatus, Option<Usage>)> {
+    use std::os::unix::process::ExitStatusExt;
+    let pid = child.id() as libc::pid_t;
+    let mut status: libc::c_int = 0;
+    let mut ru: libc::rusage = unsafe { std::mem::zeroed() };
+    loop {
+        // SAFETY: wait4 only writes into `status` and `ru`. `child` is not
+        // waited on again afterwards, so std never sees the reaped pid.
+        let r = unsafe { libc::wait4(pid, &mut status, 0, &mut ru) };
+        if r == pid {
+            return Ok((std::process::ExitStatus::from_raw(status), Some(Usage::from_rusage(&ru))));
+        }
+        let err = std::io::Error::last_os_error();
+        if err.kind() != std::io::ErrorKind::Interrupted {
+            return Err(err).context("wait4 failed");
+        }
+    }
+}
+
+#[cfg(not(unix))]
+fn reap(child: &mut std::process::Child) -> Result<(std::process::ExitStatus, Option<Usage>)> {
+    Ok((child.wait()?, None))
+}
+
+/// Blocks until `child` exits or `timeout` passes; returns false on timeout.
+///
+/// The child is not reaped, so its pid (and process group id) stays reserved
+/// until the caller has signalled the group and called `wait`.
+#[cfg(unix)]
+fn wait_exit(child: &mut std::process::Child, timeout: Duration) -> bool {
+    let pid = child.id() as libc::id_t;
+    let (tx, rx) = std::sync::mpsc::channel();
+    std::thread::spawn(move || {
+        let mut info: libc::siginfo_t = unsafe { std::mem::zeroed() };
+        loop {
+            // SAFETY: waitid only writes into `info`.
+            let r = unsafe { libc::waitid(libc::P_PID, pid, &mut info, libc::WEXITED | libc::WNOWAIT) };
+            if r == 0 || std::io::Error::last_os_error().kind() != std::io::ErrorKind::Interrupted {
+                break;
+            }
+        }
+        let _ = tx.send(());
+    });
+    !matches!(rx.recv_timeout(timeout), Err(std::sync::mpsc::RecvTimeoutError::Timeout))
+}
+
+#[cfg(not(unix))]
+fn wait_exit(child: &mut std::process::Child, timeout: Duration) -> bool {
+    let start = Instant::now();
+    while start.elapsed() < timeout {
+        match child.try_wait() {
+            Ok(None) => std::thread::sleep(Duration::from_millis(10)),
+            _ => return true,
+        }
+    }
+    false
+}
+
+#[cfg(unix)]
+fn kill_group(child: &mut std::process::Child) {
+    // SAFETY: plain syscall; the child is unreaped, so -pid is still its group.
+    unsafe {
+        libc::kill(-(child.id() as libc::pid_t), libc::SIGKILL);
+    }
+}
+
+#[cfg(not(unix))]
+fn kill_group(child: &mut std::process::Child) {
+    let _ = child.kill();
+}
+
+/// Bounded capture of one output stream: the first `cap - cap/2` bytes and the
+/// most recent `cap/2` bytes, plus the total byte count.
+#[derive(Default)]
+struct Capture {
+    head: Vec<u8>,
+    tail: VecDeque<u8>,
+    head_cap: usize,
+    tail_cap: usize,
+    total: u64,
+}
+
+impl Capture {
+    fn new(cap: usize) -> Self {
+        Capture {
+            head: Vec::new(),
+            tail: VecDeque::new(),
+            head_cap: cap - cap / 2,
+            tail_cap: cap / 2,
+            total: 0,
+        }
+    }
+
+    fn feed(&mut self, mut data: &[u8]) {
+        self.total += data.len() as u64;
+        let room = self.head_cap.saturating_sub(self.head.len());
+        if room > 0 {
+            let n = room.min(data.len());
+            self.head.extend_from_slice(&data[..n]);
+            data = &data[n..];
+        }
+        if data.is_empty() || self.tail_cap == 0 {
+            return;
+        }
+        if data.len() >= self.tail_cap {
+            self.tail.clear();
+            data = &data[data.len() - self.tail_cap..];
+        }
+        let overflow = (self.tail.len() + data.len()).saturating_sub(self.tail_cap);
+        self.tail.drain(..overflow);
+        self.tail.extend(data.iter().copied());
+    }
+
+    fn truncated(&self) -> bool {
+        self.total > (self.head.len() + self.tail.len()) as u64
+    }
+
+    fn into_string(self) -> String {
+        let dropped = self.total - (self.head.len() + self.tail.len()) as u64;
+        let mut bytes = self.head;
+        if dropped > 0 {
+            bytes.extend_from_slice(format!("\n... [{} bytes truncated] ...\n", dropped).as_bytes());
+        }
+        bytes.extend(self.tail);
+        String::from_utf8_lossy(&bytes).to_string()
+    }
+}
+
+fn spawn_capture<R: Read + Send + 'static>(pipe: Option<R>, cap: usize) -> std::thread::JoinHandle<Capture> {
+    std::thread::spawn(move || {
+        let mut c = Capture::new(cap);
+        if let Some(mut pipe) = pipe {
+            let mut buf = [0u8; 64 * 1024];
+            loop {
+                match pipe.read(&mut buf) {
+                    Ok(0) => break,
+                    Ok(n) => c.feed(&buf[..n]),
+                    Err(e) if e.kind() == std::io::ErrorKind::Interrupted => continue,
+                    Err(_) => break,
+                }
+            }
+        }
+        c
+    })
+}
+
+// glibc declares the RLIMIT_* constants with their own enum type.
+#[cfg(all(target_os = "linux", target_env = "gnu"))]
+type RlimitResource = libc::__rlimit_resource_t;
+#[cfg(all(unix, not(all(target_os = "linux", target_env = "gnu"))))]
+type RlimitResource = libc::c_int;
+
 #[cfg(unix)]
-fn set_rlimit(resource: libc::c_int, soft: u64, hard: u64) -> std::io::Result<()> {
+fn set_rlimit(resource: RlimitResource, soft: u64, hard: u64) -> std::io::Result<()> {
     let lim = libc::rlimit {
         rlim_cur: soft as libc::rlim_t,
         rlim_max: hard as libc::rlim_t,
@@ -0,0 +1,131 @@
+//! Helpers for splitting one pytest run across several processes.
+//!
+//! The sharded run collects node ids once (`pytest --collect-only -q`),
+//! assigns them to shards longest-first by known durations, runs each shard as
+//! the pytest command with its test paths replaced by the shard's own node ids
+//! (in an `@argfile` past `ARGFILE_BYTES`), and merges the outputs under a
+//! single pytest-style summary line.
+
+use regex::Regex;
+use std::collections::{BTreeMap, HashMap};
+use std::path::Path;
+
+/// pytest options whose value is the next argument, so it isn't taken for a test path
+const VALUE_OPTIONS: &[&str] = &[
+    "-k", "-m", "-p", "-o", "-c", "-W", "-r", "-n", "--deselect", "--ignore", "--ignore-glob", "--rootdir",
+    "--basetemp", "--confcutdir", "--junitxml", "--junit-xml", "--junit-prefix", "--durations", "--durations-min",
+    "--maxfail", "--tb", "--import-mode", "--override-ini", "--log-level", "--log-file", "--log-cli-level",
+];
+
+/// Node ids (bytes, one per line) a shard takes on its command line before they move to an @argfile.
+pub const ARGFILE_BYTES: usize = 32 * 1024;
+
+/// `args` minus the test paths / node ids in it (those that exist under `root` and aren't an option's value).
+///
+/// Collection already applied them; each shard is given its own node ids instead.
+pub fn without_test_paths(args: &[String], root: &Path) -> Vec<String> {
+    let mut out = Vec::with_capacity(args.len());
+    let mut prev = "";
+    for a in args {
+        let path = a.split("::").next().unwrap_or("");
+        let is_path = !VALUE_OPTIONS.contains(&prev) && !a.starts_with('-') && root.join(path).exists();
+        if !is_path {
+            out.push(a.clone());
+        }
+        prev = a;
+    }
+    out
+}
+
+/// Node ids from `pytest --collect-only -q` output (one per line, up to the first blank line).
+pub fn collected_ids(stdout: &str) -> Vec<String> {
+    stdout
+        .lines()
+        .take_while(|l| !l.trim().is_empty())
+        .filter(|l| l.contains("::") && !l.starts_with(char::is_whitespace))
+        .map(|l| l.trim_end().to_string())
+        .collect()
+}
+
+/// Longest-processing-time-first assignment of `ids` to at most `n` shards.
+///
+/// Tests without a known duration count as the mean of the known ones (1s if none
+/// are known). Ties go to the lower shard, so the split is deterministic.
+pub fn split(ids: &[String], n: usize, durations: &HashMap<String, f64>) -> Vec<Vec<String>> {
+    let n = n.clamp(1, ids.len().max(1));
+    let known: Vec<f64> = ids.iter().filter_map(|id| durations.get(id).copied()).collect();
+    let default = if known.is_empty() { 1.0 } else { known.iter().sum::<f64>() / known.len() as f64 };
+    let mut order: Vec<(f64, usize)> = ids
+        .iter()
+        .enumerate()
+        .map(|(i, id)| (durations.get(id).copied().unwrap_or(default), i))
+        .collect();
+    order.sort_by(|a, b| b.0.total_cmp(&a.0).then(a.1.cmp(&b.1)));
+    let mut load = vec![0.0f64; n];
+    let mut shards: Vec<Vec<usize>> = vec![Vec::new(); n];
+    for (d, i) in order {
+        let k = (0..n).min_by(|&a, &b| load[a].total_cmp(&load[b]).then(a.cmp(&b))).unwrap();
+        load[k] += d;
+        shards[k].push(i);
+    }
+    shards
+        .into_iter()
+        .map(|mut s| {
+            // keep collection order within a shard
+            s.sort_unstable();
+            s.into_iter().map(|i| ids[i].clone()).collect()
+        })
+        .collect()
+}
+
+fn summary_re() -> Regex {
+    // Same shape as tu_agent.utils.text.SUMMARY_LINE_RE: "2 failed, 1 passed in 0.04s"
+    Regex::new(r"^=*\s*(?P<body>(?:\d+ [a-z]+)(?:, \d+ [a-z]+)*|no tests ran)\s+in\s+[\d.]+s\b").unwrap()
+}
+
+/// Drops pytest's summary line from one shard's output and returns its counts.
+pub fn take_summary(stdout: &str) -> (String, BTreeMap<String, u64>) {
+    let re = summary_re();
+    let item = Regex::new(r"(?P<n>\d+) (?P<what>[a-z]+)").unwrap();
+    let mut counts = BTreeMap::new();
+    let mut kept = String::with_capacity(stdout.len());
+    for line in stdout.lines() {
+        if let Some(m) = re.captures(line.trim()) {
+            counts.clear();
+            for c in item.captures_iter(&m["body"]) {
+                let what = match &c["what"] {
+                    "errors" => "error",
+                    "warnings" => "warning",
+                    w => w,
+                };
+                *counts.entry(what.to_string()).or_insert(0) += c["n"].parse::<u64>().unwrap_or(0);
+            }
+            continue;
+        }
+        kept.push_str(line);
+        kept.push('\n');
+    }
+    (kept, counts)
+}
+
+/// A pytest-style final summary line for merged counts.
+pub fn summary_line(counts: &BTreeMap<String, u64>, secs: f64) -> String {
+    let rank = |w: &str| ["failed", "passed", "skipped", "xfailed", "xpassed", "error", "warning"]
+        .iter()
+        .position(|x| *x == w)
+        .unwrap_or(usize::MAX);
+    let mut items: Vec<(&String, &u64)> = counts.iter().filter(|(_, n)| **n > 0).collect();
+    items.sort_by_key(|(w, _)| (rank(w), w.to_string()));
+    if items.is_empty() {
+        return format!("no tests ran in {:.2}s", secs);
+    }
+    let body: Vec<String> = items
+        .into_iter()
+        .map(|(w, n)| match (w.as_str(), *n) {
+            ("error", n) if n > 1 => format!("{} errors", n),
+            ("warning", n) if n > 1 => format!("{} warnings", n),
+            (w, n) => format!("{} {}", n, w),
+        })
+        .collect();
+    format!("{} in {:.2}s", body.join(", "), secs)
+}